@@ -0,0 +1,333 @@
+import dataclasses
+import json
+import struct
+import typing
+import zlib
+from datetime import date
+from typing import Any, Callable, Dict, List, Tuple, Type, Union
+from allocation import config
+from allocation.domain import commands, events
+from allocation.service_layer import tracing
+
+Message = Union[commands.Command, events.Event]
+
+SCHEMA_VERSION = 1
+BINARY_MAGIC = 0xA1
+
+JSON_FIELD_ALIASES = {
+    commands.ChangeBatchQuantity: {"ref": "batchref"},
+}  # type: Dict[Type, Dict[str, str]]
+
+
+class CodecError(Exception):
+    pass
+
+
+def _message_classes() -> List[Type]:
+    return [
+        cls
+        for module, base in [(commands, commands.Command), (events, events.Event)]
+        for cls in vars(module).values()
+        if isinstance(cls, type) and issubclass(cls, base) and cls is not base
+    ]
+
+
+MESSAGE_TYPES = {cls.__name__: cls for cls in _message_classes()}
+TYPE_IDS = {
+    cls: zlib.crc32(name.encode()) & 0xFFFF for name, cls in MESSAGE_TYPES.items()
+}
+TYPES_BY_ID = {type_id: cls for cls, type_id in TYPE_IDS.items()}
+assert len(TYPES_BY_ID) == len(TYPE_IDS), "message type id collision"
+
+
+def _fields(cls) -> List[Tuple[str, Any]]:
+    hints = typing.get_type_hints(cls)
+    return [(f.name, hints[f.name]) for f in dataclasses.fields(cls)]
+
+
+def _is_optional(hint) -> bool:
+    return typing.get_origin(hint) is Union and type(None) in typing.get_args(hint)
+
+
+def _is_list(hint) -> bool:
+    return typing.get_origin(hint) in (list, List)
+
+
+class JsonCodec:
+    name = "json"
+
+    def __init__(self):
+        self._encoders = {cls: self._compile_encoder(cls) for cls in TYPE_IDS}
+        self._decoders = {cls: self._compile_decoder(cls) for cls in TYPE_IDS}
+
+    def encode(self, message: Message) -> bytes:
+        data = self._encoders[type(message)](message)
+        data["_v"] = SCHEMA_VERSION
+        data["_type"] = type(message).__name__
+        context = tracing.context_of(message)
+        if context is not None:
+            data["_trace"] = {
+                key: value
+                for key, value in dataclasses.asdict(context).items()
+                if value is not None
+            }
+        return json.dumps(data).encode()
+
+    def decode(self, payload: bytes, default_type: Type = None) -> Message:
+        data = json.loads(payload)
+        # untagged payloads from external producers predate the schema version
+        if data.get("_v", SCHEMA_VERSION) != SCHEMA_VERSION:
+            raise CodecError(f"unsupported json payload v{data['_v']}")
+        if "_type" not in data:
+            cls = default_type
+        elif data["_type"] in MESSAGE_TYPES:
+            cls = MESSAGE_TYPES[data["_type"]]
+        else:
+            raise CodecError(f"unknown message type {data['_type']!r}")
+        if cls is None:
+            raise CodecError(f"no message type in {payload!r}")
+        message = self._decoders[cls](data)
+        if "_trace" in data:
+            tracing.attach(message, tracing.TraceContext(**data["_trace"]))
+        return message
+
+    def _compile_encoder(self, cls) -> Callable[[Any], Dict]:
+        aliases = JSON_FIELD_ALIASES.get(cls, {})
+        fields = [
+            (name, aliases.get(name, name), self._value_encoder(hint))
+            for name, hint in _fields(cls)
+        ]
+
+        def encode(message):
+            return {key: enc(getattr(message, name)) for name, key, enc in fields}
+
+        return encode
+
+    def _compile_decoder(self, cls) -> Callable[[Dict], Any]:
+        aliases = JSON_FIELD_ALIASES.get(cls, {})
+        fields = [
+            (name, aliases.get(name, name), self._value_decoder(hint))
+            for name, hint in _fields(cls)
+        ]
+
+        def decode(data):
+            return cls(
+                **{name: dec(data[key]) for name, key, dec in fields if key in data}
+            )
+
+        return decode
+
+    def _value_encoder(self, hint) -> Callable:
+        if _is_optional(hint):
+            [inner] = [a for a in typing.get_args(hint) if a is not type(None)]
+            enc = self._value_encoder(inner)
+            return lambda value: None if value is None else enc(value)
+        if _is_list(hint):
+            [item] = typing.get_args(hint)
+            enc = self._value_encoder(item)
+            return lambda value: [enc(v) for v in value]
+        if hint is date:
+            return date.isoformat
+        if dataclasses.is_dataclass(hint):
+            return self._compile_encoder(hint)
+        return lambda value: value
+
+    def _value_decoder(self, hint) -> Callable:
+        if _is_optional(hint):
+            [inner] = [a for a in typing.get_args(hint) if a is not type(None)]
+            dec = self._value_decoder(inner)
+            return lambda value: None if value is None else dec(value)
+        if _is_list(hint):
+            [item] = typing.get_args(hint)
+            dec = self._value_decoder(item)
+            return lambda value: [dec(v) for v in value]
+        if hint is date:
+            return date.fromisoformat
+        if dataclasses.is_dataclass(hint):
+            return self._compile_decoder(hint)
+        return lambda value: value
+
+
+_HEADER = struct.Struct(">BBH")
+_U16 = struct.Struct(">H")
+_I32 = struct.Struct(">i")
+_U32 = struct.Struct(">I")
+_TRACE = struct.Struct(">B16s8s8s8s8s")
+_TRACE_FLAG = 0x01
+_NO_ID = bytes(8)
+
+
+class BinaryCodec:
+    name = "binary"
+
+    def __init__(self):
+        self._encoders = {cls: self._compile_encoder(cls) for cls in TYPE_IDS}
+        self._decoders = {cls: self._compile_decoder(cls) for cls in TYPE_IDS}
+
+    def encode(self, message: Message) -> bytes:
+        cls = type(message)
+        out = [_HEADER.pack(BINARY_MAGIC, SCHEMA_VERSION, TYPE_IDS[cls])]
+        self._encoders[cls](message, out)
+        context = tracing.context_of(message)
+        if context is not None:
+            out.append(_encode_trace(context))
+        return b"".join(out)
+
+    def decode(self, payload: bytes, default_type: Type = None) -> Message:
+        magic, version, type_id = _HEADER.unpack_from(payload)
+        if magic != BINARY_MAGIC or version != SCHEMA_VERSION:
+            raise CodecError(f"unsupported binary payload {magic:#x} v{version}")
+        if type_id not in TYPES_BY_ID:
+            raise CodecError(f"unknown message type id {type_id}")
+        message, offset = self._decoders[TYPES_BY_ID[type_id]](payload, _HEADER.size)
+        if len(payload) >= offset + _TRACE.size and payload[offset] == _TRACE_FLAG:
+            tracing.attach(message, _decode_trace(payload, offset))
+        return message
+
+    def _compile_encoder(self, cls):
+        fields = [(name, self._value_encoder(hint)) for name, hint in _fields(cls)]
+
+        def encode(message, out):
+            for name, enc in fields:
+                enc(getattr(message, name), out)
+
+        return encode
+
+    def _compile_decoder(self, cls):
+        fields = [(name, self._value_decoder(hint)) for name, hint in _fields(cls)]
+
+        def decode(payload, offset):
+            values = {}
+            for name, dec in fields:
+                values[name], offset = dec(payload, offset)
+            return cls(**values), offset
+
+        return decode
+
+    def _value_encoder(self, hint):
+        # pylint: disable=too-many-return-statements
+        if _is_optional(hint):
+            [inner] = [a for a in typing.get_args(hint) if a is not type(None)]
+            enc = self._value_encoder(inner)
+
+            def encode_optional(value, out):
+                if value is None:
+                    out.append(b"\x00")
+                else:
+                    out.append(b"\x01")
+                    enc(value, out)
+
+            return encode_optional
+        if _is_list(hint):
+            [item] = typing.get_args(hint)
+            enc = self._value_encoder(item)
+
+            def encode_list(value, out):
+                out.append(_U16.pack(len(value)))
+                for v in value:
+                    enc(v, out)
+
+            return encode_list
+        if hint is str:
+
+            def encode_str(value, out):
+                raw = value.encode()
+                out.append(_U16.pack(len(raw)))
+                out.append(raw)
+
+            return encode_str
+        if hint is int:
+            return lambda value, out: out.append(_I32.pack(value))
+        if hint is date:
+            return lambda value, out: out.append(_U32.pack(value.toordinal()))
+        if dataclasses.is_dataclass(hint):
+            return self._compile_encoder(hint)
+        raise CodecError(f"cannot encode {hint}")
+
+    def _value_decoder(self, hint):
+        # pylint: disable=too-many-return-statements
+        if _is_optional(hint):
+            [inner] = [a for a in typing.get_args(hint) if a is not type(None)]
+            dec = self._value_decoder(inner)
+
+            def decode_optional(payload, offset):
+                if payload[offset] == 0:
+                    return None, offset + 1
+                return dec(payload, offset + 1)
+
+            return decode_optional
+        if _is_list(hint):
+            [item] = typing.get_args(hint)
+            dec = self._value_decoder(item)
+
+            def decode_list(payload, offset):
+                [count] = _U16.unpack_from(payload, offset)
+                offset += _U16.size
+                values = []
+                for _ in range(count):
+                    value, offset = dec(payload, offset)
+                    values.append(value)
+                return values, offset
+
+            return decode_list
+        if hint is str:
+
+            def decode_str(payload, offset):
+                [length] = _U16.unpack_from(payload, offset)
+                start = offset + _U16.size
+                return payload[start : start + length].decode(), start + length
+
+            return decode_str
+        if hint is int:
+            return lambda payload, offset: (
+                _I32.unpack_from(payload, offset)[0],
+                offset + _I32.size,
+            )
+        if hint is date:
+            return lambda payload, offset: (
+                date.fromordinal(_U32.unpack_from(payload, offset)[0]),
+                offset + _U32.size,
+            )
+        if dataclasses.is_dataclass(hint):
+            return self._compile_decoder(hint)
+        raise CodecError(f"cannot decode {hint}")
+
+
+def _encode_trace(context: tracing.TraceContext) -> bytes:
+    optional = [context.causation_id, context.parent_span_id]
+    return _TRACE.pack(
+        _TRACE_FLAG,
+        bytes.fromhex(context.trace_id),
+        bytes.fromhex(context.message_id),
+        bytes.fromhex(context.correlation_id),
+        *[bytes.fromhex(value) if value else _NO_ID for value in optional],
+    )
+
+
+def _decode_trace(payload: bytes, offset: int) -> tracing.TraceContext:
+    _flag, trace_id, message_id, correlation_id, causation_id, parent_span_id = (
+        _TRACE.unpack_from(payload, offset)
+    )
+    return tracing.TraceContext(
+        trace_id=trace_id.hex(),
+        message_id=message_id.hex(),
+        correlation_id=correlation_id.hex(),
+        causation_id=causation_id.hex() if causation_id != _NO_ID else None,
+        parent_span_id=parent_span_id.hex() if parent_span_id != _NO_ID else None,
+    )
+
+
+CODECS = {
+    JsonCodec.name: JsonCodec(),
+    BinaryCodec.name: BinaryCodec(),
+}  # type: Dict[str, Union[JsonCodec, BinaryCodec]]
+
+
+def get_codec(name: str = None):
+    return CODECS[name or config.get_wire_format()]
+
+
+def decode(payload: bytes, default_type: Type = None) -> Message:
+    if payload[:1] == bytes([BINARY_MAGIC]):
+        return CODECS["binary"].decode(payload)
+    return CODECS["json"].decode(payload, default_type)
@@ -0,0 +1,200 @@
+# pylint: disable=protected-access
+from datetime import date
+from typing import Callable, Dict, List, Optional, Set, Tuple, Type
+from sqlalchemy import func, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+from allocation.adapters import codecs, orm
+from allocation.domain import events, model
+
+
+class ConcurrentAppend(Exception):
+    pass
+
+
+def _batch(product: model.Product, ref: str) -> model.Batch:
+    return next(b for b in product.batches if b.reference == ref)
+
+
+def _batch_created(product: model.Product, event: events.BatchCreated):
+    product.batches.append(model.Batch(event.ref, event.sku, event.qty, event.eta))
+
+
+def _quantity_changed(product: model.Product, event: events.BatchQuantityChanged):
+    _batch(product, event.ref)._purchased_quantity = event.qty
+
+
+def _allocated(product: model.Product, event: events.Allocated):
+    line = model.OrderLine(event.orderid, event.sku, event.qty)
+    _batch(product, event.batchref)._hold(line)
+
+
+def _deallocated(product: model.Product, event: events.Deallocated):
+    line = model.OrderLine(event.orderid, event.sku, event.qty)
+    for batch in product.batches:
+        if event.batchref in (None, batch.reference):
+            batch._allocations.discard(line)
+
+
+def _allocation_archived(product: model.Product, event: events.AllocationArchived):
+    batch = _batch(product, event.batchref)
+    batch._allocations.discard(model.OrderLine(event.orderid, event.sku, event.qty))
+    batch._archived_quantity += event.qty
+
+
+def _stock_split(product: model.Product, event: events.StockSplit):
+    product.buckets = (
+        [model.StockBucket(product.sku, i) for i in range(event.buckets)]
+        if event.buckets > 1
+        else []
+    )
+
+
+# only events that change a product's state are stored; replaying them in
+# order rebuilds it exactly (stock bucket quotas are rebalanced after loading)
+APPLY = {
+    events.BatchCreated: _batch_created,
+    events.BatchQuantityChanged: _quantity_changed,
+    events.Allocated: _allocated,
+    events.Deallocated: _deallocated,
+    events.AllocationArchived: _allocation_archived,
+    events.StockSplit: _stock_split,
+}  # type: Dict[Type[events.Event], Callable]
+
+
+def creation_events(product: model.Product) -> List[events.Event]:
+    history = []  # type: List[events.Event]
+    for batch in product.batches:
+        history.append(
+            events.BatchCreated(
+                product.sku, batch.reference, batch._purchased_quantity, batch.eta
+            )
+        )
+        history.extend(
+            events.Allocated(line.orderid, line.sku, line.qty, batch.reference)
+            for line in batch._allocations
+        )
+    if product.buckets:
+        history.append(events.StockSplit(product.sku, len(product.buckets)))
+    return history
+
+
+def snapshot(product: model.Product) -> Dict:
+    return dict(
+        buckets=len(product.buckets),
+        batches=[
+            dict(
+                ref=batch.reference,
+                qty=batch._purchased_quantity,
+                eta=batch.eta and batch.eta.isoformat(),
+                archived=batch._archived_quantity,
+                allocations=sorted(
+                    [line.orderid, line.qty] for line in batch._allocations
+                ),
+            )
+            for batch in product.batches
+        ],
+    )
+
+
+def restore(sku: str, state: Dict) -> model.Product:
+    product = model.Product(sku, [])
+    for data in state["batches"]:
+        eta = data["eta"] and date.fromisoformat(data["eta"])
+        batch = model.Batch(data["ref"], sku, data["qty"], eta)
+        batch._archived_quantity = data["archived"]
+        batch._allocations = {
+            model.OrderLine(orderid, sku, qty) for orderid, qty in data["allocations"]
+        }
+        product.batches.append(batch)
+    _stock_split(product, events.StockSplit(sku, state["buckets"]))
+    return product
+
+
+def load(session: Session, sku: str) -> Tuple[Optional[model.Product], int]:
+    snapshots, log = orm.product_snapshots.c, orm.product_events.c
+    latest = session.execute(
+        select(snapshots.version, snapshots.state).where(snapshots.sku == sku)
+    ).first()
+    version = latest.version if latest else 0
+    rows = session.execute(
+        select(log.version, log.data)
+        .where(log.sku == sku, log.version > version)
+        .order_by(log.version)
+    ).all()
+    if latest is None and not rows:
+        return None, 0
+    product = restore(sku, latest.state) if latest else model.Product(sku, [])
+    for row in rows:
+        event = codecs.decode(row.data.encode())
+        if not isinstance(event, events.Event):
+            raise codecs.CodecError(f"{sku} version {row.version} is not an event")
+        APPLY[type(event)](product, event)
+        version = row.version
+    product.rebalance_stock()
+    product.events = []
+    product.version_number = version
+    return product, version
+
+
+def append(
+    session: Session, sku: str, expected_version: int, new_events: List[events.Event]
+) -> int:
+    log = orm.product_events.c
+    current = session.execute(
+        select(func.max(log.version)).where(log.sku == sku)
+    ).scalar()
+    if (current or 0) != expected_version:
+        raise ConcurrentAppend(
+            f"{sku} is at version {current}, expected {expected_version}"
+        )
+    codec = codecs.get_codec("json")
+    rows = [
+        dict(
+            sku=sku,
+            version=expected_version + i,
+            type=type(event).__name__,
+            batchref=event.ref if isinstance(event, events.BatchCreated) else None,
+            data=codec.encode(event).decode(),
+        )
+        for i, event in enumerate(new_events, start=1)
+    ]
+    try:
+        session.execute(orm.product_events.insert(), rows)
+    except IntegrityError as e:
+        # someone else appended the same versions since we read the log
+        raise ConcurrentAppend(f"{sku} was changed concurrently") from e
+    return expected_version + len(new_events)
+
+
+def save_snapshot(session: Session, product: model.Product, version: int):
+    snapshots = orm.product_snapshots
+    session.execute(snapshots.delete().where(snapshots.c.sku == product.sku))
+    session.execute(
+        snapshots.insert(),
+        dict(sku=product.sku, version=version, state=snapshot(product)),
+    )
+
+
+def skus_with_batches_arrived_before(
+    session: Session, arrived_before: date
+) -> List[str]:
+    log = orm.product_events.c
+    rows = session.execute(
+        select(log.sku, log.data).where(log.type == events.BatchCreated.__name__)
+    )
+    skus = set()  # type: Set[str]
+    for sku, data in rows:
+        event = codecs.decode(data.encode())
+        if isinstance(event, events.BatchCreated) and (
+            event.eta is None or event.eta < arrived_before
+        ):
+            skus.add(sku)
+    return sorted(skus)
+
+
+def sku_for_batch(session: Session, batchref: str) -> Optional[str]:
+    log = orm.product_events.c
+    return session.execute(
+        select(log.sku).where(log.batchref == batchref).limit(1)
+    ).scalar()
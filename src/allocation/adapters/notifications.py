@@ -1,8 +1,17 @@
-# pylint: disable=too-few-public-methods
+# pylint: disable=too-few-public-methods, broad-except
 import abc
+import contextlib
+import logging
+import queue
 import smtplib
+import threading
+import time
+from collections import defaultdict
+from typing import Callable, Dict, Tuple
 from allocation import config
 
+logger = logging.getLogger(__name__)
+
 
 class AbstractNotifications(abc.ABC):
     @abc.abstractmethod
@@ -10,19 +19,170 @@ class AbstractNotifications(abc.ABC):
         raise NotImplementedError
 
 
+class NullNotifications(AbstractNotifications):
+    def send(self, destination, message):
+        pass
+
+
 DEFAULT_HOST = config.get_email_host_and_port()["host"]
 DEFAULT_PORT = config.get_email_host_and_port()["port"]
 
 
+class SMTPConnectionPool:
+    def __init__(
+        self,
+        smtp_host=DEFAULT_HOST,
+        port=DEFAULT_PORT,
+        size: int = 4,
+        connect: Callable = smtplib.SMTP,
+    ):
+        self.smtp_host = smtp_host
+        self.port = port
+        self.connect = connect
+        self._idle = queue.LifoQueue()  # type: queue.LifoQueue
+        self._slots = threading.BoundedSemaphore(size)
+
+    @contextlib.contextmanager
+    def connection(self):
+        with self._slots:
+            try:
+                server = self._idle.get_nowait()
+            except queue.Empty:
+                server = self.connect(self.smtp_host, port=self.port)
+            healthy = True
+            try:
+                yield server
+            except (smtplib.SMTPServerDisconnected, OSError):
+                healthy = False
+                raise
+            finally:
+                if healthy:
+                    self._idle.put(server)
+                else:
+                    self._discard(server)
+
+    def close(self):
+        while not self._idle.empty():
+            self._discard(self._idle.get_nowait())
+
+    @staticmethod
+    def _discard(server):
+        try:
+            server.close()
+        except Exception:
+            pass
+
+
 class EmailNotifications(AbstractNotifications):
-    def __init__(self, smtp_host=DEFAULT_HOST, port=DEFAULT_PORT):
-        self.server = smtplib.SMTP(smtp_host, port=port)
-        self.server.noop()
+    def __init__(self, smtp_host=DEFAULT_HOST, port=DEFAULT_PORT, pool=None):
+        self.pool = pool or SMTPConnectionPool(smtp_host, port)
 
     def send(self, destination, message):
         msg = f"Subject: allocation service notification\n{message}"
-        self.server.sendmail(
-            from_addr="allocations@example.com",
-            to_addrs=[destination],
-            msg=msg,
-        )
+        for attempt in range(2):
+            try:
+                with self.pool.connection() as server:
+                    server.sendmail(
+                        from_addr="allocations@example.com",
+                        to_addrs=[destination],
+                        msg=msg,
+                    )
+                return
+            except (smtplib.SMTPServerDisconnected, OSError):
+                if attempt:
+                    raise
+                logger.warning("SMTP connection lost, reconnecting")
+
+
+_STOP = object()
+
+
+class BackgroundNotifications(AbstractNotifications):
+    def __init__(
+        self,
+        notifications: AbstractNotifications,
+        debounce_seconds: float = 60,
+        queue_size: int = 1000,
+        workers: int = 4,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.notifications = notifications
+        self.debounce_seconds = debounce_seconds
+        self.clock = clock
+        self.suppressed = defaultdict(int)  # type: Dict[Tuple[str, str], int]
+        self._last_sent = {}  # type: Dict[Tuple[str, str], float]
+        self._lock = threading.Lock()
+        self._queue = queue.Queue(maxsize=queue_size)  # type: queue.Queue
+        self._check_seconds = min(debounce_seconds, 1)
+        self._threads = [
+            threading.Thread(
+                target=self._work, daemon=True, name=f"notifications-{i}"
+            )
+            for i in range(workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def send(self, destination, message):
+        key = (destination, message)
+        now = self.clock()
+        with self._lock:
+            last_sent = self._last_sent.get(key)
+            if last_sent is not None and now - last_sent < self.debounce_seconds:
+                self.suppressed[key] += 1
+                return
+            self._last_sent[key] = now
+            self._enqueue(destination, message, self.suppressed.pop(key, 0))
+
+    def flush_expired(self):
+        # repeats held back during a window are reported when it closes, even if
+        # the notification never comes up again
+        now = self.clock()
+        with self._lock:
+            for key, sent in list(self._last_sent.items()):
+                if now - sent < self.debounce_seconds:
+                    continue
+                repeats = self.suppressed.pop(key, 0)
+                if repeats:
+                    self._last_sent[key] = now
+                    self._enqueue(*key, repeats)
+                else:
+                    del self._last_sent[key]
+
+    def flush(self):
+        self._queue.join()
+
+    def close(self):
+        for _ in self._threads:
+            self._queue.put(_STOP)
+        for thread in self._threads:
+            thread.join()
+
+    def _enqueue(self, destination, message, repeats):
+        if repeats:
+            message = f"{message}\n({repeats} similar notifications suppressed)"
+        try:
+            self._queue.put_nowait((destination, message))
+        except queue.Full:
+            logger.error("notification queue full, dropping %r", message)
+
+    def _work(self):
+        next_check = time.monotonic() + self._check_seconds
+        while True:
+            try:
+                item = self._queue.get(timeout=self._check_seconds)
+            except queue.Empty:
+                item = None
+            if time.monotonic() >= next_check:
+                self.flush_expired()
+                next_check = time.monotonic() + self._check_seconds
+            if item is None:
+                continue
+            try:
+                if item is _STOP:
+                    return
+                self.notifications.send(*item)
+            except Exception:
+                logger.exception("failed sending notification %s", item)
+            finally:
+                self._queue.task_done()
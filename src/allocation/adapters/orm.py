@@ -6,7 +6,10 @@ from sqlalchemy import (
     Integer,
     String,
     Date,
+    DateTime,
     ForeignKey,
+    JSON,
+    Text,
     event,
 )
 from sqlalchemy.orm import mapper, relationship
@@ -40,9 +43,19 @@ batches = Table(
     Column("reference", String(255)),
     Column("sku", ForeignKey("products.sku")),
     Column("_purchased_quantity", Integer, nullable=False),
+    Column("_archived_quantity", Integer, nullable=False, server_default="0"),
     Column("eta", Date, nullable=True),
 )
 
+stock_buckets = Table(
+    "stock_buckets",
+    metadata,
+    Column("sku", ForeignKey("products.sku"), primary_key=True),
+    Column("position", Integer, primary_key=True),
+    Column("version_number", Integer, nullable=False, server_default="0"),
+    Column("quotas", JSON, nullable=False),
+)
+
 allocations = Table(
     "allocations",
     metadata,
@@ -51,6 +64,50 @@ allocations = Table(
     Column("batch_id", ForeignKey("batches.id")),
 )
 
+archived_allocations = Table(
+    "archived_allocations",
+    metadata,
+    Column("id", Integer, primary_key=True, autoincrement=True),
+    Column("orderid", String(255)),
+    Column("sku", String(255)),
+    Column("qty", Integer, nullable=False),
+    Column("batchref", String(255)),
+    Column("archived_on", Date, nullable=False),
+)
+
+batch_directory = Table(
+    "batch_directory",
+    metadata,
+    Column("batchref", String(255), primary_key=True),
+    Column("shard", Integer, nullable=False),
+)
+
+product_events = Table(
+    "product_events",
+    metadata,
+    Column("sku", String(255), primary_key=True),
+    Column("version", Integer, primary_key=True),
+    Column("type", String(255), nullable=False),
+    Column("batchref", String(255), nullable=True, index=True),
+    Column("data", Text, nullable=False),
+)
+
+product_snapshots = Table(
+    "product_snapshots",
+    metadata,
+    Column("sku", String(255), primary_key=True),
+    Column("version", Integer, nullable=False),
+    Column("state", JSON, nullable=False),
+)
+
+idempotency_keys = Table(
+    "idempotency_keys",
+    metadata,
+    Column("key", String(255), primary_key=True),
+    Column("outcome", JSON, nullable=True),
+    Column("created_at", DateTime, nullable=False, index=True),
+)
+
 allocations_view = Table(
     "allocations_view",
     metadata,
@@ -71,13 +128,26 @@ def start_mappers():
                 lines_mapper,
                 secondary=allocations,
                 collection_class=set,
+                lazy="selectin",
             )
         },
     )
+    # no version_id_col: two writers of one bucket are caught by REPEATABLE READ
+    # refusing the second update of its row, which the unit of work's
+    # sessions rely on; allocations to different buckets do not conflict
+    buckets_mapper = mapper(model.StockBucket, stock_buckets)
     mapper(
         model.Product,
         products,
-        properties={"batches": relationship(batches_mapper)},
+        properties={
+            "batches": relationship(batches_mapper, lazy="selectin"),
+            "buckets": relationship(
+                buckets_mapper,
+                lazy="selectin",
+                order_by=stock_buckets.c.position,
+                cascade="all, delete-orphan",
+            ),
+        },
     )
 
 
@@ -1,16 +1,79 @@
-import json
+# pylint: disable=broad-except
+import contextlib
 import logging
-from dataclasses import asdict
+import threading
+import time
+from typing import List, Tuple
 import redis
 
 from allocation import config
+from allocation.adapters import codecs
 from allocation.domain import events
 
 logger = logging.getLogger(__name__)
 
-r = redis.Redis(**config.get_redis_host_and_port())
 
+class RedisEventPublisher:
+    def __init__(
+        self,
+        client: redis.Redis = None,
+        codec=None,
+        retries: int = 3,
+        backoff: float = 0.05,
+    ):
+        if client is None:
+            client = redis.Redis(
+                connection_pool=redis.ConnectionPool(
+                    **config.get_redis_host_and_port(),
+                    max_connections=config.get_redis_max_connections(),
+                )
+            )
+        self.client = client
+        self.codec = codec or codecs.get_codec()
+        self.retries = retries
+        self.backoff = backoff
+        self._local = threading.local()
 
-def publish(channel, event: events.Event):
-    logging.info("publishing: channel=%s, event=%s", channel, event)
-    r.publish(channel, json.dumps(asdict(event)))
+    def __call__(self, channel, event: events.Event):
+        logger.info("publishing: channel=%s, event=%s", channel, event)
+        buffer = getattr(self._local, "buffer", None)
+        if buffer is None:
+            self.send([(channel, event)])
+        else:
+            buffer.append((channel, event))
+
+    @contextlib.contextmanager
+    def buffered(self):
+        if getattr(self._local, "buffer", None) is not None:
+            yield
+            return
+        self._local.buffer = []
+        try:
+            yield
+        finally:
+            buffer, self._local.buffer = self._local.buffer, None
+            if buffer:
+                try:
+                    self.send(buffer)
+                except Exception:
+                    logger.exception("could not publish %d events", len(buffer))
+
+    def send(self, messages: List[Tuple[str, events.Event]]):
+        payloads = [
+            (channel, self.codec.encode(event)) for channel, event in messages
+        ]
+        for attempt in range(self.retries + 1):
+            try:
+                pipe = self.client.pipeline(transaction=False)
+                for channel, payload in payloads:
+                    pipe.publish(channel, payload)
+                pipe.execute()
+                return
+            except (redis.ConnectionError, redis.TimeoutError):
+                if attempt == self.retries:
+                    raise
+                logger.warning("publish failed, retrying %d events", len(payloads))
+                time.sleep(self.backoff * 2**attempt)
+
+
+publish = RedisEventPublisher()
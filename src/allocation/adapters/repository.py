@@ -1,7 +1,26 @@
 import abc
-from typing import Set
-from allocation.adapters import orm
-from allocation.domain import model
+from datetime import date
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+from sqlalchemy import event, inspect, lambda_stmt, select
+from allocation.adapters import event_store, orm
+from allocation.adapters.sharding import CrossShardRequest, ShardRouter
+from allocation.domain import events, model
+
+
+def insert_archived(session, archived: List[Tuple[str, model.OrderLine]]):
+    session.execute(
+        orm.archived_allocations.insert(),
+        [
+            dict(
+                orderid=line.orderid,
+                sku=line.sku,
+                qty=line.qty,
+                batchref=batchref,
+                archived_on=date.today(),
+            )
+            for batchref, line in archived
+        ],
+    )
 
 
 class AbstractRepository(abc.ABC):
@@ -24,6 +43,28 @@ class AbstractRepository(abc.ABC):
             self.seen.add(product)
         return product
 
+    def archive(self, archived: List[Tuple[str, model.OrderLine]]):
+        pass
+
+    # called by the unit of work around its own commit, rollback and close, for
+    # repositories that hold changes or sessions of their own
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+    @abc.abstractmethod
+    def exists(self, sku) -> bool:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def skus(self) -> Iterable[str]:
+        raise NotImplementedError
+
     @abc.abstractmethod
     def _add(self, product: model.Product):
         raise NotImplementedError
@@ -42,18 +83,183 @@ class SqlAlchemyRepository(AbstractRepository):
         super().__init__()
         self.session = session
 
+    # lambda statements are built and compiled once per call site and later calls
+    # only bind new parameters; ORM ones are keyed on the mapper, which tests
+    # recreate
+    def exists(self, sku):
+        stmt = lambda_stmt(
+            lambda: select(orm.products.c.sku)
+            .where(orm.products.c.sku == sku)
+            .limit(1)
+        )
+        return self.session.execute(stmt).first() is not None
+
+    def skus(self):
+        stmt = lambda_stmt(lambda: select(orm.products.c.sku))
+        return [sku for sku, in self.session.execute(stmt)]
+
     def _add(self, product):
         self.session.add(product)
 
     def _get(self, sku):
-        return self.session.query(model.Product).filter_by(sku=sku).first()
+        stmt = lambda_stmt(
+            lambda: select(model.Product).where(orm.products.c.sku == sku).limit(1),
+            track_on=[inspect(model.Product)],
+        )
+        return self.session.execute(stmt).scalars().first()
 
     def _get_by_batchref(self, batchref):
-        return (
-            self.session.query(model.Product)
+        stmt = lambda_stmt(
+            lambda: select(model.Product)
             .join(model.Batch)
-            .filter(
-                orm.batches.c.reference == batchref,
+            .where(orm.batches.c.reference == batchref)
+            .limit(1),
+            track_on=[inspect(model.Product)],
+        )
+        return self.session.execute(stmt).scalars().first()
+
+    def archive(self, archived):
+        insert_archived(self.session, archived)
+        for _batchref, line in archived:
+            self.session.delete(line)
+
+
+class ShardedRepository(SqlAlchemyRepository):
+    def __init__(self, router: ShardRouter, directory):
+        super().__init__(session=None)
+        self.router = router
+        self.directory = directory
+        self.shard = None  # type: Optional[int]
+        self.new_batchrefs = set()  # type: Set[str]
+
+    def pin(self, shard: int):
+        if self.shard is None:
+            self.shard = shard
+            self.session = self.router.session(shard)
+            event.listen(self.session, "before_flush", self._track_new_batches)
+        elif shard != self.shard:
+            raise CrossShardRequest(
+                f"unit of work is pinned to shard {self.shard}, not {shard}"
             )
-            .first()
+
+    def _track_new_batches(self, session, *_):
+        self.new_batchrefs.update(
+            obj.reference for obj in session.new if isinstance(obj, model.Batch)
+        )
+
+    def exists(self, sku):
+        self.pin(self.router.shard_for(sku))
+        return super().exists(sku)
+
+    def skus(self):
+        return [
+            sku
+            for session in self.router.each_shard()
+            for sku, in session.execute(select(orm.products.c.sku))
+        ]
+
+    def _add(self, product):
+        self.pin(self.router.shard_for(product.sku))
+        super()._add(product)
+
+    def _get(self, sku):
+        self.pin(self.router.shard_for(sku))
+        return super()._get(sku)
+
+    def _get_by_batchref(self, batchref):
+        shard = self.router.lookup_batch(self.directory, batchref)
+        if shard is None:
+            return None
+        self.pin(shard)
+        return super()._get_by_batchref(batchref)
+
+    def commit(self):
+        if self.shard is None:
+            return
+        self.session.flush()
+        self.router.register_batches(self.directory, self.shard, self.new_batchrefs)
+        self.directory.commit()
+        self.session.commit()
+        self.new_batchrefs.clear()
+
+    def rollback(self):
+        if self.session is not None:
+            self.session.rollback()
+        self.new_batchrefs.clear()
+
+    def close(self):
+        if self.session is not None:
+            self.session.close()
+
+
+class EventSourcedRepository(AbstractRepository):
+    def __init__(self, session, snapshot_every: int = 100):
+        super().__init__()
+        self.session = session
+        self.snapshot_every = snapshot_every
+        self.products = {}  # type: Dict[str, model.Product]
+        self.versions = {}  # type: Dict[str, int]
+        self.unsaved = {}  # type: Dict[str, List[events.Event]]
+        self.saved_events = {}  # type: Dict[str, int]
+
+    def exists(self, sku):
+        return sku in self.products or sku in self._stored_skus(sku)
+
+    def skus(self):
+        return sorted(set(self._stored_skus()) | set(self.products))
+
+    def _stored_skus(self, sku=None) -> List[str]:
+        query = select(orm.product_events.c.sku).distinct()
+        if sku is not None:
+            query = query.where(orm.product_events.c.sku == sku)
+        return [s for s, in self.session.execute(query)]
+
+    def _add(self, product):
+        self._track(product, version=0)
+        self.unsaved[product.sku] = event_store.creation_events(product)
+
+    def _get(self, sku):
+        if sku not in self.products:
+            product, version = event_store.load(self.session, sku)
+            if product is None:
+                return None
+            self._track(product, version)
+        return self.products[sku]
+
+    def _get_by_batchref(self, batchref):
+        for product in self.products.values():
+            if any(b.reference == batchref for b in product.batches):
+                return product
+        sku = event_store.sku_for_batch(self.session, batchref)
+        return sku and self._get(sku)
+
+    def archive(self, archived):
+        # the lines leave the product through its AllocationArchived events
+        insert_archived(self.session, archived)
+
+    def _track(self, product: model.Product, version: int):
+        self.products[product.sku] = product
+        self.versions[product.sku] = version
+        self.saved_events[product.sku] = len(product.events)
+        self.unsaved[product.sku] = []
+
+    def commit(self):
+        for sku, product in self.products.items():
+            new_events = [
+                e
+                for e in self.unsaved[sku] + product.events[self.saved_events[sku] :]
+                if type(e) in event_store.APPLY
+            ]
+            if new_events:
+                self._append(product, new_events)
+            self.unsaved[sku] = []
+            self.saved_events[sku] = len(product.events)
+
+    def _append(self, product: model.Product, new_events: List[events.Event]):
+        old_version = self.versions[product.sku]
+        version = event_store.append(
+            self.session, product.sku, old_version, new_events
         )
+        if version // self.snapshot_every > old_version // self.snapshot_every:
+            event_store.save_snapshot(self.session, product, version)
+        self.versions[product.sku] = product.version_number = version
@@ -0,0 +1,56 @@
+import contextlib
+import zlib
+from typing import Iterable, Iterator, Optional, Sequence
+from sqlalchemy import select
+from sqlalchemy.orm import Session, sessionmaker
+
+from allocation.adapters import orm
+
+
+class CrossShardRequest(Exception):
+    pass
+
+
+def shard_for(sku: str, shard_count: int) -> int:
+    return zlib.crc32(sku.encode()) % shard_count
+
+
+class ShardRouter:
+    def __init__(self, shards: Sequence[sessionmaker]):
+        if not shards:
+            raise ValueError("at least one shard is required")
+        self.shards = list(shards)
+
+    def shard_for(self, sku: str) -> int:
+        return shard_for(sku, len(self.shards))
+
+    def session(self, shard: int) -> Session:
+        return self.shards[shard]()
+
+    def each_shard(self) -> Iterator[Session]:
+        for shard in range(len(self.shards)):
+            with contextlib.closing(self.session(shard)) as session:
+                yield session
+
+    @staticmethod
+    def lookup_batch(directory: Session, batchref: str) -> Optional[int]:
+        return directory.execute(
+            select(orm.batch_directory.c.shard).where(
+                orm.batch_directory.c.batchref == batchref
+            )
+        ).scalar()
+
+    @staticmethod
+    def register_batches(directory: Session, shard: int, batchrefs: Iterable[str]):
+        batchrefs = list(batchrefs)
+        if not batchrefs:
+            return
+        directory.execute(
+            orm.batch_directory.delete().where(
+                orm.batch_directory.c.batchref.in_(batchrefs)
+            )
+        )
+        directory.execute(
+            orm.batch_directory.insert(),
+            [dict(batchref=ref, shard=shard) for ref in batchrefs],
+        )
@@ -0,0 +1,179 @@
+import contextlib
+import contextvars
+import logging
+import threading
+import time
+import warnings
+from collections import Counter, defaultdict
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterator, Optional
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.engine.cursor import CursorFetchStrategy
+
+from allocation import config
+
+logger = logging.getLogger(__name__)
+
+_current_profile = contextvars.ContextVar(
+    "current_profile", default=None
+)  # type: contextvars.ContextVar[Optional[UowProfile]]
+
+
+class SqlBudgetWarning(UserWarning):
+    pass
+
+
+class SqlBudgetExceeded(Exception):
+    pass
+
+
+@dataclass
+class UowProfile:
+    message: Any = None
+    profiler: Any = field(default=None, repr=False)
+    statements: int = 0
+    db_time: float = 0.0
+    rows: int = 0
+    shapes: Counter = field(default_factory=Counter)
+    violations: list = field(default_factory=list)
+
+
+@dataclass
+class MessageStats:
+    uows: int = 0
+    statements: int = 0
+    db_time: float = 0.0
+    rows: int = 0
+
+
+class SqlProfiler:
+    def __init__(
+        self,
+        statement_budget: int = None,
+        repeat_threshold: int = None,
+        strict: bool = False,
+    ):
+        self.statement_budget = statement_budget
+        self.repeat_threshold = repeat_threshold
+        self.strict = strict
+        self.stats = defaultdict(MessageStats)  # type: Dict[str, MessageStats]
+        self._lock = threading.Lock()
+        _install_listeners()
+
+    @contextlib.contextmanager
+    def profile(self, message: Any = None) -> Iterator[UowProfile]:
+        profile = UowProfile(message=message, profiler=self)
+        token = _current_profile.set(profile)
+        try:
+            yield profile
+        finally:
+            _current_profile.reset(token)
+            self._record(profile)
+
+    def check(self, profile: UowProfile, statement: str):
+        if self.statement_budget is not None and profile.statements == (
+            self.statement_budget + 1
+        ):
+            self._violation(
+                profile,
+                f"{profile.statements} statements, over the budget of "
+                f"{self.statement_budget}",
+            )
+        if self.repeat_threshold is not None and profile.shapes[statement] == (
+            self.repeat_threshold + 1
+        ):
+            self._violation(
+                profile,
+                f"same query ran {profile.shapes[statement]} times, "
+                f"possible N+1: {statement}",
+            )
+
+    def _violation(self, profile: UowProfile, problem: str):
+        description = f"handling {profile.message!r}: {problem}"
+        profile.violations.append(description)
+        if self.strict:
+            raise SqlBudgetExceeded(description)
+        warnings.warn(description, SqlBudgetWarning, stacklevel=2)
+
+    def _record(self, profile: UowProfile):
+        key = type(profile.message).__name__ if profile.message else "<none>"
+        with self._lock:
+            stats = self.stats[key]
+            stats.uows += 1
+            stats.statements += profile.statements
+            stats.db_time += profile.db_time
+            stats.rows += profile.rows
+        logger.debug(
+            "%s: %d statements, %.1fms, %d rows",
+            key,
+            profile.statements,
+            profile.db_time * 1000,
+            profile.rows,
+        )
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    profile = _current_profile.get()
+    if profile is None:
+        return
+    profile.statements += 1
+    profile.shapes[statement] += 1
+    conn.info.setdefault("query_start", []).append(time.perf_counter())
+    profile.profiler.check(profile, statement)
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    profile = _current_profile.get()
+    if profile is None or not conn.info.get("query_start"):
+        return
+    profile.db_time += time.perf_counter() - conn.info["query_start"].pop()
+    # cursor.rowcount is -1 for SELECTs on many drivers, so rows are counted as
+    # they are fetched instead
+    if (
+        context is not None
+        and type(context.cursor_fetch_strategy) is CursorFetchStrategy
+        and not context.execution_options.get("stream_results")
+    ):
+        context.cursor_fetch_strategy = _CountingFetchStrategy(profile)
+
+
+class _CountingFetchStrategy(CursorFetchStrategy):
+    __slots__ = ("profile",)
+
+    def __init__(self, profile: UowProfile):
+        self.profile = profile
+
+    def fetchone(self, result, dbapi_cursor, hard_close=False):
+        row = super().fetchone(result, dbapi_cursor, hard_close)
+        if row is not None:
+            self.profile.rows += 1
+        return row
+
+    def fetchmany(self, result, dbapi_cursor, size=None):
+        rows = super().fetchmany(result, dbapi_cursor, size)
+        self.profile.rows += len(rows or ())
+        return rows
+
+    def fetchall(self, result, dbapi_cursor):
+        rows = super().fetchall(result, dbapi_cursor)
+        self.profile.rows += len(rows or ())
+        return rows
+
+
+_installed = False
+
+
+def _install_listeners():
+    global _installed  # pylint: disable=global-statement
+    if not _installed:
+        event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
+        _installed = True
+
+
+def profiler_from_config() -> Optional[SqlProfiler]:
+    settings = config.get_sql_profiling_settings()
+    if not settings.pop("enabled"):
+        return None
+    return SqlProfiler(**settings)
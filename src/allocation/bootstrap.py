@@ -1,11 +1,19 @@
+import contextlib
+import functools
 import inspect
 from typing import Callable
+from allocation import config
 from allocation.adapters import orm, redis_eventpublisher
 from allocation.adapters.notifications import (
     AbstractNotifications,
+    BackgroundNotifications,
     EmailNotifications,
+    SMTPConnectionPool,
 )
+from allocation.domain.policies import PolicyRegistry
 from allocation.service_layer import handlers, messagebus, unit_of_work
+from allocation.service_layer.idempotency import IdempotencyStore
+from allocation.service_layer.stock_hints import StockHints
 
 
 def bootstrap(
@@ -13,22 +21,43 @@ def bootstrap(
     uow: unit_of_work.AbstractUnitOfWork = unit_of_work.SqlAlchemyUnitOfWork(),
     notifications: AbstractNotifications = None,
     publish: Callable = redis_eventpublisher.publish,
+    policies: PolicyRegistry = None,
+    hints: StockHints = None,
+    idempotency: IdempotencyStore = None,
 ) -> messagebus.MessageBus:
 
     if notifications is None:
-        notifications = EmailNotifications()
+        notifications = default_notifications()
+
+    if policies is None:
+        policies = PolicyRegistry(**config.get_allocation_policy_settings())
+
+    if hints is None:
+        hints = default_stock_hints()
+
+    if idempotency is None:
+        idempotency = default_idempotency_store(uow)
 
     if start_orm:
         orm.start_mappers()
 
-    dependencies = {"uow": uow, "notifications": notifications, "publish": publish}
+    dependencies = {
+        "uow": uow,
+        "notifications": notifications,
+        "publish": publish,
+        "policies": policies,
+        "hints": hints,
+    }
     injected_event_handlers = {
         event_type: [
-            inject_dependencies(handler, dependencies)
-            for handler in event_handlers
+            inject_dependencies(handler, dependencies) for handler in event_handlers
         ]
         for event_type, event_handlers in handlers.EVENT_HANDLERS.items()
     }
+    injected_batched_event_handlers = [
+        (event_types, inject_dependencies(handler, dependencies))
+        for event_types, handler in handlers.BATCHED_EVENT_HANDLERS
+    ]
     injected_command_handlers = {
         command_type: inject_dependencies(handler, dependencies)
         for command_type, handler in handlers.COMMAND_HANDLERS.items()
@@ -38,9 +67,31 @@ def bootstrap(
         uow=uow,
         event_handlers=injected_event_handlers,
         command_handlers=injected_command_handlers,
+        publish_buffer=getattr(publish, "buffered", contextlib.nullcontext),
+        idempotency=idempotency,
+        batched_event_handlers=injected_batched_event_handlers,
     )
 
 
+def default_notifications() -> AbstractNotifications:
+    settings = config.get_notification_settings()
+    pool = SMTPConnectionPool(size=settings["workers"])
+    return BackgroundNotifications(EmailNotifications(pool=pool), **settings)
+
+
+def default_stock_hints() -> StockHints:
+    return StockHints(**config.get_stock_hint_settings())
+
+
+def default_idempotency_store(
+    uow: unit_of_work.AbstractUnitOfWork,
+) -> IdempotencyStore:
+    session_factory = None
+    if isinstance(uow, unit_of_work.SqlAlchemyUnitOfWork):
+        session_factory = uow.session_factory
+    return IdempotencyStore(session_factory, **config.get_idempotency_settings())
+
+
 def inject_dependencies(handler, dependencies):
     params = inspect.signature(handler).parameters
     deps = {
@@ -48,4 +99,4 @@ def inject_dependencies(handler, dependencies):
         for name, dependency in dependencies.items()
         if name in params
     }
-    return lambda message: handler(message, **deps)
+    return functools.partial(handler, **deps)
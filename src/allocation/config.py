@@ -1,26 +1,185 @@
 import os
+import socket
 
 
-def get_postgres_uri():
-    host = os.environ.get("DB_HOST", "localhost")
+def get_postgres_uri(host=None):
+    host = host or os.environ.get("DB_HOST", "localhost")
     port = 54321 if host == "localhost" else 5432
     password = os.environ.get("DB_PASSWORD", "abc123")
     user, db_name = "allocation", "allocation"
     return f"postgresql://{user}:{password}@{host}:{port}/{db_name}"
 
 
+def get_db_pool_options():
+    return dict(
+        pool_size=int(os.environ.get("DB_POOL_SIZE", 5)),
+        max_overflow=int(os.environ.get("DB_MAX_OVERFLOW", 10)),
+    )
+
+
+def get_replica_uri():
+    return get_postgres_uri(os.environ.get("DB_REPLICA_HOST"))
+
+
+def get_read_pool_options():
+    return dict(
+        pool_size=int(os.environ.get("DB_READ_POOL_SIZE", 5)),
+        max_overflow=int(os.environ.get("DB_READ_MAX_OVERFLOW", 10)),
+    )
+
+
+def get_replica_lag_settings():
+    max_lag = os.environ.get("REPLICA_MAX_LAG_SECONDS")
+    return dict(
+        max_lag_seconds=float(max_lag) if max_lag else None,
+        lag_check_seconds=float(os.environ.get("REPLICA_LAG_CHECK_SECONDS", 1)),
+    )
+
+
+def get_shard_uris():
+    uris = os.environ.get("DB_SHARD_URIS", "")
+    return [uri.strip() for uri in uris.split(",") if uri.strip()]
+
+
+def get_event_sourcing_settings():
+    return dict(
+        event_sourced=os.environ.get("PRODUCT_STORE", "tables") == "events",
+        snapshot_every=int(os.environ.get("EVENT_SNAPSHOT_EVERY", 100)),
+    )
+
+
+def get_sql_profiling_settings():
+    budget = os.environ.get("SQL_STATEMENT_BUDGET")
+    repeats = os.environ.get("SQL_REPEAT_THRESHOLD")
+    return dict(
+        enabled=os.environ.get("SQL_PROFILING", "0") == "1",
+        statement_budget=int(budget) if budget else None,
+        repeat_threshold=int(repeats) if repeats else None,
+        strict=os.environ.get("SQL_PROFILING_STRICT", "0") == "1",
+    )
+
+
+def get_trace_export_path():
+    return os.environ.get("TRACE_EXPORT_PATH")
+
+
+def get_allocation_policy_settings():
+    overrides = os.environ.get("ALLOCATION_POLICY_OVERRIDES", "")
+    return dict(
+        default=os.environ.get("ALLOCATION_POLICY", "earliest_eta"),
+        overrides=dict(
+            item.strip().split("=", 1)
+            for item in overrides.split(",")
+            if item.strip()
+        ),
+    )
+
+
+def get_stock_hint_settings():
+    return dict(
+        refresh_seconds=float(os.environ.get("KNOWN_SKUS_REFRESH_SECONDS", 60)),
+        ttl_seconds=float(os.environ.get("STOCK_HINT_TTL_SECONDS", 0)),
+    )
+
+
+def get_archive_after_days():
+    return int(os.environ.get("ARCHIVE_AFTER_DAYS", 30))
+
+
 def get_api_url():
     host = os.environ.get("API_HOST", "localhost")
     port = 5005 if host == "localhost" else 80
     return f"http://{host}:{port}"
 
 
+def get_async_api_url():
+    host = os.environ.get("ASYNC_API_HOST", "localhost")
+    port = 5006 if host == "localhost" else 80
+    return f"http://{host}:{port}"
+
+
+def get_asgi_max_workers():
+    return int(os.environ.get("ASGI_MAX_WORKERS", 100))
+
+
+def get_admission_settings():
+    target_latency = os.environ.get("ADMISSION_TARGET_LATENCY_SECONDS")
+    return dict(
+        limit=int(os.environ.get("ADMISSION_LIMIT", 16)),
+        queue_size=int(os.environ.get("ADMISSION_QUEUE_SIZE", 64)),
+        queue_timeout=float(os.environ.get("ADMISSION_QUEUE_TIMEOUT_SECONDS", 1)),
+        target_latency=float(target_latency) if target_latency else None,
+    )
+
+
+def get_consumer_admission_settings():
+    # a consumer process never has more than its workers' commands in flight
+    settings = get_admission_settings()
+    settings["limit"] = int(
+        os.environ.get(
+            "REDIS_ADMISSION_LIMIT", get_redis_consumer_settings()["workers"]
+        )
+    )
+    return settings
+
+
+def get_idempotency_settings():
+    return dict(
+        ttl_seconds=float(os.environ.get("IDEMPOTENCY_TTL_SECONDS", 86400)),
+        cache_size=int(os.environ.get("IDEMPOTENCY_CACHE_SIZE", 10000)),
+    )
+
+
+def get_group_commit_settings():
+    return dict(
+        window_seconds=float(os.environ.get("GROUP_COMMIT_WINDOW_MS", 0)) / 1000,
+        max_batch=int(os.environ.get("GROUP_COMMIT_MAX_BATCH", 100)),
+    )
+
+
 def get_redis_host_and_port():
     host = os.environ.get("REDIS_HOST", "localhost")
     port = 63791 if host == "localhost" else 6379
     return dict(host=host, port=port)
 
 
+def get_wire_format():
+    return os.environ.get("WIRE_FORMAT", "json")
+
+
+def get_redis_max_connections():
+    return int(os.environ.get("REDIS_MAX_CONNECTIONS", 50))
+
+
+def get_redis_consumer_settings():
+    return dict(
+        consumer=os.environ.get(
+            "REDIS_CONSUMER_NAME", f"{socket.gethostname()}-{os.getpid()}"
+        ),
+        workers=int(os.environ.get("REDIS_WORKERS", 4)),
+        queue_size=int(os.environ.get("REDIS_WORKER_QUEUE_SIZE", 100)),
+        batch_size=int(os.environ.get("REDIS_BATCH_SIZE", 100)),
+        max_queued=int(os.environ.get("REDIS_MAX_QUEUED", 100)),
+        block_ms=int(os.environ.get("REDIS_BLOCK_MS", 1000)),
+        min_idle_ms=int(os.environ.get("REDIS_MIN_IDLE_MS", 30000)),
+        max_deliveries=int(os.environ.get("REDIS_MAX_DELIVERIES", 5)),
+        retry_ms=int(os.environ.get("REDIS_RETRY_MS", 100)),
+        coalesce_ms=int(os.environ.get("REDIS_COALESCE_MS", 0)),
+    )
+
+
+def get_redis_consumer_processes():
+    return int(os.environ.get("REDIS_CONSUMER_PROCESSES", os.cpu_count() or 1))
+
+
+def get_notification_settings():
+    return dict(
+        debounce_seconds=float(os.environ.get("NOTIFICATION_DEBOUNCE_SECONDS", 60)),
+        queue_size=int(os.environ.get("NOTIFICATION_QUEUE_SIZE", 1000)),
+        workers=int(os.environ.get("NOTIFICATION_WORKERS", 4)),
+    )
+
+
 def get_email_host_and_port():
     host = os.environ.get("EMAIL_HOST", "localhost")
     port = 11025 if host == "localhost" else 1025
@@ -1,6 +1,6 @@
 # pylint: disable=too-few-public-methods
 from datetime import date
-from typing import Optional
+from typing import List, Optional
 from dataclasses import dataclass
 
 
@@ -13,6 +13,7 @@ class Allocate(Command):
     orderid: str
     sku: str
     qty: int
+    idempotency_key: Optional[str] = None
 
 
 @dataclass
@@ -27,3 +28,21 @@ class CreateBatch(Command):
 class ChangeBatchQuantity(Command):
     ref: str
     qty: int
+    idempotency_key: Optional[str] = None
+
+
+@dataclass
+class BulkAllocate(Command):
+    lines: List[Allocate]
+
+
+@dataclass
+class ArchiveConsumedBatches(Command):
+    sku: str
+    arrived_before: date
+
+
+@dataclass
+class SplitStock(Command):
+    sku: str
+    buckets: int
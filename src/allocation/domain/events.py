@@ -1,5 +1,7 @@
 # pylint: disable=too-few-public-methods
 from dataclasses import dataclass
+from datetime import date
+from typing import Optional
 
 
 class Event:
@@ -19,8 +21,38 @@ class Deallocated(Event):
     orderid: str
     sku: str
     qty: int
+    batchref: Optional[str] = None
+
+
+@dataclass
+class AllocationArchived(Event):
+    orderid: str
+    sku: str
+    qty: int
+    batchref: str
 
 
 @dataclass
 class OutOfStock(Event):
     sku: str
+
+
+@dataclass
+class BatchCreated(Event):
+    sku: str
+    ref: str
+    qty: int
+    eta: Optional[date] = None
+
+
+@dataclass
+class BatchQuantityChanged(Event):
+    sku: str
+    ref: str
+    qty: int
+
+
+@dataclass
+class StockSplit(Event):
+    sku: str
+    buckets: int
@@ -1,41 +1,203 @@
 from __future__ import annotations
+import zlib
 from dataclasses import dataclass
 from datetime import date
-from typing import Optional, List, Set
-from . import commands, events
+from typing import Callable, Dict, Optional, List, Set, Tuple
+from . import commands, events, policies
 
 
 class Product:
-    def __init__(self, sku: str, batches: List[Batch], version_number: int = 0):
+    def __init__(
+        self,
+        sku: str,
+        batches: List[Batch],
+        version_number: int = 0,
+        buckets: List[StockBucket] = None,
+    ):
         self.sku = sku
         self.batches = batches
         self.version_number = version_number
+        self.buckets = buckets or []
         self.events = []  # type: List[events.Event]
 
-    def allocate(self, line: OrderLine) -> str:
-        try:
-            batch = next(b for b in sorted(self.batches) if b.can_allocate(line))
-            batch.allocate(line)
-            self.version_number += 1
+    def allocate(
+        self,
+        line: OrderLine,
+        policy: policies.AllocationPolicy = None,
+        evicted: bool = False,
+    ) -> str:
+        # an evicted part of a split line may land next to another part of it,
+        # which is merged rather than dropped as a repeat of the same line
+        add = Batch.add_part if evicted else Batch.allocate
+        if self.buckets:
+            return self._allocate_from_buckets(line, policy, add)
+        return self._allocate_from_product(line, policy, add)
+
+    def _allocate_from_product(
+        self,
+        line: OrderLine,
+        policy: policies.AllocationPolicy = None,
+        add: Callable[[Batch, OrderLine], bool] = None,
+    ) -> str:
+        policy = policy or policies.DEFAULT_POLICY
+        add = add or Batch.allocate
+        parts = policy.choose(self._index_for(policy), line)
+        if not parts:
+            self.events.append(events.OutOfStock(line.sku))
+            return None
+        for batch, qty in parts:
+            part = line if qty == line.qty else OrderLine(line.orderid, line.sku, qty)
+            if not add(batch, part):
+                continue
+            self._batch_changed(batch)
             self.events.append(
                 events.Allocated(
                     orderid=line.orderid,
                     sku=line.sku,
-                    qty=line.qty,
+                    qty=qty,
                     batchref=batch.reference,
                 )
             )
+        self.version_number += 1
+        return parts[0][0].reference
+
+    def _allocate_from_buckets(
+        self,
+        line: OrderLine,
+        policy: policies.AllocationPolicy = None,
+        add: Callable[[Batch, OrderLine], bool] = None,
+    ) -> str:
+        # only the chosen bucket's row is written, so allocations that land in
+        # different buckets don't conflict on the product's version
+        add = add or Batch.allocate
+        start = zlib.crc32(line.orderid.encode()) % len(self.buckets)
+        batches = sorted(self.batches, key=policies.eta_order)
+        for bucket in self.buckets[start:] + self.buckets[:start]:
+            batch = bucket.take(line.qty, batches)
+            if batch is None:
+                continue
+            if add(batch, line):
+                self._batch_changed(batch)
+                self.events.append(
+                    events.Allocated(
+                        line.orderid, line.sku, line.qty, batch.reference
+                    )
+                )
             return batch.reference
-        except StopIteration:
-            self.events.append(events.OutOfStock(line.sku))
-            return None
+        batchref = self._allocate_from_product(line, policy, add)
+        if batchref is not None:
+            self.rebalance_stock()
+        return batchref
+
+    def add_batch(self, ref: str, qty: int, eta: Optional[date]):
+        self.batches.append(Batch(ref, self.sku, qty, eta))
+        self.events.append(events.BatchCreated(self.sku, ref, qty, eta))
+        self.rebalance_stock()
+
+    def split_stock(self, buckets: int):
+        if buckets <= 1:
+            self.buckets = []
+        else:
+            self.buckets = self.buckets[:buckets] + [
+                StockBucket(self.sku, i) for i in range(len(self.buckets), buckets)
+            ]
+            self.rebalance_stock()
+        self.events.append(events.StockSplit(self.sku, max(buckets, 1)))
+        self.version_number += 1
 
-    def change_batch_quantity(self, ref: str, qty: int):
+    def rebalance_stock(self):
+        if not self.buckets:
+            return
+        quotas = [{} for _ in self.buckets]  # type: List[Dict[str, int]]
+        for batch in self.batches:
+            share, extra = divmod(max(batch.available_quantity, 0), len(self.buckets))
+            for i, bucket_quotas in enumerate(quotas):
+                bucket_quotas[batch.reference] = share + (i < extra)
+        for bucket, bucket_quotas in zip(self.buckets, quotas):
+            bucket.reset(bucket_quotas)
+
+    def largest_allocatable(self, policy: policies.AllocationPolicy = None) -> int:
+        policy = policy or policies.DEFAULT_POLICY
+        return policy.largest_allocatable(self._index_for(policy))
+
+    def _index_for(self, policy: policies.AllocationPolicy) -> policies.BatchIndex:
+        indexes = self.__dict__.setdefault("_indexes", {})
+        index = indexes.get(policy.name)
+        if index is None or index.size != len(self.batches):
+            index = indexes[policy.name] = policy.build_index(self.batches)
+        return index
+
+    def _batch_changed(self, batch: Batch):
+        for index in self.__dict__.get("_indexes", {}).values():
+            if index.size == len(self.batches):
+                index.update(batch)
+
+    def change_batch_quantity(
+        self, ref: str, qty: int, policy: policies.AllocationPolicy = None
+    ):
         batch = next(b for b in self.batches if b.reference == ref)
         batch._purchased_quantity = qty
-        while batch.available_quantity < 0:
+        self.events.append(events.BatchQuantityChanged(self.sku, ref, qty))
+        evicted = []
+        while batch.available_quantity < 0 and batch.has_allocations:
             line = batch.deallocate_one()
-            self.events.append(events.Deallocated(line.orderid, line.sku, line.qty))
+            evicted.append(line)
+            self.events.append(
+                events.Deallocated(line.orderid, line.sku, line.qty, batch.reference)
+            )
+        self._batch_changed(batch)
+        self.rebalance_stock()
+        for line in evicted:
+            self.allocate(line, policy, evicted=True)
+
+    def archive_consumed(self, arrived_before: date) -> List[Tuple[str, OrderLine]]:
+        archived = [
+            (batch.reference, line)
+            for batch in self.batches
+            if batch.is_consumed(arrived_before)
+            for line in batch.archive()
+        ]
+        for batchref, line in archived:
+            self.events.append(
+                events.AllocationArchived(line.orderid, line.sku, line.qty, batchref)
+            )
+        if archived:
+            self.version_number += 1
+        return archived
+
+
+class StockBucket:
+    def __init__(
+        self,
+        sku: str,
+        position: int,
+        quotas: Dict[str, int] = None,
+        version_number: int = 0,
+    ):
+        self.sku = sku
+        self.position = position
+        self.quotas = quotas or {}
+        self.version_number = version_number
+
+    def __repr__(self):
+        return f"<StockBucket {self.sku}/{self.position}>"
+
+    @property
+    def available_quantity(self) -> int:
+        return sum(self.quotas.values())
+
+    def take(self, qty: int, batches: List[Batch]) -> Optional[Batch]:
+        for batch in batches:
+            quota = self.quotas.get(batch.reference, 0)
+            if quota >= qty and batch.available_quantity >= qty:
+                self.reset({**self.quotas, batch.reference: quota - qty})
+                return batch
+        return None
+
+    def reset(self, quotas: Dict[str, int]):
+        # assigned rather than mutated so the ORM sees the change
+        self.quotas = {ref: qty for ref, qty in quotas.items() if qty}
+        self.version_number += 1
 
 
 @dataclass(unsafe_hash=True)
@@ -51,6 +213,7 @@ class Batch:
         self.sku = sku
         self.eta = eta
         self._purchased_quantity = qty
+        self._archived_quantity = 0
         self._allocations = set()  # type: Set[OrderLine]
 
     def __repr__(self):
@@ -71,16 +234,51 @@ class Batch:
             return True
         return self.eta > other.eta
 
-    def allocate(self, line: OrderLine):
-        if self.can_allocate(line):
+    def allocate(self, line: OrderLine) -> bool:
+        if line in self._allocations or not self.can_allocate(line):
+            return False
+        self._allocations.add(line)
+        return True
+
+    def add_part(self, line: OrderLine) -> bool:
+        if not self.can_allocate(line):
+            return False
+        self._hold(line)
+        return True
+
+    def _hold(self, line: OrderLine):
+        held = next((h for h in self._allocations if h == line), None)
+        if held is None:
             self._allocations.add(line)
+            return
+        # removed while its hash changes, and kept so the ORM updates its row
+        self._allocations.remove(held)
+        held.qty += line.qty
+        self._allocations.add(held)
 
     def deallocate_one(self) -> OrderLine:
         return self._allocations.pop()
 
+    @property
+    def has_allocations(self) -> bool:
+        return bool(self._allocations)
+
+    def is_consumed(self, arrived_before: date) -> bool:
+        return (
+            self.has_allocations
+            and self.available_quantity <= 0
+            and (self.eta is None or self.eta < arrived_before)
+        )
+
+    def archive(self) -> List[OrderLine]:
+        lines = list(self._allocations)
+        self._archived_quantity += sum(line.qty for line in lines)
+        self._allocations.clear()
+        return lines
+
     @property
     def allocated_quantity(self) -> int:
-        return sum(line.qty for line in self._allocations)
+        return self._archived_quantity + sum(line.qty for line in self._allocations)
 
     @property
     def available_quantity(self) -> int:
@@ -0,0 +1,194 @@
+from __future__ import annotations
+import abc
+import bisect
+from datetime import date
+from typing import Dict, Iterable, List, Optional, Tuple, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from .model import Batch, OrderLine
+
+Parts = List[Tuple["Batch", int]]
+
+
+def eta_order(batch: Batch):
+    return (batch.eta is not None, batch.eta or date.min)
+
+
+class BatchIndex(abc.ABC):
+    def __init__(self, batches: Iterable[Batch]):
+        self.batches = sorted(batches, key=eta_order)
+        self.size = len(self.batches)
+
+    @abc.abstractmethod
+    def update(self, batch: Batch):
+        raise NotImplementedError
+
+    @property
+    @abc.abstractmethod
+    def largest_available(self) -> int:
+        raise NotImplementedError
+
+
+class EtaIndex(BatchIndex):
+    def __init__(self, batches: Iterable[Batch]):
+        super().__init__(batches)
+        self.positions = {b.reference: i for i, b in enumerate(self.batches)}
+        self.leaves = 1
+        while self.leaves < self.size:
+            self.leaves *= 2
+        self._max = [0] * (2 * self.leaves)
+        self._sum = [0] * (2 * self.leaves)
+        for i, batch in enumerate(self.batches):
+            available = batch.available_quantity
+            self._max[self.leaves + i] = available
+            self._sum[self.leaves + i] = max(available, 0)
+        for node in range(self.leaves - 1, 0, -1):
+            self._pull(node)
+
+    def _pull(self, node: int):
+        left, right = 2 * node, 2 * node + 1
+        self._max[node] = max(self._max[left], self._max[right])
+        self._sum[node] = self._sum[left] + self._sum[right]
+
+    def update(self, batch: Batch):
+        node = self.leaves + self.positions[batch.reference]
+        available = batch.available_quantity
+        self._max[node] = available
+        self._sum[node] = max(available, 0)
+        node //= 2
+        while node:
+            self._pull(node)
+            node //= 2
+
+    @property
+    def largest_available(self) -> int:
+        return self._max[1] if self.size else 0
+
+    @property
+    def total_available(self) -> int:
+        return self._sum[1] if self.size else 0
+
+    def first_fitting(self, qty: int) -> Optional[Batch]:
+        if not self.size or self._max[1] < qty:
+            return None
+        node = 1
+        while node < self.leaves:
+            node = 2 * node if self._max[2 * node] >= qty else 2 * node + 1
+        return self.batches[node - self.leaves]
+
+
+class QuantityIndex(BatchIndex):
+    def __init__(self, batches: Iterable[Batch]):
+        super().__init__(batches)
+        self.by_ref = {b.reference: b for b in self.batches}
+        self._order = {b.reference: i for i, b in enumerate(self.batches)}
+        self._keys = {b.reference: self._key(b) for b in self.batches}
+        self._sorted = sorted(self._keys.values())
+
+    def _key(self, batch: Batch):
+        return (
+            batch.available_quantity,
+            self._order[batch.reference],
+            batch.reference,
+        )
+
+    def update(self, batch: Batch):
+        old = self._keys[batch.reference]
+        del self._sorted[bisect.bisect_left(self._sorted, old)]
+        new = self._keys[batch.reference] = self._key(batch)
+        bisect.insort(self._sorted, new)
+
+    @property
+    def largest_available(self) -> int:
+        return self._sorted[-1][0] if self._sorted else 0
+
+    def smallest_fitting(self, qty: int) -> Optional[Batch]:
+        i = bisect.bisect_left(self._sorted, (qty,))
+        if i == len(self._sorted):
+            return None
+        return self.by_ref[self._sorted[i][2]]
+
+
+class AllocationPolicy(abc.ABC):
+    name = ""
+
+    @abc.abstractmethod
+    def build_index(self, batches: Iterable[Batch]) -> BatchIndex:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def choose(self, index, line: OrderLine) -> Parts:
+        raise NotImplementedError
+
+    def largest_allocatable(self, index) -> int:
+        return max(index.largest_available, 0)
+
+
+class EarliestEta(AllocationPolicy):
+    name = "earliest_eta"
+
+    def build_index(self, batches):
+        return EtaIndex(batches)
+
+    def choose(self, index: EtaIndex, line: OrderLine) -> Parts:
+        batch = index.first_fitting(line.qty)
+        return [(batch, line.qty)] if batch else []
+
+
+class BestFit(AllocationPolicy):
+    name = "best_fit"
+
+    def build_index(self, batches):
+        return QuantityIndex(batches)
+
+    def choose(self, index: QuantityIndex, line: OrderLine) -> Parts:
+        batch = index.smallest_fitting(line.qty)
+        return [(batch, line.qty)] if batch else []
+
+
+class Split(EarliestEta):
+    name = "split"
+
+    def largest_allocatable(self, index: EtaIndex) -> int:
+        return index.total_available
+
+    def choose(self, index: EtaIndex, line: OrderLine) -> Parts:
+        parts = super().choose(index, line)
+        if parts or index.total_available < line.qty:
+            return parts
+        remaining = line.qty
+        for batch in index.batches:
+            take = min(batch.available_quantity, remaining)
+            if take > 0:
+                parts.append((batch, take))
+                remaining -= take
+            if not remaining:
+                break
+        return parts
+
+
+POLICIES = {
+    policy.name: policy for policy in [EarliestEta(), BestFit(), Split()]
+}  # type: Dict[str, AllocationPolicy]
+
+DEFAULT_POLICY = POLICIES["earliest_eta"]
+
+
+class PolicyRegistry:
+    def __init__(self, default: str = DEFAULT_POLICY.name, overrides: Dict = None):
+        self.default = self._lookup(default)
+        self.overrides = {
+            sku: self._lookup(name) for sku, name in (overrides or {}).items()
+        }
+
+    @staticmethod
+    def _lookup(name: str) -> AllocationPolicy:
+        try:
+            return POLICIES[name]
+        except KeyError:
+            raise ValueError(
+                f"unknown allocation policy {name!r}, expected one of {sorted(POLICIES)}"
+            ) from None
+
+    def for_sku(self, sku: str) -> AllocationPolicy:
+        return self.overrides.get(sku, self.default)
@@ -0,0 +1,141 @@
+import asyncio
+import contextlib
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Any, Callable, Dict
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, PlainTextResponse
+from starlette.routing import Route
+from allocation import bootstrap, config, views
+from allocation.adapters import orm
+from allocation.domain import commands
+from allocation.service_layer import messagebus, unit_of_work
+from allocation.service_layer.admission import (
+    AdmissionController,
+    Overloaded,
+    QueueFull,
+)
+from allocation.service_layer.group_commit import GroupCommitter
+from allocation.service_layer.handlers import InvalidSku
+from allocation.service_layer.idempotency import DuplicateCommand, IdempotencyStore
+
+
+def create_app(
+    bus_factory: Callable[[], messagebus.MessageBus],
+    max_workers: int = config.get_asgi_max_workers(),
+    read_uow: unit_of_work.ReadOnlyUnitOfWork = None,
+    admission: AdmissionController = None,
+    group_commit_settings: dict = None,
+) -> Starlette:
+    # the bus and its handlers are synchronous, so each request gets a fresh bus
+    # (and UoW) and runs it on a worker thread while the event loop moves on
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    async def run_in_executor(fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(executor, fn, *args)
+
+    if admission is None:
+        admission = AdmissionController(**config.get_admission_settings())
+
+    # the wait deadline starts when the request arrives, not when a thread is free
+    def handle(cmd, arrived_at):
+        with admission.admit(arrived_at):
+            return bus_factory().handle(cmd)
+
+    if group_commit_settings is None:
+        group_commit_settings = config.get_group_commit_settings()
+    group_commit = None
+    if group_commit_settings["window_seconds"]:
+        group_commit = GroupCommitter(
+            lambda cmd: handle(cmd, time.monotonic()), **group_commit_settings
+        )
+
+    async def overloaded(_request: Request, e: Overloaded):
+        status = 429 if isinstance(e, QueueFull) else 503
+        return JSONResponse(
+            {"message": str(e)}, status, headers={"Retry-After": str(e.retry_after)}
+        )
+
+    @contextlib.asynccontextmanager
+    async def lifespan(_app):
+        yield
+        executor.shutdown(wait=True)
+
+    async def add_batch(request: Request):
+        data = await request.json()
+        eta = data["eta"]
+        if eta is not None:
+            eta = datetime.fromisoformat(eta).date()
+        cmd = commands.CreateBatch(data["ref"], data["sku"], data["qty"], eta)
+        await run_in_executor(handle, cmd, time.monotonic())
+        return PlainTextResponse("OK", 201)
+
+    async def allocate(request: Request):
+        data = await request.json()
+        try:
+            cmd = commands.Allocate(
+                data["orderid"],
+                data["sku"],
+                data["qty"],
+                idempotency_key=request.headers.get("Idempotency-Key"),
+            )
+            if group_commit and cmd.idempotency_key is None:
+                await run_in_executor(group_commit.allocate, cmd)
+            else:
+                await run_in_executor(handle, cmd, time.monotonic())
+        except InvalidSku as e:
+            return JSONResponse({"message": str(e)}, 400)
+        except DuplicateCommand as e:
+            return JSONResponse({"message": f"{e} is still being handled"}, 409)
+        return PlainTextResponse("OK", 202)
+
+    async def allocations_view(request: Request):
+        orderid = request.path_params["orderid"]
+        uow = read_uow or bus_factory().uow
+        result = await run_in_executor(views.allocations, orderid, uow)
+        if not result:
+            return PlainTextResponse("not found", 404)
+        return JSONResponse(result, 200)
+
+    async def db_pools(_request: Request):
+        if read_uow is None:
+            return PlainTextResponse("no read-only unit of work", 404)
+        return JSONResponse(read_uow.stats(), 200)
+
+    # Starlette types handlers as taking any Exception
+    exception_handlers = {Overloaded: overloaded}  # type: Dict[Any, Callable]
+    return Starlette(
+        routes=[
+            Route("/add_batch", add_batch, methods=["POST"]),
+            Route("/allocate", allocate, methods=["POST"]),
+            Route("/allocations/{orderid}", allocations_view, methods=["GET"]),
+            Route("/db_pools", db_pools, methods=["GET"]),
+        ],
+        exception_handlers=exception_handlers,
+        lifespan=lifespan,
+    )
+
+
+def default_app() -> Starlette:
+    orm.start_mappers()
+    notifications = bootstrap.default_notifications()
+    hints = bootstrap.default_stock_hints()
+    idempotency = IdempotencyStore(
+        unit_of_work.DEFAULT_SESSION_FACTORY, **config.get_idempotency_settings()
+    )
+
+    def new_bus():
+        return bootstrap.bootstrap(
+            start_orm=False,
+            uow=unit_of_work.SqlAlchemyUnitOfWork(),
+            notifications=notifications,
+            hints=hints,
+            idempotency=idempotency,
+        )
+
+    return create_app(
+        new_bus,
+        read_uow=unit_of_work.ReadOnlyUnitOfWork(**config.get_replica_lag_settings()),
+    )
@@ -0,0 +1,40 @@
+import argparse
+import logging
+from datetime import date, timedelta
+from allocation import bootstrap, config, views
+from allocation.adapters.notifications import NullNotifications
+from allocation.domain import commands
+from allocation.service_layer import unit_of_work
+
+logger = logging.getLogger(__name__)
+
+
+def compact(bus, arrived_before: date) -> int:
+    archived = 0
+    for sku in views.compaction_candidates(arrived_before, bus.uow):
+        [count] = bus.handle(commands.ArchiveConsumedBatches(sku, arrived_before))
+        archived += count
+    return archived
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m allocation.entrypoints.compactor"
+    )
+    parser.add_argument(
+        "--older-than-days", type=int, default=config.get_archive_after_days()
+    )
+    args = parser.parse_args(argv)
+    bus = bootstrap.bootstrap(
+        uow=unit_of_work.SqlAlchemyUnitOfWork(),
+        notifications=NullNotifications(),
+        publish=lambda *args: None,
+    )
+    arrived_before = date.today() - timedelta(days=args.older_than_days)
+    archived = compact(bus, arrived_before)
+    logger.info("archived %d allocations", archived)
+    print(f"archived {archived} allocations")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,202 @@
+# pylint: disable=broad-except
+import argparse
+import logging
+import multiprocessing
+import os
+import signal
+import threading
+import time
+from dataclasses import dataclass
+from typing import Callable, List, Optional
+
+from allocation import config
+from allocation.entrypoints import redis_eventconsumer
+
+logger = logging.getLogger(__name__)
+
+SHUTDOWN_SIGNALS = {signal.SIGTERM, signal.SIGINT}
+
+Target = Callable[[int, Callable[[], None]], None]
+
+
+@dataclass
+class WorkerSlot:
+    index: int
+    pid: Optional[int] = None
+    started_at: float = 0.0
+    failures: int = 0
+    restarts: int = 0
+    restart_at: float = 0.0
+
+
+class Supervisor:
+    def __init__(
+        self,
+        target: Target,
+        processes: int,
+        min_backoff: float = 0.5,
+        max_backoff: float = 30.0,
+        stable_seconds: float = 30.0,
+        report_seconds: float = 10.0,
+        shutdown_timeout: float = 30.0,
+        poll_seconds: float = 0.1,
+    ):
+        self.target = target
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.stable_seconds = stable_seconds
+        self.report_seconds = report_seconds
+        self.shutdown_timeout = shutdown_timeout
+        self.poll_seconds = poll_seconds
+        self.slots = [WorkerSlot(i) for i in range(processes)]
+        self.counters = multiprocessing.RawArray("q", processes)
+        self.stopping = threading.Event()
+        self._last_counts = [0] * processes
+        self._last_report = time.monotonic()
+
+    def run(self, install_signals: bool = True):
+        if install_signals:
+            signal.signal(signal.SIGTERM, lambda *_: self.stop())
+            signal.signal(signal.SIGINT, lambda *_: self.stop())
+        for slot in self.slots:
+            self.spawn(slot)
+        deadline = None
+        while not self.stopping.is_set() or self.running():
+            self.reap()
+            now = time.monotonic()
+            if self.stopping.is_set():
+                deadline = deadline or now + self.shutdown_timeout
+                if now > deadline:
+                    self.signal_all(signal.SIGKILL)
+            else:
+                for slot in self.slots:
+                    if slot.pid is None and slot.restart_at <= now:
+                        self.spawn(slot)
+                if now - self._last_report >= self.report_seconds:
+                    self.report()
+            time.sleep(self.poll_seconds)
+        self.report()
+
+    def stop(self):
+        if not self.stopping.is_set():
+            logger.info("stopping %d workers", len(self.running()))
+            self.stopping.set()
+            self.signal_all(signal.SIGTERM)
+
+    def running(self) -> List[WorkerSlot]:
+        return [slot for slot in self.slots if slot.pid is not None]
+
+    def signal_all(self, signum: int):
+        for pid in [slot.pid for slot in self.slots if slot.pid is not None]:
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def spawn(self, slot: WorkerSlot):
+        signal.pthread_sigmask(signal.SIG_BLOCK, SHUTDOWN_SIGNALS)
+        pid = os.fork()
+        if pid == 0:
+            self._run_child(slot.index)
+        signal.pthread_sigmask(signal.SIG_UNBLOCK, SHUTDOWN_SIGNALS)
+        slot.pid = pid
+        slot.started_at = time.monotonic()
+        slot.restart_at = 0.0
+        logger.info("started worker %d as pid %d", slot.index, pid)
+        if self.stopping.is_set():
+            os.kill(pid, signal.SIGTERM)
+
+    def _run_child(self, index: int):
+        code = 0
+        try:
+            for signum in SHUTDOWN_SIGNALS:
+                signal.signal(signum, signal.SIG_DFL)
+            signal.pthread_sigmask(signal.SIG_UNBLOCK, SHUTDOWN_SIGNALS)
+            self.target(index, self._counter(index))
+        except BaseException:
+            logger.exception("worker %d crashed", index)
+            code = 1
+        finally:
+            os._exit(code)  # pylint: disable=protected-access
+
+    def _counter(self, index: int) -> Callable[[], None]:
+        lock = threading.Lock()
+
+        def processed():
+            with lock:
+                self.counters[index] += 1
+
+        return processed
+
+    def reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            slot = next((s for s in self.slots if s.pid == pid), None)
+            if slot is None:
+                continue
+            slot.pid = None
+            code = os.waitstatus_to_exitcode(status)
+            if self.stopping.is_set():
+                logger.info(
+                    "worker %d (pid %d) exited with %d", slot.index, pid, code
+                )
+                continue
+            self.schedule_restart(slot, code)
+
+    def schedule_restart(self, slot: WorkerSlot, code: int):
+        now = time.monotonic()
+        if now - slot.started_at >= self.stable_seconds:
+            slot.failures = 0
+        slot.failures += 1
+        delay = min(self.max_backoff, self.min_backoff * 2 ** (slot.failures - 1))
+        slot.restart_at = now + delay
+        slot.restarts += 1
+        logger.warning(
+            "worker %d exited with %d, restarting in %.1fs", slot.index, code, delay
+        )
+
+    def throughput(self) -> List[float]:
+        now = time.monotonic()
+        elapsed = max(now - self._last_report, 1e-9)
+        counts = list(self.counters)
+        rates = [(c - last) / elapsed for c, last in zip(counts, self._last_counts)]
+        self._last_counts, self._last_report = counts, now
+        return rates
+
+    def report(self):
+        for slot, rate in zip(self.slots, self.throughput()):
+            logger.info(
+                "worker %d (pid %s): %.1f msg/s, %d handled, %d restarts",
+                slot.index,
+                slot.pid,
+                rate,
+                self.counters[slot.index],
+                slot.restarts,
+            )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m allocation.entrypoints.consumer_supervisor"
+    )
+    parser.add_argument(
+        "--processes", type=int, default=config.get_redis_consumer_processes()
+    )
+    parser.add_argument("--report-seconds", type=float, default=10.0)
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+
+    Supervisor(
+        redis_eventconsumer.run_worker,
+        args.processes,
+        report_seconds=args.report_seconds,
+    ).run()
+
+
+if __name__ == "__main__":
+    main()
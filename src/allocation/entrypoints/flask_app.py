@@ -1,11 +1,56 @@
 from datetime import datetime
 from flask import Flask, jsonify, request
+from allocation.adapters.sharding import CrossShardRequest
 from allocation.domain import commands
 from allocation.service_layer.handlers import InvalidSku
-from allocation import bootstrap, views
+from allocation.service_layer.idempotency import DuplicateCommand, IdempotencyStore
+from allocation import bootstrap, config, views
+from allocation.adapters import orm
+from allocation.service_layer import messagebus, unit_of_work
+from allocation.service_layer.admission import (
+    AdmissionController,
+    Overloaded,
+    QueueFull,
+)
+from allocation.service_layer.group_commit import GroupCommitter
 
 app = Flask(__name__)
-bus = bootstrap.bootstrap()
+orm.start_mappers()
+notifications = bootstrap.default_notifications()
+hints = bootstrap.default_stock_hints()
+idempotency = IdempotencyStore(
+    unit_of_work.DEFAULT_SESSION_FACTORY, **config.get_idempotency_settings()
+)
+read_uow = unit_of_work.ReadOnlyUnitOfWork(**config.get_replica_lag_settings())
+admission = AdmissionController(**config.get_admission_settings())
+
+
+# request threads must not share a bus or UoW, so each command gets its own
+def new_bus() -> messagebus.MessageBus:
+    return bootstrap.bootstrap(
+        start_orm=False,
+        uow=unit_of_work.SqlAlchemyUnitOfWork(),
+        notifications=notifications,
+        hints=hints,
+        idempotency=idempotency,
+    )
+
+
+def handle(cmd):
+    with admission.admit():
+        return new_bus().handle(cmd)
+
+
+group_commit_settings = config.get_group_commit_settings()
+group_commit = None
+if group_commit_settings["window_seconds"]:
+    group_commit = GroupCommitter(handle, **group_commit_settings)
+
+
+@app.errorhandler(Overloaded)
+def overloaded(e: Overloaded):
+    status = 429 if isinstance(e, QueueFull) else 503
+    return {"message": str(e)}, status, {"Retry-After": str(e.retry_after)}
 
 
 @app.route("/add_batch", methods=["POST"])
@@ -16,7 +61,7 @@ def add_batch():
     cmd = commands.CreateBatch(
         request.json["ref"], request.json["sku"], request.json["qty"], eta
     )
-    bus.handle(cmd)
+    handle(cmd)
     return "OK", 201
 
 
@@ -24,18 +69,62 @@ def add_batch():
 def allocate_endpoint():
     try:
         cmd = commands.Allocate(
-            request.json["orderid"], request.json["sku"], request.json["qty"]
+            request.json["orderid"],
+            request.json["sku"],
+            request.json["qty"],
+            idempotency_key=request.headers.get("Idempotency-Key"),
         )
-        bus.handle(cmd)
+        # group commits are one command, so retried requests are handled alone
+        if group_commit and cmd.idempotency_key is None:
+            group_commit.allocate(cmd)
+        else:
+            handle(cmd)
     except InvalidSku as e:
         return {"message": str(e)}, 400
+    except DuplicateCommand as e:
+        return {"message": f"{e} is still being handled"}, 409
 
     return "OK", 202
 
 
+@app.route("/allocate_batch", methods=["POST"])
+def allocate_batch_endpoint():
+    cmd = commands.BulkAllocate(
+        [
+            commands.Allocate(line["orderid"], line["sku"], line["qty"])
+            for line in request.json
+        ]
+    )
+    try:
+        [outcomes] = handle(cmd)
+    except CrossShardRequest as e:
+        return {"message": str(e)}, 400
+    results = [
+        allocation_outcome(line, outcome)
+        for line, outcome in zip(cmd.lines, outcomes)
+    ]
+    return jsonify(results), 200
+
+
+def allocation_outcome(line: commands.Allocate, outcome):
+    result = {"orderid": line.orderid, "sku": line.sku}
+    if isinstance(outcome, InvalidSku):
+        result.update(status="invalid_sku", message=str(outcome))
+    elif outcome is None:
+        result.update(status="out_of_stock")
+    else:
+        result.update(status="allocated", batchref=outcome)
+    return result
+
+
 @app.route("/allocations/<orderid>", methods=["GET"])
 def allocations_view_endpoint(orderid):
-    result = views.allocations(orderid, bus.uow)
+    result = views.allocations(orderid, read_uow)
     if not result:
         return "not found", 404
     return jsonify(result), 200
+
+
+@app.route("/db_pools", methods=["GET"])
+def db_pools_endpoint():
+    return jsonify(read_uow.stats()), 200
@@ -0,0 +1,418 @@
+# pylint: disable=broad-except
+import argparse
+import itertools
+import json
+import random
+import statistics
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from datetime import date, timedelta
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Union
+import redis
+import requests
+from sqlalchemy import create_engine
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.orm import sessionmaker
+from allocation import bootstrap, config
+from allocation.adapters import codecs, orm
+from allocation.adapters.notifications import NullNotifications
+from allocation.domain import commands
+from allocation.service_layer import handlers, unit_of_work
+
+CONFLICT_MARKERS = ["could not serialize", "deadlock detected", "database is locked"]
+
+
+@dataclass
+class TrafficShape:
+    commands: int = 10000
+    skus: int = 500
+    zipf_s: float = 1.1
+    eta_ratio: float = 0.5
+    new_batch_ratio: float = 0.02
+    burst_probability: float = 0.01
+    burst_size: int = 20
+    batch_qty: int = 1000
+    max_line_qty: int = 10
+    seed: Optional[int] = None
+
+
+def generate(shape: TrafficShape) -> Iterator[commands.Command]:
+    rng = random.Random(shape.seed)
+    prefix = uuid.UUID(int=rng.getrandbits(128)).hex[:6]
+    skus = [f"sku-{prefix}-{i}" for i in range(shape.skus)]
+    weights = [1 / (rank**shape.zipf_s) for rank in range(1, shape.skus + 1)]
+    batchrefs = {}  # type: Dict[str, List[str]]
+    refs = itertools.count()
+
+    def new_batch(sku):
+        ref = f"{sku}-batch-{next(refs)}"
+        batchrefs.setdefault(sku, []).append(ref)
+        eta = None
+        if rng.random() < shape.eta_ratio:
+            eta = date.today() + timedelta(days=rng.randint(1, 60))
+        return commands.CreateBatch(ref, sku, shape.batch_qty, eta)
+
+    for sku in skus:
+        yield new_batch(sku)
+
+    orderids = itertools.count()
+    emitted = 0
+    while emitted < shape.commands:
+        sku = rng.choices(skus, weights)[0]
+        roll = rng.random()
+        if roll < shape.burst_probability:
+            ref = rng.choice(batchrefs[sku])
+            for _ in range(min(shape.burst_size, shape.commands - emitted)):
+                yield commands.ChangeBatchQuantity(
+                    ref, rng.randint(0, shape.batch_qty)
+                )
+                emitted += 1
+            continue
+        if roll < shape.burst_probability + shape.new_batch_ratio:
+            yield new_batch(sku)
+        else:
+            qty = rng.randint(1, shape.max_line_qty)
+            yield commands.Allocate(f"order-{prefix}-{next(orderids)}", sku, qty)
+        emitted += 1
+
+
+def write_stream(messages: Iterable[commands.Command], out):
+    codec = codecs.get_codec("json")
+    for message in messages:
+        out.write(codec.encode(message).decode() + "\n")
+
+
+def read_stream(lines: Iterable[str]) -> Iterator[commands.Command]:
+    for line in lines:
+        if line.strip():
+            cmd = codecs.decode(line.encode())
+            if not isinstance(cmd, commands.Command):
+                raise codecs.CodecError(f"expected a command, got {cmd}")
+            yield cmd
+
+
+@dataclass
+class Report:
+    commands: int = 0
+    elapsed: float = 0.0
+    latencies: List[float] = field(default_factory=list)
+    conflicts: int = 0
+    retries: int = 0
+    errors: int = 0
+    events: Optional[int] = None
+
+    def as_dict(self) -> Dict:
+        percentiles = (
+            statistics.quantiles(self.latencies, n=100) if self.latencies else []
+        )
+        return dict(
+            commands=self.commands,
+            throughput=self.commands / self.elapsed if self.elapsed else 0.0,
+            p50=percentiles[49] if percentiles else None,
+            p95=percentiles[94] if percentiles else None,
+            p99=percentiles[98] if percentiles else None,
+            conflicts=self.conflicts,
+            retries=self.retries,
+            errors=self.errors,
+            events_per_command=(
+                self.events / self.commands
+                if self.events is not None and self.commands
+                else None
+            ),
+        )
+
+
+class Conflict(Exception):
+    pass
+
+
+def is_conflict(error: Exception) -> bool:
+    return isinstance(error, DBAPIError) and any(
+        marker in str(error) for marker in CONFLICT_MARKERS
+    )
+
+
+class CountingBus:
+    def __init__(self, bus, counter: Callable[[], None]):
+        self.bus = bus
+        handle_event = bus.handle_event
+
+        def counting_handle_event(event):
+            counter()
+            handle_event(event)
+
+        bus.handle_event = counting_handle_event
+
+    def handle(self, cmd):
+        try:
+            return self.bus.handle(cmd)
+        except Exception as e:
+            if is_conflict(e):
+                raise Conflict(str(e)) from e
+            raise
+
+
+class BusTarget:
+    counts_events = True
+
+    def __init__(self, db_uri: str = None):
+        orm.start_mappers()
+        if db_uri:
+            engine = create_engine(db_uri)
+            orm.metadata.create_all(engine)
+            session_factory = sessionmaker(bind=engine)
+        else:
+            session_factory = unit_of_work.DEFAULT_SESSION_FACTORY
+        self.session_factory = session_factory
+        self.hints = bootstrap.default_stock_hints()
+        self.events = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def count_event(self):
+        with self._lock:
+            self.events += 1
+
+    def send(self, cmd: commands.Command):
+        bus = getattr(self._local, "bus", None)
+        if bus is None:
+            bus = self._local.bus = CountingBus(
+                bootstrap.bootstrap(
+                    start_orm=False,
+                    uow=unit_of_work.SqlAlchemyUnitOfWork(self.session_factory),
+                    notifications=NullNotifications(),
+                    publish=lambda *args: None,
+                    hints=self.hints,
+                ),
+                self.count_event,
+            )
+        bus.handle(cmd)
+
+
+class HttpTarget:
+    # the API has no endpoint for ChangeBatchQuantity, so those go onto the Redis
+    # stream and need a running consumer to be handled
+    counts_events = False
+
+    def __init__(self, url: str = None, client=None):
+        if client is None:
+            client = requests.Session()
+            self.prefix = url or config.get_api_url()
+        else:
+            self.prefix = ""
+        self.client = client
+        self._redis = None  # type: Optional[redis.Redis]
+
+    def send(self, cmd: commands.Command):
+        if isinstance(cmd, commands.ChangeBatchQuantity):
+            self.redis().xadd(
+                "change_batch_quantity", {"data": codecs.get_codec().encode(cmd)}
+            )
+            return
+        if isinstance(cmd, commands.CreateBatch):
+            eta = cmd.eta.isoformat() if cmd.eta else None
+            r = self.client.post(
+                f"{self.prefix}/add_batch",
+                json={"ref": cmd.ref, "sku": cmd.sku, "qty": cmd.qty, "eta": eta},
+            )
+        elif isinstance(cmd, commands.Allocate):
+            r = self.client.post(
+                f"{self.prefix}/allocate",
+                json={"orderid": cmd.orderid, "sku": cmd.sku, "qty": cmd.qty},
+            )
+        else:
+            raise ValueError(f"cannot send {cmd} to the API")
+        if r.status_code >= 500:
+            raise Exception(f"{r.status_code} from {cmd}")
+
+    def redis(self):
+        if self._redis is None:
+            self._redis = redis.Redis(**config.get_redis_host_and_port())
+        return self._redis
+
+
+class FlaskTarget(HttpTarget):
+    counts_events = True
+
+    def __init__(self):
+        from allocation.entrypoints import (
+            flask_app,
+        )  # pylint: disable=import-outside-toplevel
+
+        flask_app.app.testing = True
+        super().__init__(client=flask_app.app.test_client())
+        self.events = 0
+        self._lock = threading.Lock()
+        new_bus = flask_app.new_bus
+        flask_app.new_bus = lambda: CountingBus(new_bus(), self.count_event).bus
+        self.handle = flask_app.handle
+
+    def count_event(self):
+        with self._lock:
+            self.events += 1
+
+    def send(self, cmd: commands.Command):
+        try:
+            # handled in-process, so a Flask run needs no Redis
+            if isinstance(cmd, commands.ChangeBatchQuantity):
+                self.handle(cmd)
+            else:
+                super().send(cmd)
+        except Exception as e:
+            if is_conflict(e):
+                raise Conflict(str(e)) from e
+            raise
+
+
+def run(
+    target,
+    messages: Iterable[commands.Command],
+    rate: float = 0,
+    concurrency: int = 1,
+    retries: int = 3,
+) -> Report:
+    messages = iter(messages)
+    setup = []  # type: List[commands.Command]
+    first = None
+    for message in messages:
+        if not isinstance(message, commands.CreateBatch):
+            first = message
+            break
+        setup.append(message)
+    for message in setup:
+        target.send(message)
+    if first is not None:
+        messages = itertools.chain([first], messages)
+
+    report = Report()
+    lock = threading.Lock()
+    events_before = getattr(target, "events", 0)
+
+    def send(cmd):
+        start = time.perf_counter()
+        for attempt in range(retries + 1):
+            try:
+                target.send(cmd)
+                outcome = "ok"
+                break
+            except Conflict:
+                outcome = "conflict"
+                with lock:
+                    report.conflicts += 1
+                    if attempt < retries:
+                        report.retries += 1
+            except handlers.InvalidSku:
+                outcome = "ok"
+                break
+            except Exception:
+                outcome = "error"
+                break
+        with lock:
+            report.latencies.append(time.perf_counter() - start)
+            if outcome != "ok":
+                report.errors += 1
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for i, cmd in enumerate(messages):
+            if rate:
+                delay = start + i / rate - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            executor.submit(send, cmd)
+            report.commands += 1
+    report.elapsed = time.perf_counter() - start
+    if target.counts_events:
+        report.events = target.events - events_before
+    return report
+
+
+def add_shape_arguments(parser):
+    defaults = TrafficShape()
+    parser.add_argument("--commands", type=int, default=defaults.commands)
+    parser.add_argument("--skus", type=int, default=defaults.skus)
+    parser.add_argument("--zipf-s", type=float, default=defaults.zipf_s)
+    parser.add_argument("--eta-ratio", type=float, default=defaults.eta_ratio)
+    parser.add_argument(
+        "--new-batch-ratio", type=float, default=defaults.new_batch_ratio
+    )
+    parser.add_argument(
+        "--burst-probability", type=float, default=defaults.burst_probability
+    )
+    parser.add_argument("--burst-size", type=int, default=defaults.burst_size)
+    parser.add_argument("--batch-qty", type=int, default=defaults.batch_qty)
+    parser.add_argument("--max-line-qty", type=int, default=defaults.max_line_qty)
+    parser.add_argument("--seed", type=int, default=None)
+
+
+def shape_from_args(args) -> TrafficShape:
+    return TrafficShape(
+        commands=args.commands,
+        skus=args.skus,
+        zipf_s=args.zipf_s,
+        eta_ratio=args.eta_ratio,
+        new_batch_ratio=args.new_batch_ratio,
+        burst_probability=args.burst_probability,
+        burst_size=args.burst_size,
+        batch_qty=args.batch_qty,
+        max_line_qty=args.max_line_qty,
+        seed=args.seed,
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m allocation.entrypoints.loadgen")
+    subparsers = parser.add_subparsers(dest="action", required=True)
+
+    generate_parser = subparsers.add_parser("generate", help="write a command stream")
+    add_shape_arguments(generate_parser)
+
+    run_parser = subparsers.add_parser("run", help="generate or replay a stream")
+    add_shape_arguments(run_parser)
+    run_parser.add_argument("--replay", type=argparse.FileType("r"))
+    run_parser.add_argument(
+        "--target", choices=["bus", "flask", "http"], default="bus"
+    )
+    run_parser.add_argument("--db-uri", help="bus target only, defaults to postgres")
+    run_parser.add_argument("--url", help="http target only")
+    run_parser.add_argument("--rate", type=float, default=0, help="commands/s, 0=max")
+    run_parser.add_argument("--concurrency", type=int, default=1)
+    run_parser.add_argument("--retries", type=int, default=3)
+    run_parser.add_argument("--json", action="store_true")
+
+    args = parser.parse_args(argv)
+    if args.action == "generate":
+        write_stream(generate(shape_from_args(args)), sys.stdout)
+        return
+
+    if args.replay:
+        messages = read_stream(args.replay)  # type: Iterable[commands.Command]
+    else:
+        messages = generate(shape_from_args(args))
+    if args.target == "bus":
+        target = BusTarget(args.db_uri)  # type: Union[BusTarget, HttpTarget]
+    elif args.target == "flask":
+        target = FlaskTarget()
+    else:
+        target = HttpTarget(args.url)
+
+    report = run(
+        target, messages, args.rate, args.concurrency, args.retries
+    ).as_dict()
+    if args.json:
+        print(json.dumps(report))
+        return
+    for key, value in report.items():
+        if isinstance(value, float) and key.startswith("p"):
+            value = f"{value * 1000:.2f}ms"
+        elif isinstance(value, float):
+            value = f"{value:.2f}"
+        print(f"{key:>20}: {value}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,30 +1,410 @@
-import json
+# pylint: disable=broad-except
+from __future__ import annotations
 import logging
+import queue
+import signal
+import threading
+import time
+import zlib
+from typing import Any, Callable, Dict, List, Optional, Set
 import redis
 
 from allocation import bootstrap, config
+from allocation.adapters import codecs, orm, sharding
 from allocation.domain import commands
+from allocation.service_layer import messagebus, unit_of_work
+from allocation.service_layer.admission import AdmissionController
+from allocation.service_layer.idempotency import IdempotencyStore
 
 logger = logging.getLogger(__name__)
 
 r = redis.Redis(**config.get_redis_host_and_port())
 
+STREAM = "change_batch_quantity"
+GROUP = "allocation"
+
 
 def main():
-    logger.info("Redis pubsub starting")
-    bus = bootstrap.bootstrap()
-    pubsub = r.pubsub(ignore_subscribe_messages=True)
-    pubsub.subscribe("change_batch_quantity")
+    logger.info("Redis stream consumer starting")
+    consumer = build_consumer(r)
+    signal.signal(signal.SIGTERM, lambda *_: consumer.stop())
+    signal.signal(signal.SIGINT, lambda *_: consumer.stop())
+    consumer.run()
+
+
+def run_worker(index: int, on_processed: Callable[[], None]):
+    logger.info("Redis stream consumer worker %d starting", index)
+    consumer = build_consumer(
+        redis.Redis(**config.get_redis_host_and_port()),
+        session_factory=unit_of_work.default_session_factory(),
+        shards=unit_of_work.default_shard_router(),
+        on_processed=on_processed,
+    )
+    signal.signal(signal.SIGTERM, lambda *_: consumer.stop())
+    signal.signal(signal.SIGINT, lambda *_: consumer.stop())
+    consumer.run()
+
+
+def build_consumer(
+    client: redis.Redis,
+    session_factory=unit_of_work.DEFAULT_SESSION_FACTORY,
+    shards: Optional[sharding.ShardRouter] = unit_of_work.DEFAULT_SHARDS,
+    on_processed: Callable[[], None] = None,
+) -> StreamConsumer:
+    orm.start_mappers()
+    notifications = bootstrap.default_notifications()
+    hints = bootstrap.default_stock_hints()
+    idempotency = IdempotencyStore(
+        session_factory, **config.get_idempotency_settings()
+    )
+
+    def new_bus() -> messagebus.MessageBus:
+        return bootstrap.bootstrap(
+            start_orm=False,
+            uow=unit_of_work.SqlAlchemyUnitOfWork(session_factory, shards=shards),
+            notifications=notifications,
+            hints=hints,
+            idempotency=idempotency,
+        )
+
+    return StreamConsumer(
+        client,
+        new_bus,
+        stream=STREAM,
+        group=GROUP,
+        decode=decode_change_batch_quantity,
+        partition_key=lambda cmd: cmd.ref,
+        coalesce_key=lambda cmd: cmd.ref,
+        keyed_by_message_id=True,
+        on_processed=on_processed,
+        admission=AdmissionController(**config.get_consumer_admission_settings()),
+        **config.get_redis_consumer_settings(),
+    )
+
+
+def decode_change_batch_quantity(m) -> commands.ChangeBatchQuantity:
+    cmd = codecs.decode(m[b"data"], default_type=commands.ChangeBatchQuantity)
+    if not isinstance(cmd, commands.ChangeBatchQuantity):
+        raise codecs.CodecError(f"expected ChangeBatchQuantity, got {cmd}")
+    return cmd
+
+
+class StreamConsumer:
+    def __init__(
+        self,
+        client: redis.Redis,
+        bus_factory: Callable[[], messagebus.MessageBus],
+        stream: str,
+        group: str,
+        decode: Callable,
+        consumer: str,
+        partition_key: Callable = None,
+        workers: int = 0,
+        queue_size: int = 100,
+        batch_size: int = 100,
+        max_queued: int = 100,
+        block_ms: int = 1000,
+        min_idle_ms: int = 30000,
+        max_deliveries: int = 5,
+        retry_ms: int = 100,
+        on_processed: Callable[[], None] = None,
+        admission: AdmissionController = None,
+        coalesce_key: Callable = None,
+        coalesce_ms: int = 0,
+        keyed_by_message_id: bool = False,
+    ):
+        self.client = client
+        self.bus_factory = bus_factory
+        self.stream = stream
+        self.group = group
+        self.decode = decode
+        self.consumer = consumer
+        self.batch_size = batch_size
+        self.max_queued = max_queued
+        self.block_ms = block_ms
+        self.min_idle_ms = min_idle_ms
+        self.max_deliveries = max_deliveries
+        self.retry_ms = retry_ms
+        self.partition_key = partition_key
+        self.on_processed = on_processed
+        self.admission = admission
+        self.coalesce_key = coalesce_key
+        self.coalesce_ms = coalesce_ms
+        self.keyed_by_message_id = keyed_by_message_id
+        self.received = 0
+        self.coalesced = 0
+        self.dead_letter_stream = f"{stream}:dead"
+        self.in_flight = set()  # type: Set[bytes]
+        self.held = set()  # type: Set
+        self.stopping = threading.Event()
+        if workers:
+            self.workers = PartitionedWorkers(
+                self, workers, queue_size
+            )  # type: Optional[PartitionedWorkers]
+            self.bus = None
+        else:
+            self.workers = None
+            self.bus = bus_factory()
+        self.ensure_group()
+
+    def ensure_group(self):
+        try:
+            self.client.xgroup_create(self.stream, self.group, id="0", mkstream=True)
+        except redis.ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+
+    def run(self):
+        while not self.stopping.is_set():
+            self.consume_once()
+        self.drain()
+        logger.info("consumer %s finished: %s", self.consumer, self.stats())
+
+    def stop(self):
+        logger.info("stopping consumer %s", self.consumer)
+        self.stopping.set()
+
+    def drain(self):
+        if self.workers:
+            self.workers.shutdown()
+
+    def consume_once(self) -> int:
+        if self.under_pressure():
+            # leave messages in the stream for consumers that are keeping up
+            self.stopping.wait(self.block_ms / 1000)
+            return 0
+        batch = self.reclaim_pending()
+        batch += self.read(self.block_ms)
+        if batch and self.coalesce_key and self.coalesce_ms:
+            # give bursts for the same key a chance to arrive before handling them
+            deadline = time.monotonic() + self.coalesce_ms / 1000
+            while len(batch) < self.batch_size:
+                remaining_ms = int((deadline - time.monotonic()) * 1000)
+                if remaining_ms <= 0:
+                    break
+                batch += self.read(remaining_ms)
+        if self.coalesce_key:
+            batch = self.coalesce(batch, self.coalesce_key)
+        return sum(
+            self.dispatch(message_id, message) for message_id, message in batch
+        )
+
+    def under_pressure(self) -> bool:
+        # busy workers are the point; a backlog queued up in front of them, or
+        # commands queueing for admission, means they are falling behind
+        if self.workers is not None and self.workers.queued() > self.max_queued:
+            return True
+        return bool(self.admission and self.admission.under_pressure())
+
+    def read(self, block_ms: int) -> List:
+        response = self.client.xreadgroup(
+            self.group,
+            self.consumer,
+            {self.stream: ">"},
+            count=self.batch_size,
+            block=block_ms,
+        )  # type: Any
+        batch = []
+        for _stream, messages in response or []:
+            for message_id, fields in messages:
+                message = self.decode_or_dead_letter(message_id, fields)
+                if message is not None:
+                    batch.append((message_id, message))
+        return batch
+
+    def coalesce(self, batch: List, key: Callable) -> List:
+        # only the latest message for each key matters, so the ones it supersedes
+        # are acknowledged without ever reaching the bus
+        latest = {}  # type: Dict
+        for message_id, message in batch:
+            latest[key(message)] = message_id
+        superseded = [
+            message_id
+            for message_id, message in batch
+            if latest[key(message)] != message_id
+        ]
+        if superseded:
+            logger.info("coalesced %d superseded messages", len(superseded))
+            self.client.xack(self.stream, self.group, *superseded)
+        self.received += len(batch)
+        self.coalesced += len(superseded)
+        return [
+            (message_id, message)
+            for message_id, message in batch
+            if latest[key(message)] == message_id
+        ]
+
+    def stats(self) -> Dict:
+        return dict(
+            received=self.received,
+            coalesced=self.coalesced,
+            in_flight=len(self.in_flight),
+        )
+
+    def reclaim_pending(self) -> List:
+        self.renew_in_flight()
+        claimed = self.client.xautoclaim(
+            self.stream,
+            self.group,
+            self.consumer,
+            min_idle_time=self.min_idle_ms,
+            start_id="0-0",
+            count=self.batch_size,
+        )[1]
+        batch = []
+        for message_id, fields in claimed:
+            if fields is None or message_id in self.in_flight:
+                continue
+            if self.deliveries(message_id) > self.max_deliveries:
+                self.dead_letter(message_id, fields)
+                continue
+            message = self.decode_or_dead_letter(message_id, fields)
+            if message is not None:
+                batch.append((message_id, message))
+        return batch
+
+    def renew_in_flight(self):
+        # messages queued for the workers can sit idle for longer than min_idle_ms;
+        # JUSTID resets their idle time without counting another delivery, so
+        # neither this consumer nor another one reclaims them
+        in_flight = list(self.in_flight)  # type: List[Any]
+        if in_flight:
+            self.client.xclaim(
+                self.stream,
+                self.group,
+                self.consumer,
+                min_idle_time=0,
+                message_ids=in_flight,
+                justid=True,
+            )
+
+    def deliveries(self, message_id) -> int:
+        [pending] = self.client.xpending_range(
+            self.stream, self.group, min=message_id, max=message_id, count=1
+        )
+        return int(pending["times_delivered"])
+
+    def dead_letter(self, message_id, fields):
+        logger.error(
+            "giving up on %s %s, moving to %s",
+            message_id,
+            fields,
+            self.dead_letter_stream,
+        )
+        pipe = self.client.pipeline()
+        pipe.xadd(self.dead_letter_stream, fields)
+        pipe.xack(self.stream, self.group, message_id)
+        pipe.execute()
+
+    def decode_or_dead_letter(self, message_id, fields):
+        try:
+            return self.decode(fields)
+        except Exception:
+            logger.exception("could not decode %s", message_id)
+            self.dead_letter(message_id, fields)
+            return None
+
+    def dispatch(self, message_id, message) -> int:
+        if self.keyed_by_message_id and message.idempotency_key is None:
+            # a redelivered message is only handled again if it was never committed
+            message.idempotency_key = f"{self.stream}:{message_id.decode()}"
+        if self.workers is not None:
+            self.in_flight.add(message_id)
+            self.workers.submit(message_id, message)
+            return 1
+        if self.bus is None:
+            self.bus = self.bus_factory()
+        return self.process(self.bus, message_id, message)
+
+    def key_of(self, message):
+        return self.partition_key(message) if self.partition_key else None
+
+    def process(self, bus: messagebus.MessageBus, message_id, message) -> int:
+        # messages for a key are handled strictly in order, so a failing message is
+        # retried in place and the ones behind it for the same key have to wait
+        key = self.key_of(message)
+        try:
+            if key in self.held:
+                logger.info(
+                    "holding %s behind an earlier pending message", message_id
+                )
+                return 0
+            for attempt in range(1, self.max_deliveries + 1):
+                if self.handle(bus, message_id, message, attempt):
+                    return 1
+                if attempt < self.max_deliveries and self.stopping.wait(
+                    self.retry_ms * attempt / 1000
+                ):
+                    # leave it, and everything after it for its key, to be reclaimed
+                    self.held.add(key)
+                    return 0
+            stored = self.client.xrange(self.stream, min=message_id, max=message_id)
+            for _id, fields in stored or []:
+                self.dead_letter(message_id, fields)
+            return 0
+        finally:
+            self.in_flight.discard(message_id)
+
+    def handle(
+        self, bus: messagebus.MessageBus, message_id, message, attempt
+    ) -> bool:
+        logger.info("handling %s %s (attempt %d)", message_id, message, attempt)
+        try:
+            if self.admission:
+                with self.admission.admit(blocking=True):
+                    bus.handle(message)
+            else:
+                bus.handle(message)
+            self.client.xack(self.stream, self.group, message_id)
+            if self.on_processed:
+                self.on_processed()
+        except Exception:
+            logger.exception("failed handling %s", message_id)
+            return False
+        return True
+
+
+_STOP = object()
+
+
+class PartitionedWorkers:
+    def __init__(
+        self,
+        consumer: StreamConsumer,
+        workers: int,
+        queue_size: int,
+    ):
+        self.consumer = consumer
+        self.queues = [
+            queue.Queue(maxsize=queue_size) for _ in range(workers)
+        ]  # type: List[queue.Queue]
+        self.threads = [
+            threading.Thread(target=self.work, args=(q,), name=f"worker-{i}")
+            for i, q in enumerate(self.queues)
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, message_id, message):
+        key = str(self.consumer.key_of(message)).encode()
+        self.queues[zlib.crc32(key) % len(self.queues)].put((message_id, message))
 
-    for m in pubsub.listen():
-        handle_change_batch_quantity(m, bus)
+    def queued(self) -> int:
+        return sum(q.qsize() for q in self.queues)
 
+    def work(self, q: queue.Queue):
+        bus = self.consumer.bus_factory()
+        while True:
+            item = q.get()
+            if item is _STOP:
+                return
+            self.consumer.process(bus, *item)
 
-def handle_change_batch_quantity(m, bus):
-    logger.info("handling %s", m)
-    data = json.loads(m["data"])
-    cmd = commands.ChangeBatchQuantity(ref=data["batchref"], qty=data["qty"])
-    bus.handle(cmd)
+    def shutdown(self):
+        for q in self.queues:
+            q.put(_STOP)
+        for thread in self.threads:
+            thread.join()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,126 @@
+import contextlib
+import math
+import threading
+import time
+from typing import Dict, Iterator, Optional
+
+
+class Overloaded(Exception):
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class QueueFull(Overloaded):
+    pass
+
+
+class DeadlineExceeded(Overloaded):
+    pass
+
+
+class AdmissionController:
+    def __init__(
+        self,
+        limit: int = 16,
+        queue_size: int = 64,
+        queue_timeout: float = 1.0,
+        target_latency: Optional[float] = None,
+        min_limit: int = 1,
+        max_limit: Optional[int] = None,
+    ):
+        self.limit = float(limit)
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.target_latency = target_latency
+        self.min_limit = min_limit
+        self.max_limit = max_limit or limit * 4
+        self.in_flight = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.latency = None  # type: Optional[float]
+        self._cond = threading.Condition()
+
+    @contextlib.contextmanager
+    def admit(
+        self, arrived_at: Optional[float] = None, blocking: bool = False
+    ) -> Iterator[None]:
+        self._acquire(arrived_at, blocking)
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self._release(time.monotonic() - started)
+
+    def _acquire(self, arrived_at: Optional[float], blocking: bool):
+        with self._cond:
+            if self.in_flight >= self.current_limit:
+                if not blocking and self.waiting >= self.queue_size:
+                    self.rejected += 1
+                    raise QueueFull("too many requests queued", self.retry_after())
+                deadline = None
+                if not blocking:
+                    deadline = (arrived_at or time.monotonic()) + self.queue_timeout
+                self.waiting += 1
+                try:
+                    self._wait_for_slot(deadline)
+                finally:
+                    self.waiting -= 1
+            self.in_flight += 1
+            self.admitted += 1
+
+    def _wait_for_slot(self, deadline: Optional[float]):
+        while self.in_flight >= self.current_limit:
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                self.rejected += 1
+                raise DeadlineExceeded(
+                    "timed out waiting to be admitted", self.retry_after()
+                )
+            self._cond.wait(remaining)
+
+    def _release(self, latency: float):
+        with self._cond:
+            saturated = self.in_flight >= self.current_limit
+            self.in_flight -= 1
+            if self.latency is None:
+                self.latency = latency
+            else:
+                self.latency = 0.8 * self.latency + 0.2 * latency
+            if self.target_latency is not None:
+                self._adapt(latency, self.target_latency, saturated)
+            self._cond.notify()
+
+    def _adapt(self, latency: float, target_latency: float, saturated: bool):
+        # additive increase while we are using the whole limit and keeping up,
+        # multiplicative decrease as soon as the database starts falling behind
+        if latency > target_latency:
+            self.limit = max(self.min_limit, self.limit * 0.9)
+        elif saturated:
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+    @property
+    def current_limit(self) -> int:
+        return max(self.min_limit, int(self.limit))
+
+    def retry_after(self) -> int:
+        latency = self.latency if self.latency is not None else 1.0
+        return max(1, math.ceil(latency * (self.waiting + 1) / self.current_limit))
+
+    def under_pressure(self) -> bool:
+        # every slot being busy is just full use; commands queueing for one means
+        # the limit is holding work back
+        with self._cond:
+            return self.waiting > 0
+
+    def stats(self) -> Dict:
+        with self._cond:
+            return dict(
+                limit=self.current_limit,
+                in_flight=self.in_flight,
+                waiting=self.waiting,
+                admitted=self.admitted,
+                rejected=self.rejected,
+                latency=self.latency,
+            )
@@ -0,0 +1,81 @@
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional
+from allocation.domain import commands
+
+
+@dataclass
+class _Waiter:
+    cmd: commands.Allocate
+    wake: threading.Event = field(default_factory=threading.Event)
+    finished: bool = False
+    result: Optional[str] = None
+    error: Optional[Exception] = None
+
+
+class GroupCommitter:
+    def __init__(
+        self,
+        handle: Callable[[commands.Command], List],
+        window_seconds: float = 0.002,
+        max_batch: int = 100,
+    ):
+        self.handle = handle
+        self.window_seconds = window_seconds
+        self.max_batch = max_batch
+        self.commits = 0
+        self.allocations = 0
+        self._queues = {}  # type: Dict[str, List[_Waiter]]
+        self._lock = threading.Lock()
+
+    def allocate(self, cmd: commands.Allocate) -> Optional[str]:
+        waiter = _Waiter(cmd)
+        with self._lock:
+            queue = self._queues.setdefault(cmd.sku, [])
+            queue.append(waiter)
+            leader = len(queue) == 1
+        if not leader:
+            waiter.wake.wait()
+        if not waiter.finished:
+            self._lead(cmd.sku)
+        if waiter.error is not None:
+            raise waiter.error
+        return waiter.result
+
+    def _lead(self, sku: str):
+        # the batch stays at the head of its SKU's queue until it is committed, so
+        # later arrivals wait for the next leader instead of starting their own
+        time.sleep(self.window_seconds)
+        with self._lock:
+            queue = self._queues[sku]
+            batch = queue[: self.max_batch]
+        try:
+            self._commit(batch)
+        finally:
+            with self._lock:
+                del queue[: len(batch)]
+                if queue:
+                    queue[0].wake.set()
+                else:
+                    del self._queues[sku]
+
+    def _commit(self, batch: List[_Waiter]):
+        try:
+            [outcomes] = self.handle(commands.BulkAllocate([w.cmd for w in batch]))
+        except Exception as e:  # pylint: disable=broad-except
+            for waiter in batch:
+                waiter.error = e
+        else:
+            for waiter, outcome in zip(batch, outcomes):
+                if isinstance(outcome, Exception):
+                    waiter.error = outcome
+                else:
+                    waiter.result = outcome
+        finally:
+            with self._lock:
+                self.commits += 1
+                self.allocations += len(batch)
+            for waiter in batch:
+                waiter.finished = True
+                waiter.wake.set()
@@ -1,9 +1,14 @@
 # pylint: disable=unused-argument
 from __future__ import annotations
+import itertools
+from collections import defaultdict
 from dataclasses import asdict
-from typing import List, Dict, Callable, Type, TYPE_CHECKING
+from typing import List, Dict, Callable, Optional, Tuple, Type, Union, TYPE_CHECKING
+from sqlalchemy import text
 from allocation.domain import commands, events, model
 from allocation.domain.model import OrderLine
+from allocation.domain.policies import PolicyRegistry
+from allocation.service_layer.stock_hints import StockHints
 
 if TYPE_CHECKING:
     from allocation.adapters import notifications
@@ -14,49 +19,136 @@ class InvalidSku(Exception):
     pass
 
 
+# one row per order, SKU and batch, however many parts of a line the batch holds
+INSERT_ALLOCATION_VIEW = text("""
+    INSERT INTO allocations_view (orderid, sku, batchref)
+    SELECT :orderid, :sku, :batchref
+    WHERE NOT EXISTS (
+        SELECT 1 FROM allocations_view
+        WHERE orderid = :orderid AND sku = :sku AND batchref = :batchref
+    )
+    """)
+
+DELETE_ALLOCATION_VIEW = text("""
+    DELETE FROM allocations_view
+    WHERE orderid = :orderid AND sku = :sku AND batchref = :batchref
+    """)
+
+DELETE_ORDER_ALLOCATION_VIEW = text("""
+    DELETE FROM allocations_view
+    WHERE orderid = :orderid AND sku = :sku
+    """)
+
+
 def add_batch(
     cmd: commands.CreateBatch,
     uow: unit_of_work.AbstractUnitOfWork,
+    hints: StockHints = None,
 ):
     with uow:
         product = uow.products.get(sku=cmd.sku)
         if product is None:
             product = model.Product(cmd.sku, batches=[])
             uow.products.add(product)
-        product.batches.append(model.Batch(cmd.ref, cmd.sku, cmd.qty, cmd.eta))
+        product.add_batch(cmd.ref, cmd.qty, cmd.eta)
         uow.commit()
+    if hints:
+        hints.sku_added(cmd.sku)
 
 
 def allocate(
     cmd: commands.Allocate,
     uow: unit_of_work.AbstractUnitOfWork,
+    policies: PolicyRegistry = None,
+    hints: StockHints = None,
 ):
     line = OrderLine(cmd.orderid, cmd.sku, cmd.qty)
+    if hints:
+        if not hints.can_fit(line.sku, line.qty):
+            return None
+        if not hints.is_known(line.sku, uow):
+            raise InvalidSku(f"Invalid sku {line.sku}")
+    policy = policies.for_sku(line.sku) if policies is not None else None
     with uow:
         product = uow.products.get(sku=line.sku)
         if product is None:
             raise InvalidSku(f"Invalid sku {line.sku}")
-        product.allocate(line)
-        uow.commit()
+        batchref = product.allocate(line, policy)
+        if batchref is None and hints:
+            hints.record_capacity(line.sku, product.largest_allocatable(policy))
+        uow.commit(outcome=batchref)
+    return batchref
 
 
-def reallocate(
-    event: events.Deallocated,
+def bulk_allocate(
+    cmd: commands.BulkAllocate,
     uow: unit_of_work.AbstractUnitOfWork,
-):
-    allocate(commands.Allocate(**asdict(event)), uow=uow)
+    policies: PolicyRegistry = None,
+) -> List[Union[Optional[str], InvalidSku]]:
+    lines_by_sku = defaultdict(list)  # type: Dict[str, List[int]]
+    for i, line_cmd in enumerate(cmd.lines):
+        lines_by_sku[line_cmd.sku].append(i)
+
+    # no stock hints here: each SKU's product is loaded once for all of its lines
+    outcomes = [None] * len(cmd.lines)  # type: List[Union[Optional[str], InvalidSku]]
+    with uow:
+        for sku, indexes in lines_by_sku.items():
+            product = uow.products.get(sku=sku)
+            policy = policies.for_sku(sku) if policies is not None else None
+            for i in indexes:
+                if product is None:
+                    outcomes[i] = InvalidSku(f"Invalid sku {sku}")
+                    continue
+                line_cmd = cmd.lines[i]
+                outcomes[i] = product.allocate(
+                    OrderLine(line_cmd.orderid, line_cmd.sku, line_cmd.qty), policy
+                )
+        uow.commit()
+    return outcomes
 
 
 def change_batch_quantity(
     cmd: commands.ChangeBatchQuantity,
     uow: unit_of_work.AbstractUnitOfWork,
+    policies: PolicyRegistry = None,
+    hints: StockHints = None,
 ):
     with uow:
         product = uow.products.get_by_batchref(batchref=cmd.ref)
-        product.change_batch_quantity(ref=cmd.ref, qty=cmd.qty)
+        policy = policies.for_sku(product.sku) if policies is not None else None
+        product.change_batch_quantity(ref=cmd.ref, qty=cmd.qty, policy=policy)
+        if hints:
+            hints.stock_changed(product.sku)
+        uow.commit()
+
+
+def split_stock(
+    cmd: commands.SplitStock,
+    uow: unit_of_work.AbstractUnitOfWork,
+):
+    with uow:
+        product = uow.products.get(sku=cmd.sku)
+        if product is None:
+            raise InvalidSku(f"Invalid sku {cmd.sku}")
+        product.split_stock(cmd.buckets)
         uow.commit()
 
 
+def archive_consumed_batches(
+    cmd: commands.ArchiveConsumedBatches,
+    uow: unit_of_work.AbstractUnitOfWork,
+) -> int:
+    with uow:
+        product = uow.products.get(sku=cmd.sku)
+        if product is None:
+            return 0
+        archived = product.archive_consumed(cmd.arrived_before)
+        if archived:
+            uow.products.archive(archived)
+        uow.commit()
+    return len(archived)
+
+
 # pylint: disable=unused-argument
 
 
@@ -70,6 +162,13 @@ def send_out_of_stock_notification(
     )
 
 
+def clear_stock_hint(
+    event: events.Deallocated,
+    hints: StockHints,
+):
+    hints.stock_changed(event.sku)
+
+
 def publish_allocated_event(
     event: events.Allocated,
     publish: Callable,
@@ -77,44 +176,48 @@ def publish_allocated_event(
     publish("line_allocated", event)
 
 
-def add_allocation_to_read_model(
-    event: events.Allocated,
+def update_allocations_view(
+    allocation_events: List[Union[events.Allocated, events.Deallocated]],
     uow: unit_of_work.SqlAlchemyUnitOfWork,
 ):
+    # one transaction for all of a message's allocation changes, so a quantity cut
+    # that evicts and reallocates N lines does not cost 2N commits
     with uow:
-        uow.session.execute(
-            """
-            INSERT INTO allocations_view (orderid, sku, batchref)
-            VALUES (:orderid, :sku, :batchref)
-            """,
-            dict(orderid=event.orderid, sku=event.sku, batchref=event.batchref),
-        )
+        for statement, group in itertools.groupby(
+            allocation_events, key=allocations_view_statement
+        ):
+            uow.session.execute(statement, [asdict(event) for event in group])
         uow.commit()
 
 
-def remove_allocation_from_read_model(
-    event: events.Deallocated,
-    uow: unit_of_work.SqlAlchemyUnitOfWork,
-):
-    with uow:
-        uow.session.execute(
-            """
-            DELETE FROM allocations_view
-            WHERE orderid = :orderid AND sku = :sku
-            """,
-            dict(orderid=event.orderid, sku=event.sku),
-        )
-        uow.commit()
+def allocations_view_statement(event: Union[events.Allocated, events.Deallocated]):
+    if isinstance(event, events.Allocated):
+        return INSERT_ALLOCATION_VIEW
+    # a split line has a row per batch, so only the evicted part's row goes
+    if event.batchref is None:
+        return DELETE_ORDER_ALLOCATION_VIEW
+    return DELETE_ALLOCATION_VIEW
 
 
 EVENT_HANDLERS = {
-    events.Allocated: [publish_allocated_event, add_allocation_to_read_model],
-    events.Deallocated: [remove_allocation_from_read_model, reallocate],
+    events.Allocated: [publish_allocated_event],
+    events.Deallocated: [clear_stock_hint],
+    events.AllocationArchived: [],
     events.OutOfStock: [send_out_of_stock_notification],
+    events.BatchCreated: [],
+    events.BatchQuantityChanged: [],
+    events.StockSplit: [],
 }  # type: Dict[Type[events.Event], List[Callable]]
 
+BATCHED_EVENT_HANDLERS = [
+    ((events.Allocated, events.Deallocated), update_allocations_view),
+]  # type: List[Tuple[Tuple[Type[events.Event], ...], Callable]]
+
 COMMAND_HANDLERS = {
     commands.Allocate: allocate,
+    commands.BulkAllocate: bulk_allocate,
     commands.CreateBatch: add_batch,
     commands.ChangeBatchQuantity: change_batch_quantity,
+    commands.ArchiveConsumedBatches: archive_consumed_batches,
+    commands.SplitStock: split_stock,
 }  # type: Dict[Type[commands.Command], Callable]
@@ -0,0 +1,119 @@
+import contextlib
+import logging
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Any, Callable, Optional, Tuple
+from sqlalchemy import and_, delete, insert, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session, sessionmaker
+from allocation.adapters import orm
+
+logger = logging.getLogger(__name__)
+
+
+class DuplicateCommand(Exception):
+    def __init__(self, key: str, stored: Optional[Tuple[Any]] = None):
+        super().__init__(key)
+        self.stored = stored
+
+
+class IdempotencyStore:
+    def __init__(
+        self,
+        session_factory: Optional[sessionmaker] = None,
+        ttl_seconds: float = 86400,
+        cache_size: int = 10000,
+        purge_every: int = 1000,
+        clock: Callable[[], datetime] = datetime.now,
+    ):
+        self.session_factory = session_factory
+        self.ttl = timedelta(seconds=ttl_seconds)
+        self.cache_size = cache_size
+        self.purge_every = purge_every
+        self.clock = clock
+        self.hits = 0
+        self.recorded = 0
+        self.claimed = 0
+        self._cache = OrderedDict()  # type: OrderedDict[str, Tuple[datetime, Any]]
+        self._lock = threading.Lock()
+
+    def lookup(self, key: str) -> Optional[Tuple[Any]]:
+        cutoff = self.clock() - self.ttl
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached is not None and cached[0] >= cutoff:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return (cached[1],)
+        if self.session_factory is None:
+            return None
+        keys = orm.idempotency_keys.c
+        with contextlib.closing(self.session_factory()) as session:
+            row = session.execute(
+                select(keys.outcome, keys.created_at).where(
+                    keys.key == key, keys.created_at >= cutoff
+                )
+            ).first()
+        if row is None:
+            return None
+        self._remember(key, row.created_at, row.outcome)
+        with self._lock:
+            self.hits += 1
+        return (row.outcome,)
+
+    def claim(self, key: str, session: Session, outcome: Any):
+        # written with the outcome in the handler's own transaction, so the key is
+        # claimed exactly when the changes commit, and of two concurrent duplicates
+        # only one can. An expired claim is replaced. The session may be a shard's,
+        # which purge() does not reach, so it is swept now and then
+        keys = orm.idempotency_keys
+        now = self.clock()
+        with self._lock:
+            self.claimed += 1
+            sweep = self.claimed % self.purge_every == 0
+        expired = keys.c.created_at < now - self.ttl
+        session.execute(
+            delete(keys).where(expired if sweep else and_(keys.c.key == key, expired))
+        )
+        try:
+            with session.begin_nested():
+                session.execute(
+                    insert(keys).values(key=key, outcome=outcome, created_at=now)
+                )
+        except IntegrityError as e:
+            # read from the claiming session, as a shard's keys are not in ours
+            stored = session.execute(
+                select(keys.c.outcome).where(keys.c.key == key)
+            ).first()
+            raise DuplicateCommand(key, stored and (stored.outcome,)) from e
+
+    def record(self, key: str, outcome: Any):
+        # the row was written by claim(), so this only keeps it in memory
+        self._remember(key, self.clock(), outcome)
+        with self._lock:
+            self.recorded += 1
+            purge = self.recorded % self.purge_every == 0
+        if purge:
+            self.purge()
+
+    def purge(self) -> int:
+        cutoff = self.clock() - self.ttl
+        with self._lock:
+            for key in [k for k, (at, _) in self._cache.items() if at < cutoff]:
+                del self._cache[key]
+        if self.session_factory is None:
+            return 0
+        keys = orm.idempotency_keys
+        with contextlib.closing(self.session_factory()) as session:
+            purged = session.execute(delete(keys).where(keys.c.created_at < cutoff))
+            session.commit()
+        logger.info("purged %d expired idempotency keys", purged.rowcount)
+        return purged.rowcount
+
+    def _remember(self, key: str, at: datetime, outcome: Any):
+        with self._lock:
+            self._cache[key] = (at, outcome)
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
@@ -1,15 +1,43 @@
 # pylint: disable=broad-except, attribute-defined-outside-init
 from __future__ import annotations
+import contextlib
+import contextvars
+import functools
 import logging
-from typing import Callable, Dict, List, Union, Type, TYPE_CHECKING
+from typing import (
+    Any,
+    Callable,
+    ContextManager,
+    Dict,
+    List,
+    Optional,
+    Tuple,
+    Union,
+    Type,
+    TYPE_CHECKING,
+)
 from allocation.domain import commands, events
+from . import tracing
+from .idempotency import DuplicateCommand
 
 if TYPE_CHECKING:
+    from sqlalchemy.orm import Session
     from . import unit_of_work
+    from .idempotency import IdempotencyStore
 
 logger = logging.getLogger(__name__)
 
 Message = Union[commands.Command, events.Event]
+BatchedHandlers = List[Tuple[Tuple[Type[events.Event], ...], Callable]]
+
+current_message = contextvars.ContextVar(
+    "current_message", default=None
+)  # type: contextvars.ContextVar[Optional[Message]]
+
+# per thread, as several request threads can share one bus and unit of work
+current_claim = contextvars.ContextVar(
+    "current_claim", default=None
+)  # type: contextvars.ContextVar[Optional[Callable[[Session, Any], None]]]
 
 
 class MessageBus:
@@ -18,38 +46,127 @@ class MessageBus:
         uow: unit_of_work.AbstractUnitOfWork,
         event_handlers: Dict[Type[events.Event], List[Callable]],
         command_handlers: Dict[Type[commands.Command], Callable],
+        publish_buffer: Callable[[], ContextManager] = contextlib.nullcontext,
+        idempotency: IdempotencyStore = None,
+        batched_event_handlers: BatchedHandlers = None,
     ):
         self.uow = uow
         self.event_handlers = event_handlers
         self.command_handlers = command_handlers
+        self.batched_event_handlers = batched_event_handlers or []
+        self.publish_buffer = publish_buffer
+        self.idempotency = idempotency
 
-    def handle(self, message: Message):
+    def handle(self, message: Message) -> List:
+        results = []
         self.queue = [message]
-        while self.queue:
-            message = self.queue.pop(0)
-            if isinstance(message, events.Event):
-                self.handle_event(message)
-            elif isinstance(message, commands.Command):
-                self.handle_command(message)
-            else:
-                raise Exception(f"{message} was not an Event or Command")
+        self.batches = [
+            [] for _ in self.batched_event_handlers
+        ]  # type: List[List[events.Event]]
+        with self.publish_buffer():
+            while self.queue:
+                message = self.queue.pop(0)
+                if isinstance(message, events.Event):
+                    self.handle_event(message)
+                elif isinstance(message, commands.Command):
+                    results.append(self.handle_command(message))
+                else:
+                    raise Exception(f"{message} was not an Event or Command")
+            self.handle_batches()
+        return results
 
     def handle_event(self, event: events.Event):
         for handler in self.event_handlers[type(event)]:
             try:
                 logger.debug("handling event %s with handler %s", event, handler)
-                handler(event)
-                self.queue.extend(self.uow.collect_new_events())
+                with self.handling(event, handler) as span:
+                    handler(event)
+                    self.queue.extend(self.caused_by(event, span))
             except Exception:
                 logger.exception("Exception handling event %s", event)
                 continue
+        for (event_types, _), batch in zip(self.batched_event_handlers, self.batches):
+            if isinstance(event, event_types):
+                batch.append(event)
+
+    def handle_batches(self):
+        # handlers that take every matching event the message caused, in order
+        for (_, handler), batch in zip(self.batched_event_handlers, self.batches):
+            if not batch:
+                continue
+            try:
+                logger.debug(
+                    "handling %d events with handler %s", len(batch), handler
+                )
+                with self.handling(batch[0], handler):
+                    handler(batch)
+            except Exception:
+                logger.exception("Exception handling events %s", batch)
 
     def handle_command(self, command: commands.Command):
         logger.debug("handling command %s", command)
+        key = getattr(command, "idempotency_key", None)
+        if not key or self.idempotency is None:
+            return self.run_handler(command)
+        stored = self.idempotency.lookup(key)
+        if stored is not None:
+            logger.info("already handled %s, returning its outcome", command)
+            return stored[0]
+        # claimed in the same transaction as the handler's own changes
+        token = current_claim.set(functools.partial(self.idempotency.claim, key))
+        try:
+            result = self.run_handler(command)
+        except DuplicateCommand as e:
+            stored = e.stored or self.idempotency.lookup(key)
+            if stored is None:
+                logger.info("a concurrent duplicate of %s is in progress", command)
+                raise
+            logger.info("a concurrent duplicate of %s got there first", command)
+            return stored[0]
+        finally:
+            current_claim.reset(token)
+        self.idempotency.record(key, result)
+        return result
+
+    def run_handler(self, command: commands.Command):
         try:
             handler = self.command_handlers[type(command)]
-            handler(command)
-            self.queue.extend(self.uow.collect_new_events())
+            with self.handling(command, handler) as span:
+                result = handler(command)
+                self.queue.extend(self.caused_by(command, span))
+        except DuplicateCommand:
+            raise
         except Exception:
             logger.exception("Exception handling command %s", command)
             raise
+        return result
+
+    @contextlib.contextmanager
+    def handling(self, message: Message, handler: Callable):
+        context = tracing.ensure_context(message)
+        handler_name = getattr(getattr(handler, "func", handler), "__name__", "")
+        attributes = {
+            "messaging.message.id": context.message_id,
+            "messaging.message.conversation_id": context.correlation_id,
+            "message.type": type(message).__name__,
+            "message.causation_id": context.causation_id or "",
+            "code.function": handler_name,
+        }
+        token = current_message.set(message)
+        try:
+            with tracing.tracer.span(
+                f"handle {type(message).__name__}",
+                attributes,
+                trace_id=context.trace_id,
+                parent_span_id=context.parent_span_id,
+            ) as span:
+                yield span
+        finally:
+            current_message.reset(token)
+
+    def caused_by(self, message: Message, span: tracing.Span) -> List[Message]:
+        context = tracing.ensure_context(message)
+        return [
+            tracing.attach(event, context.caused(span.span_id))
+            for event in self.uow.collect_new_events()
+        ]
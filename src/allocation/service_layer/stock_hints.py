@@ -0,0 +1,80 @@
+from __future__ import annotations
+import threading
+import time
+from typing import Callable, Dict, Optional, Set, Tuple, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from . import unit_of_work
+
+
+class StockHints:
+    def __init__(
+        self,
+        refresh_seconds: float = 60,
+        ttl_seconds: float = 0,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.refresh_seconds = refresh_seconds
+        self.ttl_seconds = ttl_seconds
+        self.clock = clock
+        self.known_skus = set()  # type: Set[str]
+        self.fast_rejections = 0
+        self._refreshed_at = None  # type: Optional[float]
+        self._capacity = {}  # type: Dict[str, Tuple[int, float]]
+        self._lock = threading.Lock()
+
+    def is_known(self, sku: str, uow: unit_of_work.AbstractUnitOfWork) -> bool:
+        with self._lock:
+            if sku in self.known_skus:
+                return True
+            stale = self._refreshed_at is None or (
+                self.clock() - self._refreshed_at > self.refresh_seconds
+            )
+        if stale:
+            self.refresh(uow)
+            with self._lock:
+                return sku in self.known_skus
+        with uow:
+            exists = uow.products.exists(sku)
+        if exists:
+            with self._lock:
+                self.known_skus.add(sku)
+        return exists
+
+    def refresh(self, uow: unit_of_work.AbstractUnitOfWork):
+        with uow:
+            skus = set(uow.products.skus())
+        with self._lock:
+            self.known_skus |= skus
+            self._refreshed_at = self.clock()
+
+    def can_fit(self, sku: str, qty: int) -> bool:
+        with self._lock:
+            hint = self._capacity.get(sku)
+            if hint is None:
+                return True
+            capacity, expires_at = hint
+            if self.clock() >= expires_at:
+                del self._capacity[sku]
+                return True
+            if qty <= capacity:
+                return True
+            self.fast_rejections += 1
+            return False
+
+    def record_capacity(self, sku: str, capacity: int):
+        # only this process's stock changes clear a hint, so they are opt-in and
+        # should live no longer than other processes can be allowed to be ignored
+        if not self.ttl_seconds:
+            return
+        with self._lock:
+            self._capacity[sku] = (capacity, self.clock() + self.ttl_seconds)
+
+    def stock_changed(self, sku: str):
+        with self._lock:
+            self._capacity.pop(sku, None)
+
+    def sku_added(self, sku: str):
+        with self._lock:
+            self.known_skus.add(sku)
+            self._capacity.pop(sku, None)
@@ -0,0 +1,219 @@
+# pylint: disable=broad-except
+from __future__ import annotations
+import contextlib
+import contextvars
+import json
+import logging
+import os
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterator, List, Optional
+
+from allocation import config
+
+logger = logging.getLogger(__name__)
+
+SERVICE_NAME = "allocation"
+
+_current_span = contextvars.ContextVar(
+    "current_span", default=None
+)  # type: contextvars.ContextVar[Optional[Span]]
+
+
+def new_trace_id() -> str:
+    return os.urandom(16).hex()
+
+
+def new_span_id() -> str:
+    return os.urandom(8).hex()
+
+
+@dataclass(frozen=True)
+class TraceContext:
+    trace_id: str
+    message_id: str
+    correlation_id: str
+    causation_id: Optional[str] = None
+    parent_span_id: Optional[str] = None
+
+    def caused(self, parent_span_id: Optional[str]) -> TraceContext:
+        return TraceContext(
+            trace_id=self.trace_id,
+            message_id=new_span_id(),
+            correlation_id=self.correlation_id,
+            causation_id=self.message_id,
+            parent_span_id=parent_span_id,
+        )
+
+
+def root_context() -> TraceContext:
+    message_id = new_span_id()
+    span = _current_span.get()
+    if span is None:
+        return TraceContext(new_trace_id(), message_id, message_id)
+    return TraceContext(span.trace_id, message_id, message_id, None, span.span_id)
+
+
+def context_of(message) -> Optional[TraceContext]:
+    return getattr(message, "_trace", None)
+
+
+def attach(message, context: TraceContext):
+    message._trace = context  # pylint: disable=protected-access
+    return message
+
+
+def ensure_context(message) -> TraceContext:
+    context = context_of(message)
+    if context is None:
+        context = root_context()
+        attach(message, context)
+    return context
+
+
+@dataclass
+class Span:
+    name: str
+    trace_id: str
+    span_id: str
+    parent_span_id: Optional[str]
+    start_time_ns: int
+    end_time_ns: Optional[int] = None
+    attributes: Dict[str, Any] = field(default_factory=dict)
+    error: Optional[str] = None
+
+    @property
+    def duration_ns(self) -> int:
+        return (self.end_time_ns or time.time_ns()) - self.start_time_ns
+
+    def to_otlp(self) -> Dict:
+        span = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": 1,
+            "startTimeUnixNano": str(self.start_time_ns),
+            "endTimeUnixNano": str(self.end_time_ns),
+            "attributes": [
+                {"key": key, "value": _otlp_value(value)}
+                for key, value in self.attributes.items()
+            ],
+            "status": (
+                {"code": 2, "message": self.error} if self.error else {"code": 1}
+            ),
+        }
+        if self.parent_span_id:
+            span["parentSpanId"] = self.parent_span_id
+        return span
+
+
+def _otlp_value(value) -> Dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+class InMemorySpanExporter:
+    def __init__(self):
+        self.spans = []  # type: List[Span]
+        self._lock = threading.Lock()
+
+    def export(self, span: Span):
+        with self._lock:
+            self.spans.append(span)
+
+    def clear(self):
+        with self._lock:
+            self.spans.clear()
+
+    def named(self, name: str) -> List[Span]:
+        return [s for s in self.spans if s.name == name]
+
+
+class OtlpJsonFileExporter:
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def export(self, span: Span):
+        line = json.dumps(
+            {
+                "resourceSpans": [
+                    {
+                        "resource": {
+                            "attributes": [
+                                {
+                                    "key": "service.name",
+                                    "value": {"stringValue": SERVICE_NAME},
+                                }
+                            ]
+                        },
+                        "scopeSpans": [
+                            {"scope": {"name": __name__}, "spans": [span.to_otlp()]}
+                        ],
+                    }
+                ]
+            }
+        )
+        with self._lock, open(self.path, "a") as f:
+            f.write(line + "\n")
+
+
+class Tracer:
+    def __init__(self, exporters: List = None):
+        self.exporters = list(exporters or [])
+
+    @contextlib.contextmanager
+    def span(
+        self,
+        name: str,
+        attributes: Dict[str, Any] = None,
+        trace_id: str = None,
+        parent_span_id: str = None,
+    ) -> Iterator[Span]:
+        if trace_id is None:
+            parent = _current_span.get()
+            trace_id = parent.trace_id if parent else new_trace_id()
+            parent_span_id = parent.span_id if parent else None
+        span = Span(
+            name=name,
+            trace_id=trace_id,
+            span_id=new_span_id(),
+            parent_span_id=parent_span_id,
+            start_time_ns=time.time_ns(),
+            attributes=dict(attributes or {}),
+        )
+        token = _current_span.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            _current_span.reset(token)
+            span.end_time_ns = time.time_ns()
+            self._export(span)
+
+    def _export(self, span: Span):
+        for exporter in self.exporters:
+            try:
+                exporter.export(span)
+            except Exception:
+                logger.exception("could not export span %s", span.name)
+
+
+def current_span() -> Optional[Span]:
+    return _current_span.get()
+
+
+def tracer_from_config() -> Tracer:
+    path = config.get_trace_export_path()
+    return Tracer([OtlpJsonFileExporter(path)] if path else [])
+
+
+tracer = tracer_from_config()
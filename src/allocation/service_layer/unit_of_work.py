@@ -1,13 +1,21 @@
 # pylint: disable=attribute-defined-outside-init
 from __future__ import annotations
 import abc
-from sqlalchemy import create_engine
+import logging
+import threading
+import time
+from typing import Any, Callable, Dict, Iterator, Optional
+from sqlalchemy import create_engine, text
+from sqlalchemy.pool import QueuePool
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.orm.session import Session
 
 
 from allocation import config
-from allocation.adapters import repository
+from allocation.adapters import repository, sharding, sql_profiling
+from allocation.service_layer import messagebus, tracing
+
+logger = logging.getLogger(__name__)
 
 
 class AbstractUnitOfWork(abc.ABC):
@@ -19,8 +27,17 @@ class AbstractUnitOfWork(abc.ABC):
     def __exit__(self, *args):
         self.rollback()
 
-    def commit(self):
-        self._commit()
+    def commit(self, outcome: Any = None):
+        # a keyed command's outcome is claimed in the transaction it describes
+        with tracing.tracer.span("uow.commit"):
+            claim = messagebus.current_claim.get()
+            if claim is not None:
+                messagebus.current_claim.set(None)
+                self._claim(claim, outcome)
+            self._commit()
+
+    def _claim(self, claim: Callable[[Session, Any], None], outcome: Any):
+        pass
 
     def collect_new_events(self):
         for product in self.products.seen:
@@ -36,29 +53,222 @@ class AbstractUnitOfWork(abc.ABC):
         raise NotImplementedError
 
 
-DEFAULT_SESSION_FACTORY = sessionmaker(
-    bind=create_engine(
-        config.get_postgres_uri(),
-        isolation_level="REPEATABLE READ",
+def default_session_factory() -> sessionmaker:
+    return sessionmaker(
+        bind=create_engine(
+            config.get_postgres_uri(),
+            isolation_level="REPEATABLE READ",
+            **config.get_db_pool_options(),
+        )
     )
-)
+
+
+DEFAULT_SESSION_FACTORY = default_session_factory()
+
+
+def default_shard_router() -> Optional[sharding.ShardRouter]:
+    uris = config.get_shard_uris()
+    if not uris:
+        return None
+    return sharding.ShardRouter(
+        [
+            sessionmaker(
+                bind=create_engine(
+                    uri,
+                    isolation_level="REPEATABLE READ",
+                    **config.get_db_pool_options(),
+                )
+            )
+            for uri in uris
+        ]
+    )
+
+
+DEFAULT_SHARDS = default_shard_router()
+
+
+DEFAULT_PROFILER = sql_profiling.profiler_from_config()
+
+EVENT_SOURCING = config.get_event_sourcing_settings()
 
 
 class SqlAlchemyUnitOfWork(AbstractUnitOfWork):
-    def __init__(self, session_factory=DEFAULT_SESSION_FACTORY):
+    def __init__(
+        self,
+        session_factory=DEFAULT_SESSION_FACTORY,
+        profiler: Optional[sql_profiling.SqlProfiler] = DEFAULT_PROFILER,
+        shards: Optional[sharding.ShardRouter] = DEFAULT_SHARDS,
+        event_sourced: bool = EVENT_SOURCING["event_sourced"],
+        snapshot_every: int = EVENT_SOURCING["snapshot_every"],
+    ):
+        if shards and event_sourced:
+            raise ValueError("event-sourced products cannot be sharded yet")
         self.session_factory = session_factory
+        self.profiler = profiler
+        self.shards = shards
+        self.event_sourced = event_sourced
+        self.snapshot_every = snapshot_every
+        self.profile = None  # type: Optional[sql_profiling.UowProfile]
 
     def __enter__(self):
+        if self.profiler:
+            self._profiling = self.profiler.profile(messagebus.current_message.get())
+            self.profile = self._profiling.__enter__()
         self.session = self.session_factory()  # type: Session
-        self.products = repository.SqlAlchemyRepository(self.session)
+        if self.shards:
+            self.products = repository.ShardedRepository(self.shards, self.session)
+        elif self.event_sourced:
+            self.products = repository.EventSourcedRepository(
+                self.session, self.snapshot_every
+            )
+        else:
+            self.products = repository.SqlAlchemyRepository(self.session)
         return super().__enter__()
 
     def __exit__(self, *args):
-        super().__exit__(*args)
-        self.session.close()
+        try:
+            super().__exit__(*args)
+            self.session.close()
+            self.products.close()
+        finally:
+            if self.profiler:
+                self._profiling.__exit__(*args)
+
+    def product_sessions(self) -> Iterator[Session]:
+        if self.shards:
+            yield from self.shards.each_shard()
+        else:
+            yield self.session
+
+    def _claim(self, claim, outcome):
+        # in the session that commits the product, so a failed commit leaves the
+        # key unclaimed; a sharded one is only pinned once used
+        claim(getattr(self.products, "session", None) or self.session, outcome)
 
     def _commit(self):
+        self.products.commit()
         self.session.commit()
 
     def rollback(self):
+        self.products.rollback()
         self.session.rollback()
+
+
+def default_read_session_factory() -> sessionmaker:
+    return sessionmaker(
+        bind=create_engine(
+            config.get_replica_uri(),
+            isolation_level="REPEATABLE READ",
+            execution_options={"postgresql_readonly": True},
+            **config.get_read_pool_options(),
+        )
+    )
+
+
+DEFAULT_READ_SESSION_FACTORY = default_read_session_factory()
+
+
+REPLICA_LAG = text("""
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() THEN 0
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+    END
+    """)
+
+
+def postgres_replica_lag(session: Session) -> float:
+    return session.execute(REPLICA_LAG).scalar()
+
+
+def pool_stats(session_factory: sessionmaker) -> Dict:
+    pool = session_factory.kw["bind"].pool
+    if not isinstance(pool, QueuePool):
+        return dict(status=pool.status())
+    return dict(
+        size=pool.size(),
+        checked_out=pool.checkedout(),
+        overflow=pool.overflow(),
+        idle=pool.checkedin(),
+    )
+
+
+class ReadOnlyUnitOfWork:
+    def __init__(
+        self,
+        session_factory=DEFAULT_READ_SESSION_FACTORY,
+        primary_session_factory=DEFAULT_SESSION_FACTORY,
+        max_lag_seconds: Optional[float] = None,
+        lag_check_seconds: float = 1.0,
+        lag_probe: Callable[[Session], float] = postgres_replica_lag,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.session_factory = session_factory
+        self.primary_session_factory = primary_session_factory
+        self.max_lag_seconds = max_lag_seconds
+        self.lag_check_seconds = lag_check_seconds
+        self.lag_probe = lag_probe
+        self.clock = clock
+        self.replica_reads = 0
+        self.primary_fallbacks = 0
+        self._lag = None  # type: Optional[float]
+        self._lag_checked_at = None  # type: Optional[float]
+        self._lock = threading.Lock()
+        self._lag_lock = threading.Lock()
+        self._local = threading.local()
+
+    # one instance is shared by all request threads, so the session is per thread
+    @property
+    def session(self) -> Session:
+        return self._local.session
+
+    def __enter__(self) -> ReadOnlyUnitOfWork:
+        fresh = self.replica_is_fresh()
+        with self._lock:
+            if fresh:
+                self.replica_reads += 1
+            else:
+                self.primary_fallbacks += 1
+        factory = self.session_factory if fresh else self.primary_session_factory
+        self._local.session = factory()
+        return self
+
+    def __exit__(self, *args):
+        self.session.rollback()
+        self.session.close()
+
+    def replica_is_fresh(self) -> bool:
+        if self.max_lag_seconds is None:
+            return True
+        lag = self.replica_lag()
+        return lag is not None and lag <= self.max_lag_seconds
+
+    def replica_lag(self) -> Optional[float]:
+        with self._lag_lock:
+            now = self.clock()
+            if (
+                self._lag_checked_at is None
+                or now - self._lag_checked_at >= self.lag_check_seconds
+            ):
+                self._lag_checked_at = now
+                self._lag = self._probe_lag()
+            return self._lag
+
+    def _probe_lag(self) -> Optional[float]:
+        session = self.session_factory()
+        try:
+            return self.lag_probe(session)
+        except Exception:  # pylint: disable=broad-except
+            logger.exception("could not read replica lag, reading from the primary")
+            return None
+        finally:
+            session.close()
+
+    def stats(self) -> Dict:
+        return dict(
+            replica=pool_stats(self.session_factory),
+            primary=pool_stats(self.primary_session_factory),
+            replica_reads=self.replica_reads,
+            primary_fallbacks=self.primary_fallbacks,
+            replica_lag=self._lag,
+        )
@@ -1,12 +1,36 @@
+from sqlalchemy import text
+from allocation.adapters import event_store
 from allocation.service_layer import unit_of_work
 
+ALLOCATIONS = text(
+    "SELECT sku, batchref FROM allocations_view WHERE orderid = :orderid"
+)
 
-def allocations(orderid: str, uow: unit_of_work.SqlAlchemyUnitOfWork):
+COMPACTION_CANDIDATES = text("""
+    SELECT DISTINCT b.sku FROM batches AS b
+    JOIN allocations AS a ON a.batch_id = b.id
+    WHERE b.eta IS NULL OR b.eta < :arrived_before
+    """)
+
+
+def allocations(orderid: str, uow: unit_of_work.ReadOnlyUnitOfWork):
+    with uow:
+        results = uow.session.execute(ALLOCATIONS, dict(orderid=orderid))
+        return [dict(r) for r in results]
+
+
+def compaction_candidates(arrived_before, uow: unit_of_work.SqlAlchemyUnitOfWork):
     with uow:
-        results = uow.session.execute(
-            """
-            SELECT sku, batchref FROM allocations_view WHERE orderid = :orderid
-            """,
-            dict(orderid=orderid),
-        )
-    return [dict(r) for r in results]
+        if uow.event_sourced:
+            # batch quantities live in the event log, so this may include
+            # products with nothing left to archive
+            return event_store.skus_with_batches_arrived_before(
+                uow.session, arrived_before
+            )
+        return [
+            sku
+            for session in uow.product_sessions()
+            for sku, in session.execute(
+                COMPACTION_CANDIDATES, dict(arrived_before=arrived_before)
+            )
+        ]
@@ -0,0 +1,16 @@
+import pytest
+from allocation import bootstrap
+from ..unit.test_handlers import FakeNotifications, FakeUnitOfWork
+
+
+@pytest.fixture
+def fake_bus_factory():
+    def new_bus():
+        return bootstrap.bootstrap(
+            start_orm=False,
+            uow=FakeUnitOfWork(),
+            notifications=FakeNotifications(),
+            publish=lambda *args: None,
+        )
+
+    return new_bus
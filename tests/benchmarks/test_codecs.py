@@ -0,0 +1,22 @@
+import json
+from dataclasses import asdict
+import pytest
+from allocation.adapters import codecs
+from allocation.domain import events
+
+EVENT = events.Allocated("order-123", "SMALL-TABLE", 10, "batch-001")
+
+
+def test_asdict_json_encode(benchmark):
+    benchmark(lambda: json.dumps(asdict(EVENT)).encode())
+
+
+@pytest.mark.parametrize("name", codecs.CODECS.keys())
+def test_encode(benchmark, name):
+    benchmark(codecs.get_codec(name).encode, EVENT)
+
+
+@pytest.mark.parametrize("name", codecs.CODECS.keys())
+def test_decode(benchmark, name):
+    payload = codecs.get_codec(name).encode(EVENT)
+    assert benchmark(codecs.decode, payload) == EVENT
@@ -0,0 +1,68 @@
+from datetime import date, timedelta
+import pytest
+from allocation.domain import commands
+from allocation.domain.model import Batch, OrderLine, Product
+from allocation.domain.policies import POLICIES
+
+today = date.today()
+
+
+def make_product(sku, batches, lines_per_batch, qty=1000):
+    product = Product(
+        sku,
+        [
+            Batch(f"b{i}", sku, qty, eta=today + timedelta(days=i))
+            for i in range(batches)
+        ],
+    )
+    for batch in product.batches:
+        for j in range(lines_per_batch):
+            batch.allocate(OrderLine(f"{batch.reference}-o{j}", sku, 1))
+    return product
+
+
+@pytest.mark.parametrize("batches", [1, 10, 100, 1000])
+@pytest.mark.parametrize("lines_per_batch", [0, 10])
+def test_allocate(benchmark, batches, lines_per_batch):
+    def setup():
+        product = make_product("LAMP", batches, lines_per_batch, qty=lines_per_batch)
+        product.batches[-1]._purchased_quantity += 1
+        return (product, OrderLine("new-order", "LAMP", 1)), {}
+
+    benchmark.pedantic(lambda p, line: p.allocate(line), setup=setup, rounds=50)
+
+
+@pytest.mark.parametrize("policy", POLICIES.values(), ids=POLICIES.keys())
+def test_allocate_many_lines_to_one_product(benchmark, policy):
+    def setup():
+        product = make_product("LAMP", 1000, 0, qty=10)
+        lines = [OrderLine(f"o{i}", "LAMP", 1 + i % 3) for i in range(1000)]
+        return (product, lines), {}
+
+    def allocate_all(product, lines):
+        for line in lines:
+            product.allocate(line, policy)
+
+    benchmark.pedantic(allocate_all, setup=setup, rounds=10)
+
+
+@pytest.mark.parametrize("evicted", [1, 10, 100])
+def test_change_batch_quantity_cascade(benchmark, fake_bus_factory, evicted):
+    def setup():
+        bus = fake_bus_factory()
+        bus.handle(commands.CreateBatch("b1", "LAMP", evicted * 2, None))
+        bus.handle(commands.CreateBatch("b2", "LAMP", evicted * 2, today))
+        for i in range(evicted * 2):
+            bus.handle(commands.Allocate(f"o{i}", "LAMP", 1))
+        return (bus, commands.ChangeBatchQuantity("b1", evicted)), {}
+
+    benchmark.pedantic(lambda bus, cmd: bus.handle(cmd), setup=setup, rounds=20)
+
+
+def test_bus_dispatch_overhead(benchmark, fake_bus_factory):
+    def setup():
+        bus = fake_bus_factory()
+        bus.handle(commands.CreateBatch("b1", "LAMP", 100, None))
+        return (bus, commands.Allocate("o1", "LAMP", 1)), {}
+
+    benchmark.pedantic(lambda bus, cmd: bus.handle(cmd), setup=setup, rounds=200)
@@ -0,0 +1,71 @@
+# pylint: disable=redefined-outer-name
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from allocation import bootstrap
+from allocation.adapters.orm import metadata
+from allocation.domain import commands, model
+from allocation.service_layer import unit_of_work
+from allocation.service_layer.group_commit import GroupCommitter
+
+pytestmark = pytest.mark.usefixtures("mappers")
+
+THREADS = 16
+ALLOCATIONS = 160
+
+
+@pytest.fixture
+def sqlite_file_session_factory(tmp_path):
+    # a file-backed database so that every commit pays for a real fsync
+    engine = create_engine(f"sqlite:///{tmp_path / 'allocation.db'}")
+    metadata.create_all(engine)
+    session_factory = sessionmaker(bind=engine)
+    with unit_of_work.SqlAlchemyUnitOfWork(session_factory) as uow:
+        uow.products.add(
+            model.Product("LAMP", [model.Batch("b1", "LAMP", 10**6, None)])
+        )
+        uow.commit()
+    return session_factory
+
+
+@pytest.mark.parametrize("grouped", [False, True], ids=["direct", "group-commit"])
+def test_concurrent_allocations(benchmark, sqlite_file_session_factory, grouped):
+    # allocations for one SKU serialise on its product row whichever way they
+    # are committed, so hold a lock around each unit of work as postgres would
+    row_lock = threading.Lock()
+    orderids = itertools.count()
+
+    def handle(cmd):
+        bus = bootstrap.bootstrap(
+            start_orm=False,
+            uow=unit_of_work.SqlAlchemyUnitOfWork(sqlite_file_session_factory),
+            notifications=mock.Mock(),
+            publish=lambda *args: None,
+        )
+        with row_lock:
+            return bus.handle(cmd)
+
+    committer = GroupCommitter(handle, window_seconds=0.001)
+
+    def allocate(cmd):
+        if grouped:
+            return committer.allocate(cmd)
+        [batchref] = handle(cmd)
+        return batchref
+
+    def run():
+        cmds = [
+            commands.Allocate(f"o{next(orderids)}", "LAMP", 1)
+            for _ in range(ALLOCATIONS)
+        ]
+        with ThreadPoolExecutor(THREADS) as executor:
+            return list(executor.map(allocate, cmds))
+
+    results = benchmark.pedantic(run, rounds=3)
+    assert results == ["b1"] * ALLOCATIONS
+    if grouped:
+        assert committer.commits < committer.allocations
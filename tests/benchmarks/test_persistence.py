@@ -0,0 +1,42 @@
+# pylint: disable=redefined-outer-name
+import pytest
+from allocation.domain import model
+from allocation.service_layer import unit_of_work
+
+pytestmark = pytest.mark.usefixtures("mappers")
+
+
+@pytest.fixture(params=[(1, 0), (10, 10), (100, 10)], ids=lambda p: f"{p[0]}x{p[1]}")
+def stored_product(request, sqlite_session_factory):
+    batches, lines_per_batch = request.param
+    with unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory) as uow:
+        product = model.Product("LAMP", [])
+        for i in range(batches):
+            batch = model.Batch(f"b{i}", "LAMP", 10**6, None)
+            for j in range(lines_per_batch):
+                batch.allocate(model.OrderLine(f"b{i}-o{j}", "LAMP", 1))
+            product.batches.append(batch)
+        uow.products.add(product)
+        uow.commit()
+    return sqlite_session_factory
+
+
+def test_repository_load(benchmark, stored_product):
+    def load():
+        with unit_of_work.SqlAlchemyUnitOfWork(stored_product) as uow:
+            product = uow.products.get("LAMP")
+            return sum(b.available_quantity for b in product.batches)
+
+    assert benchmark(load) > 0
+
+
+def test_repository_load_allocate_and_commit(benchmark, stored_product):
+    orderids = iter(range(10**9))
+
+    def allocate():
+        with unit_of_work.SqlAlchemyUnitOfWork(stored_product) as uow:
+            product = uow.products.get("LAMP")
+            product.allocate(model.OrderLine(f"new-{next(orderids)}", "LAMP", 1))
+            uow.commit()
+
+    benchmark(allocate)
@@ -0,0 +1,77 @@
+# pylint: disable=redefined-outer-name, protected-access
+import pytest
+from allocation import views
+from allocation.adapters import repository
+from allocation.domain import model
+
+pytestmark = pytest.mark.usefixtures("mappers")
+
+
+@pytest.fixture
+def session(sqlite_session_factory):
+    session = sqlite_session_factory()
+    product = model.Product("LAMP", [model.Batch("b1", "LAMP", 100, None)])
+    product.allocate(model.OrderLine("o1", "LAMP", 1))
+    session.add(product)
+    session.execute(
+        "INSERT INTO allocations_view (orderid, sku, batchref)"
+        " VALUES ('o1', 'LAMP', 'b1')"
+    )
+    session.commit()
+    return session
+
+
+# how the repository and views built their statements before they were cached
+def rebuilt_get(session):
+    return session.query(model.Product).filter_by(sku="LAMP").first()
+
+
+def rebuilt_get_by_batchref(session):
+    return (
+        session.query(model.Product)
+        .join(model.Batch)
+        .filter_by(reference="b1")
+        .first()
+    )
+
+
+def rebuilt_allocations(session):
+    return session.execute(
+        """
+        SELECT sku, batchref FROM allocations_view WHERE orderid = :orderid
+        """,
+        dict(orderid="o1"),
+    ).all()
+
+
+def cached_get(session):
+    return repository.SqlAlchemyRepository(session)._get("LAMP")
+
+
+def cached_get_by_batchref(session):
+    return repository.SqlAlchemyRepository(session)._get_by_batchref("b1")
+
+
+def cached_allocations(session):
+    return session.execute(views.ALLOCATIONS, dict(orderid="o1")).all()
+
+
+@pytest.mark.parametrize(
+    "lookup",
+    [
+        rebuilt_get,
+        cached_get,
+        rebuilt_get_by_batchref,
+        cached_get_by_batchref,
+        rebuilt_allocations,
+        cached_allocations,
+    ],
+    ids=lambda fn: fn.__name__,
+)
+def test_statement_overhead(benchmark, session, lookup):
+    def run():
+        result = lookup(session)
+        session.expunge_all()
+        return result
+
+    assert benchmark(run)
@@ -25,6 +25,19 @@ def post_to_allocate(orderid, sku, qty, expect_success=True):
     return r
 
 
+def post_to_allocate_batch(lines):
+    url = config.get_api_url()
+    r = requests.post(
+        f"{url}/allocate_batch",
+        json=[
+            {"orderid": orderid, "sku": sku, "qty": qty}
+            for orderid, sku, qty in lines
+        ],
+    )
+    assert r.status_code == 200
+    return r
+
+
 def get_allocation(orderid):
     url = config.get_api_url()
     return requests.get(f"{url}/allocations/{orderid}")
@@ -14,5 +14,5 @@ def subscribe_to(channel):
     return pubsub
 
 
-def publish_message(channel, message):
-    r.publish(channel, json.dumps(message))
+def add_to_stream(stream, message):
+    r.xadd(stream, {"data": json.dumps(message)})
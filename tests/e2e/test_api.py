@@ -37,3 +37,29 @@ def test_unhappy_path_returns_400_and_error_message():
 
     r = api_client.get_allocation(orderid)
     assert r.status_code == 404
+
+
+@pytest.mark.usefixtures("postgres_db")
+@pytest.mark.usefixtures("restart_api")
+def test_allocate_batch_returns_an_outcome_per_line():
+    sku, unknown_sku = random_sku(), random_sku("unknown")
+    batch = random_batchref()
+    order1, order2, order3 = random_orderid(1), random_orderid(2), random_orderid(3)
+    api_client.post_to_add_batch(batch, sku, 10, None)
+
+    r = api_client.post_to_allocate_batch(
+        [(order1, sku, 8), (order2, unknown_sku, 1), (order3, sku, 8)]
+    )
+
+    assert r.json() == [
+        {"orderid": order1, "sku": sku, "status": "allocated", "batchref": batch},
+        {
+            "orderid": order2,
+            "sku": unknown_sku,
+            "status": "invalid_sku",
+            "message": f"Invalid sku {unknown_sku}",
+        },
+        {"orderid": order3, "sku": sku, "status": "out_of_stock"},
+    ]
+    r = api_client.get_allocation(order1)
+    assert r.json() == [{"sku": sku, "batchref": batch}]
@@ -22,7 +22,7 @@ def test_change_batch_quantity_leading_to_reallocation():
     subscription = redis_client.subscribe_to("line_allocated")
 
     # change quantity on allocated batch so it's less than our order
-    redis_client.publish_message(
+    redis_client.add_to_stream(
         "change_batch_quantity",
         {"batchref": earlier_batch, "qty": 5},
     )
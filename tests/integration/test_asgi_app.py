@@ -0,0 +1,144 @@
+# pylint: disable=redefined-outer-name
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from starlette.testclient import TestClient
+from allocation import bootstrap
+from allocation.adapters.orm import metadata
+from allocation.entrypoints import asgi_app
+from allocation.service_layer import unit_of_work
+from allocation.service_layer.admission import AdmissionController
+from ..random_refs import random_batchref, random_orderid, random_sku
+
+pytestmark = pytest.mark.usefixtures("mappers")
+
+
+@pytest.fixture
+def sqlite_file_session_factory(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'allocation.db'}")
+    metadata.create_all(engine)
+    yield sessionmaker(bind=engine)
+
+
+@pytest.fixture
+def client(sqlite_file_session_factory):
+    uows = []
+
+    def new_bus():
+        uow = unit_of_work.SqlAlchemyUnitOfWork(sqlite_file_session_factory)
+        uows.append(uow)
+        return bootstrap.bootstrap(
+            start_orm=False,
+            uow=uow,
+            notifications=mock.Mock(),
+            publish=lambda *args: None,
+        )
+
+    with TestClient(asgi_app.create_app(new_bus, max_workers=4)) as client:
+        client.uows = uows
+        yield client
+
+
+def test_happy_path_returns_202_and_batch_is_allocated(client):
+    sku, orderid = random_sku(), random_orderid()
+    earlybatch, laterbatch = random_batchref(1), random_batchref(2)
+    add = lambda ref, eta: client.post(
+        "/add_batch", json={"ref": ref, "sku": sku, "qty": 100, "eta": eta}
+    )
+    assert add(laterbatch, "2011-01-02").status_code == 201
+    assert add(earlybatch, "2011-01-01").status_code == 201
+
+    r = client.post("/allocate", json={"orderid": orderid, "sku": sku, "qty": 3})
+    assert r.status_code == 202
+
+    r = client.get(f"/allocations/{orderid}")
+    assert r.status_code == 200
+    assert r.json() == [{"sku": sku, "batchref": earlybatch}]
+
+
+def test_unhappy_path_returns_400_and_error_message(client):
+    unknown_sku, orderid = random_sku(), random_orderid()
+    r = client.post(
+        "/allocate", json={"orderid": orderid, "sku": unknown_sku, "qty": 20}
+    )
+    assert r.status_code == 400
+    assert r.json()["message"] == f"Invalid sku {unknown_sku}"
+
+    r = client.get(f"/allocations/{orderid}")
+    assert r.status_code == 404
+
+
+def test_each_request_gets_its_own_unit_of_work(client):
+    client.get(f"/allocations/{random_orderid()}")
+    client.get(f"/allocations/{random_orderid()}")
+    assert len(client.uows) == 2
+    assert client.uows[0] is not client.uows[1]
+
+
+def test_sheds_load_with_429_once_the_admission_queue_is_full(
+    sqlite_file_session_factory,
+):
+    admission = AdmissionController(limit=1, queue_size=0)
+
+    def new_bus():
+        return bootstrap.bootstrap(
+            start_orm=False,
+            uow=unit_of_work.SqlAlchemyUnitOfWork(sqlite_file_session_factory),
+            notifications=mock.Mock(),
+            publish=lambda *args: None,
+        )
+
+    app = asgi_app.create_app(new_bus, max_workers=4, admission=admission)
+    with TestClient(app) as client, admission.admit():
+        r = client.post(
+            "/allocate",
+            json={"orderid": random_orderid(), "sku": random_sku(), "qty": 1},
+        )
+
+    assert r.status_code == 429
+    assert int(r.headers["Retry-After"]) >= 1
+    assert admission.stats()["rejected"] == 1
+
+
+def test_group_commit_allocates_concurrent_requests_together(
+    sqlite_file_session_factory,
+):
+    def new_bus():
+        return bootstrap.bootstrap(
+            start_orm=False,
+            uow=unit_of_work.SqlAlchemyUnitOfWork(sqlite_file_session_factory),
+            notifications=mock.Mock(),
+            publish=lambda *args: None,
+        )
+
+    app = asgi_app.create_app(
+        new_bus,
+        max_workers=8,
+        group_commit_settings=dict(window_seconds=0.05, max_batch=100),
+    )
+    sku, batchref = random_sku(), random_batchref()
+    orderids = [random_orderid(str(i)) for i in range(4)]
+    with TestClient(app) as client:
+        client.post(
+            "/add_batch", json={"ref": batchref, "sku": sku, "qty": 10, "eta": None}
+        )
+        with ThreadPoolExecutor(4) as executor:
+            responses = list(
+                executor.map(
+                    lambda orderid: client.post(
+                        "/allocate", json={"orderid": orderid, "sku": sku, "qty": 2}
+                    ),
+                    orderids,
+                )
+            )
+        assert [r.status_code for r in responses] == [202] * 4
+        for orderid in orderids:
+            r = client.get(f"/allocations/{orderid}")
+            assert r.json() == [{"sku": sku, "batchref": batchref}]
+
+        r = client.post(
+            "/allocate", json={"orderid": random_orderid(), "sku": "NOPE", "qty": 1}
+        )
+        assert r.status_code == 400
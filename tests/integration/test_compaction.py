@@ -0,0 +1,56 @@
+# pylint: disable=redefined-outer-name
+from datetime import date, timedelta
+from unittest import mock
+from sqlalchemy.orm import clear_mappers
+import pytest
+from allocation import bootstrap, views
+from allocation.domain import commands
+from allocation.entrypoints import compactor
+from allocation.service_layer import unit_of_work
+from ..random_refs import random_sku, random_batchref, random_orderid
+
+today = date.today()
+
+
+@pytest.fixture
+def sqlite_bus(sqlite_session_factory):
+    bus = bootstrap.bootstrap(
+        start_orm=True,
+        uow=unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory),
+        notifications=mock.Mock(),
+        publish=lambda *args: None,
+    )
+    yield bus
+    clear_mappers()
+
+
+def test_archives_consumed_batches_and_keeps_views_working(sqlite_bus):
+    sku, old, new = random_sku(), random_batchref("old"), random_batchref("new")
+    orders = [random_orderid(str(i)) for i in range(3)]
+    sqlite_bus.handle(commands.CreateBatch(old, sku, 20, today - timedelta(days=60)))
+    sqlite_bus.handle(commands.CreateBatch(new, sku, 20, today + timedelta(days=5)))
+    sqlite_bus.handle(commands.Allocate(orders[0], sku, 10))
+    sqlite_bus.handle(commands.Allocate(orders[1], sku, 10))
+    sqlite_bus.handle(commands.Allocate(orders[2], sku, 10))
+
+    archived = compactor.compact(sqlite_bus, today - timedelta(days=30))
+
+    assert archived == 2
+    session = sqlite_bus.uow.session_factory()
+    assert session.execute("SELECT count(*) FROM allocations").scalar() == 1
+    assert session.execute("SELECT count(*) FROM order_lines").scalar() == 1
+    assert sorted(
+        session.execute("SELECT orderid, qty, batchref FROM archived_allocations")
+    ) == [(orders[0], 10, old), (orders[1], 10, old)]
+    assert views.allocations(orders[0], sqlite_bus.uow) == [
+        {"sku": sku, "batchref": old}
+    ]
+
+    with sqlite_bus.uow as uow:
+        product = uow.products.get(sku)
+        [old_batch] = [b for b in product.batches if b.reference == old]
+        assert not old_batch.has_allocations
+        assert old_batch.available_quantity == 0
+
+    assert compactor.compact(sqlite_bus, today - timedelta(days=30)) == 0
+    assert sqlite_bus.handle(commands.Allocate(random_orderid(), sku, 10)) == [new]
@@ -0,0 +1,79 @@
+import contextlib
+import signal
+import threading
+import time
+from allocation.entrypoints.consumer_supervisor import Supervisor
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+@contextlib.contextmanager
+def supervising(supervisor):
+    thread = threading.Thread(
+        target=supervisor.run, kwargs=dict(install_signals=False)
+    )
+    thread.start()
+    try:
+        yield supervisor
+    finally:
+        supervisor.stop()
+        thread.join(10)
+        assert not thread.is_alive()
+
+
+def draining_worker(drained_dir):
+    def target(index, processed):
+        stopping = threading.Event()
+        signal.signal(signal.SIGTERM, lambda *_: stopping.set())
+        while not stopping.is_set():
+            processed()
+            time.sleep(0.005)
+        (drained_dir / f"worker-{index}").write_text("drained")
+
+    return target
+
+
+def crashing_worker(index, processed):
+    raise RuntimeError(f"worker {index} cannot connect")
+
+
+def stubborn_worker(index, processed):
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    while True:
+        time.sleep(0.01)
+
+
+def test_forks_workers_and_reports_their_throughput(tmp_path):
+    supervisor = Supervisor(draining_worker(tmp_path), processes=2, poll_seconds=0.01)
+    with supervising(supervisor):
+        wait_for(lambda: all(supervisor.counters) and len(supervisor.running()) == 2)
+        assert len({slot.pid for slot in supervisor.running()}) == 2
+        assert all(rate > 0 for rate in supervisor.throughput())
+
+    assert not supervisor.running()
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["worker-0", "worker-1"]
+
+
+def test_restarts_crashed_workers_with_backoff():
+    supervisor = Supervisor(
+        crashing_worker, processes=1, min_backoff=0.02, poll_seconds=0.01
+    )
+    with supervising(supervisor):
+        [slot] = supervisor.slots
+        wait_for(lambda: slot.restarts >= 3)
+        assert slot.failures == slot.restarts
+        assert supervisor.max_backoff >= slot.restart_at - time.monotonic() > 0
+
+
+def test_kills_workers_that_do_not_drain_in_time():
+    supervisor = Supervisor(
+        stubborn_worker, processes=1, shutdown_timeout=0.2, poll_seconds=0.01
+    )
+    with supervising(supervisor):
+        wait_for(lambda: supervisor.running())
+    assert not supervisor.running()
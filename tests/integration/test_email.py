@@ -21,10 +21,14 @@ def bus(sqlite_session_factory):
     clear_mappers()
 
 
-def get_email_from_mailhog(sku):
+def get_emails_from_mailhog(sku):
     host, port = map(config.get_email_host_and_port().get, ["host", "http_port"])
     all_emails = requests.get(f"http://{host}:{port}/api/v2/messages").json()
-    return next(m for m in all_emails["items"] if sku in str(m))
+    return [m for m in all_emails["items"] if sku in str(m)]
+
+
+def get_email_from_mailhog(sku):
+    return get_emails_from_mailhog(sku)[0]
 
 
 def test_out_of_stock_email(bus):
@@ -35,3 +39,25 @@ def test_out_of_stock_email(bus):
     assert email["Raw"]["From"] == "allocations@example.com"
     assert email["Raw"]["To"] == ["stock@made.com"]
     assert f"Out of stock for {sku}" in email["Raw"]["Data"]
+
+
+def test_out_of_stock_emails_are_debounced(sqlite_session_factory):
+    background = notifications.BackgroundNotifications(
+        notifications.EmailNotifications(), debounce_seconds=60
+    )
+    bus = bootstrap.bootstrap(
+        start_orm=True,
+        uow=unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory),
+        notifications=background,
+        publish=lambda *args: None,
+    )
+    try:
+        sku = random_sku()
+        bus.handle(commands.CreateBatch("batch1", sku, 9, None))
+        for i in range(5):
+            bus.handle(commands.Allocate(f"order{i}", sku, 10))
+        background.flush()
+    finally:
+        clear_mappers()
+
+    assert len(get_emails_from_mailhog(sku)) == 1
@@ -0,0 +1,132 @@
+# pylint: disable=redefined-outer-name
+from datetime import date, timedelta
+from unittest import mock
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from allocation import bootstrap, views
+from allocation.adapters import event_store
+from allocation.adapters.orm import metadata
+from allocation.domain import commands, model
+from allocation.entrypoints import compactor
+from allocation.service_layer import unit_of_work
+
+pytestmark = pytest.mark.usefixtures("mappers")
+
+
+@pytest.fixture
+def session_factory(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'events.db'}")
+    metadata.create_all(engine)
+    return sessionmaker(bind=engine)
+
+
+def event_sourced_uow(session_factory, snapshot_every=100):
+    return unit_of_work.SqlAlchemyUnitOfWork(
+        session_factory, event_sourced=True, snapshot_every=snapshot_every
+    )
+
+
+def state_of(product: model.Product):
+    return event_store.snapshot(product), [
+        b.available_quantity for b in product.buckets
+    ]
+
+
+def test_rebuilds_a_product_from_its_events_through_the_bus(session_factory):
+    bus = bootstrap.bootstrap(
+        start_orm=False,
+        uow=event_sourced_uow(session_factory),
+        notifications=mock.Mock(),
+        publish=lambda *args: None,
+    )
+    bus.handle(commands.CreateBatch("warehouse", "SOFA", 20, None))
+    bus.handle(commands.CreateBatch("shipment", "SOFA", 20, date(2011, 1, 2)))
+    for orderid in ["o1", "o2"]:
+        bus.handle(commands.Allocate(orderid, "SOFA", 10))
+    bus.handle(commands.ChangeBatchQuantity("warehouse", 5))
+    bus.handle(commands.SplitStock("SOFA", 2))
+
+    with event_sourced_uow(session_factory) as uow:
+        product = uow.products.get("SOFA")
+        warehouse, shipment = product.batches
+        assert (warehouse.available_quantity, shipment.available_quantity) == (5, 0)
+        assert sorted(b.available_quantity for b in product.buckets) == [2, 3]
+        assert product.version_number == 10
+    for orderid in ["o1", "o2"]:
+        assert views.allocations(orderid, bus.uow) == [
+            {"sku": "SOFA", "batchref": "shipment"}
+        ]
+
+
+def test_archives_consumed_batches(session_factory):
+    bus = bootstrap.bootstrap(
+        start_orm=False,
+        uow=event_sourced_uow(session_factory, snapshot_every=3),
+        notifications=mock.Mock(),
+        publish=lambda *args: None,
+    )
+    today = date.today()
+    bus.handle(commands.CreateBatch("old", "SOFA", 20, today - timedelta(days=60)))
+    bus.handle(commands.CreateBatch("new", "SOFA", 20, today + timedelta(days=5)))
+    for orderid in ["o1", "o2", "o3"]:
+        bus.handle(commands.Allocate(orderid, "SOFA", 10))
+
+    assert compactor.compact(bus, today - timedelta(days=30)) == 2
+    assert compactor.compact(bus, today - timedelta(days=30)) == 0
+
+    session = session_factory()
+    assert sorted(
+        session.execute("SELECT orderid, qty, batchref FROM archived_allocations")
+    ) == [("o1", 10, "old"), ("o2", 10, "old")]
+    session.execute("DELETE FROM product_snapshots")
+    session.commit()
+    with event_sourced_uow(session_factory) as uow:
+        old, new = uow.products.get("SOFA").batches
+        assert (old.has_allocations, old.allocated_quantity) == (False, 20)
+        assert new.available_quantity == 10
+    assert bus.handle(commands.ChangeBatchQuantity("old", 10)) == [None]
+
+
+def test_loads_from_the_latest_snapshot_and_the_events_after_it(session_factory):
+    with event_sourced_uow(session_factory, snapshot_every=5) as uow:
+        uow.products.add(
+            model.Product("LAMP", [model.Batch("b1", "LAMP", 100, None)])
+        )
+        uow.commit()
+    for i in range(7):
+        with event_sourced_uow(session_factory, snapshot_every=5) as uow:
+            uow.products.get("LAMP").allocate(model.OrderLine(f"o{i}", "LAMP", 1))
+            uow.commit()
+
+    session = session_factory()
+    [[snapshot_version]] = session.execute("SELECT version FROM product_snapshots")
+    assert snapshot_version == 5
+    with event_sourced_uow(session_factory) as uow:
+        from_snapshot = state_of(uow.products.get("LAMP"))
+    session.execute("DELETE FROM product_snapshots")
+    session.commit()
+    with event_sourced_uow(session_factory) as uow:
+        product = uow.products.get("LAMP")
+        assert state_of(product) == from_snapshot
+        assert product.version_number == 8
+        assert product.batches[0].available_quantity == 93
+
+
+def test_rejects_appends_from_a_stale_copy_of_the_product(session_factory):
+    with event_sourced_uow(session_factory) as uow:
+        uow.products.add(model.Product("LAMP", [model.Batch("b1", "LAMP", 10, None)]))
+        uow.commit()
+
+    first, second = event_sourced_uow(session_factory), event_sourced_uow(
+        session_factory
+    )
+    with first, second:
+        first.products.get("LAMP").allocate(model.OrderLine("o1", "LAMP", 5))
+        second.products.get("LAMP").allocate(model.OrderLine("o2", "LAMP", 8))
+        first.commit()
+        with pytest.raises(event_store.ConcurrentAppend):
+            second.commit()
+
+    with event_sourced_uow(session_factory) as uow:
+        assert uow.products.get("LAMP").batches[0].available_quantity == 5
@@ -0,0 +1,116 @@
+# pylint: disable=redefined-outer-name
+from datetime import datetime, timedelta
+from unittest import mock
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from allocation import bootstrap
+from allocation.adapters.orm import metadata
+from allocation.domain import commands
+from allocation.service_layer import unit_of_work
+from allocation.service_layer.handlers import InvalidSku
+from allocation.service_layer.idempotency import IdempotencyStore
+
+pytestmark = pytest.mark.usefixtures("mappers")
+
+
+@pytest.fixture
+def session_factory(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'allocation.db'}")
+    metadata.create_all(engine)
+    return sessionmaker(bind=engine)
+
+
+def new_bus(session_factory, idempotency):
+    return bootstrap.bootstrap(
+        start_orm=False,
+        uow=unit_of_work.SqlAlchemyUnitOfWork(session_factory),
+        notifications=mock.Mock(),
+        publish=lambda *args: None,
+        idempotency=idempotency,
+    )
+
+
+def allocated_orders(session_factory):
+    return session_factory().execute("SELECT orderid FROM order_lines").all()
+
+
+def test_outcomes_survive_a_cold_cache(session_factory):
+    bus = new_bus(session_factory, IdempotencyStore(session_factory))
+    bus.handle(commands.CreateBatch("batch1", "LAMP", 100, None))
+    bus.handle(commands.Allocate("o1", "LAMP", 10, idempotency_key="k1"))
+
+    restarted = new_bus(session_factory, IdempotencyStore(session_factory))
+    assert restarted.handle(
+        commands.Allocate("o1", "LAMP", 10, idempotency_key="k1")
+    ) == ["batch1"]
+    assert allocated_orders(session_factory) == [("o1",)]
+
+
+def test_failed_commands_can_be_retried(session_factory):
+    bus = new_bus(session_factory, IdempotencyStore(session_factory))
+    cmd = commands.Allocate("o1", "LAMP", 10, idempotency_key="k1")
+    with pytest.raises(InvalidSku):
+        bus.handle(cmd)
+
+    bus.handle(commands.CreateBatch("batch1", "LAMP", 100, None))
+    assert bus.handle(cmd) == ["batch1"]
+
+
+def test_out_of_stock_outcomes_are_remembered(session_factory):
+    bus = new_bus(session_factory, IdempotencyStore(session_factory))
+    bus.handle(commands.CreateBatch("batch1", "LAMP", 5, None))
+    cmd = commands.Allocate("o1", "LAMP", 10, idempotency_key="k1")
+    assert bus.handle(cmd) == [None]
+
+    restarted = new_bus(session_factory, IdempotencyStore(session_factory))
+    restarted.handle(commands.ChangeBatchQuantity("batch1", 50))
+    assert restarted.handle(cmd) == [None]
+    assert allocated_orders(session_factory) == []
+
+
+def test_outcomes_survive_a_crash_before_they_are_cached(session_factory):
+    store = IdempotencyStore(session_factory)
+    bus = new_bus(session_factory, store)
+    bus.handle(commands.CreateBatch("batch1", "LAMP", 100, None))
+    cmd = commands.Allocate("o1", "LAMP", 10, idempotency_key="k1")
+    store.record = mock.Mock(side_effect=RuntimeError("crashed"))
+    with pytest.raises(RuntimeError):
+        bus.handle(cmd)
+
+    restarted = new_bus(session_factory, IdempotencyStore(session_factory))
+    assert restarted.handle(cmd) == ["batch1"]
+    assert allocated_orders(session_factory) == [("o1",)]
+
+
+def test_a_concurrent_duplicate_is_rolled_back(session_factory):
+    new_bus(session_factory, IdempotencyStore(session_factory)).handle(
+        commands.CreateBatch("batch1", "LAMP", 100, None)
+    )
+    first = new_bus(session_factory, IdempotencyStore(session_factory))
+    # the second copy looked the key up before the first one committed
+    second = new_bus(session_factory, IdempotencyStore(session_factory))
+    second.idempotency.lookup = mock.Mock(side_effect=[None, ("batch1",)])
+
+    cmd = commands.Allocate("o1", "LAMP", 10, idempotency_key="k1")
+    assert first.handle(cmd) == ["batch1"]
+    assert second.handle(cmd) == ["batch1"]
+    assert allocated_orders(session_factory) == [("o1",)]
+
+
+def test_expired_keys_are_ignored_and_purged(session_factory):
+    now = datetime(2011, 1, 1)
+    store = IdempotencyStore(session_factory, ttl_seconds=60, clock=lambda: now)
+    bus = new_bus(session_factory, store)
+    bus.handle(commands.CreateBatch("batch1", "LAMP", 100, None))
+    bus.handle(commands.Allocate("o1", "LAMP", 10, idempotency_key="k1"))
+    bus.handle(commands.Allocate("o2", "LAMP", 10, idempotency_key="k2"))
+
+    now += timedelta(seconds=61)
+    # an identical line would be a no-op in the domain, so reuse the key for another
+    bus.handle(commands.Allocate("o3", "LAMP", 10, idempotency_key="k1"))
+    assert len(allocated_orders(session_factory)) == 3
+
+    assert store.purge() == 1
+    [[key]] = session_factory().execute("SELECT key FROM idempotency_keys")
+    assert key == "k1"
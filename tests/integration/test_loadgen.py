@@ -0,0 +1,22 @@
+# pylint: disable=redefined-outer-name
+import pytest
+from sqlalchemy.orm import clear_mappers
+from allocation.entrypoints import loadgen
+
+
+@pytest.fixture
+def bus_target(tmp_path):
+    yield loadgen.BusTarget(f"sqlite:///{tmp_path / 'load.db'}")
+    clear_mappers()
+
+
+def test_runs_a_generated_stream_through_the_bus(bus_target):
+    shape = loadgen.TrafficShape(commands=200, skus=5, burst_probability=0.05, seed=1)
+
+    report = loadgen.run(bus_target, loadgen.generate(shape), concurrency=2).as_dict()
+
+    assert report["commands"] == 200
+    assert report["errors"] == 0
+    assert report["throughput"] > 0
+    assert report["p50"] <= report["p95"] <= report["p99"]
+    assert report["events_per_command"] > 0
@@ -0,0 +1,347 @@
+# pylint: disable=redefined-outer-name
+import json
+import threading
+import time
+from typing import List, Tuple
+from unittest import mock
+import pytest
+import redis
+from allocation import config
+from allocation.domain import commands
+from allocation.entrypoints import redis_eventconsumer
+from allocation.service_layer.admission import AdmissionController
+from ..random_refs import random_suffix
+
+
+@pytest.fixture
+def redis_client():
+    client = redis.Redis(**config.get_redis_host_and_port())
+    client.ping()
+    return client
+
+
+@pytest.fixture
+def stream(redis_client):
+    name = f"change_batch_quantity-{random_suffix()}"
+    yield name
+    redis_client.delete(name, f"{name}:dead")
+
+
+def make_consumer(redis_client, stream, bus, name="c1", **kwargs):
+    bus_factory = kwargs.pop("bus_factory", lambda: bus)
+    return redis_eventconsumer.StreamConsumer(
+        redis_client,
+        bus_factory,
+        stream=stream,
+        group="allocation",
+        decode=redis_eventconsumer.decode_change_batch_quantity,
+        partition_key=lambda cmd: cmd.ref,
+        consumer=name,
+        block_ms=10,
+        **kwargs,
+    )
+
+
+def add(redis_client, stream, batchref, qty):
+    redis_client.xadd(
+        stream, {"data": json.dumps({"batchref": batchref, "qty": qty})}
+    )
+
+
+def test_handles_a_batch_of_messages_and_acknowledges_them(redis_client, stream):
+    bus = mock.Mock()
+    consumer = make_consumer(redis_client, stream, bus, batch_size=10)
+    for qty in range(3):
+        add(redis_client, stream, "b1", qty)
+
+    assert consumer.consume_once() == 3
+
+    assert bus.handle.call_args_list == [
+        mock.call(commands.ChangeBatchQuantity("b1", qty)) for qty in range(3)
+    ]
+    assert redis_client.xpending(stream, "allocation")["pending"] == 0
+
+
+def test_messages_are_shared_between_consumers_in_a_group(redis_client, stream):
+    bus1, bus2 = mock.Mock(), mock.Mock()
+    consumer1 = make_consumer(redis_client, stream, bus1, name="c1", batch_size=2)
+    consumer2 = make_consumer(redis_client, stream, bus2, name="c2", batch_size=2)
+    for qty in range(4):
+        add(redis_client, stream, "b1", qty)
+
+    consumer1.consume_once()
+    consumer2.consume_once()
+
+    handled = [c.args[0].qty for c in bus1.handle.call_args_list] + [
+        c.args[0].qty for c in bus2.handle.call_args_list
+    ]
+    assert handled == [0, 1, 2, 3]
+
+
+def test_failed_messages_stay_pending_and_are_reclaimed(redis_client, stream):
+    failing_bus = mock.Mock()
+    dead_consumer = make_consumer(redis_client, stream, failing_bus, name="c1")
+
+    def crash(_cmd):
+        dead_consumer.stop()
+        raise Exception("db down")
+
+    failing_bus.handle.side_effect = crash
+    add(redis_client, stream, "b1", 5)
+
+    assert dead_consumer.consume_once() == 0
+    assert redis_client.xpending(stream, "allocation")["pending"] == 1
+
+    bus = mock.Mock()
+    live_consumer = make_consumer(redis_client, stream, bus, name="c2", min_idle_ms=0)
+    assert live_consumer.consume_once() == 1
+    bus.handle.assert_called_once_with(commands.ChangeBatchQuantity("b1", 5))
+    assert redis_client.xpending(stream, "allocation")["pending"] == 0
+
+
+class FlakyBus:
+    def __init__(self, failures):
+        self.failures = failures
+        self.handled = []  # type: List[commands.ChangeBatchQuantity]
+
+    def handle(self, cmd):
+        if self.failures:
+            self.failures -= 1
+            raise Exception("deadlock")
+        self.handled.append(cmd)
+
+
+@pytest.mark.parametrize("workers", [0, 2])
+def test_a_failed_message_is_retried_before_later_ones_for_its_batchref(
+    redis_client, stream, workers
+):
+    bus = FlakyBus(failures=2)
+    consumer = make_consumer(redis_client, stream, bus, workers=workers, retry_ms=1)
+    add(redis_client, stream, "b1", 5)
+    add(redis_client, stream, "b1", 8)
+
+    consumer.consume_once()
+    consumer.drain()
+
+    assert [cmd.qty for cmd in bus.handled] == [5, 8]
+    assert redis_client.xpending(stream, "allocation")["pending"] == 0
+
+
+def test_stopping_mid_retry_holds_later_messages_for_the_batchref(
+    redis_client, stream
+):
+    bus = FlakyBus(failures=1)
+    consumer = make_consumer(redis_client, stream, bus)
+    for ref, qty in [("b1", 5), ("b2", 7), ("b1", 8)]:
+        add(redis_client, stream, ref, qty)
+    consumer.stop()
+
+    assert consumer.consume_once() == 1
+
+    assert bus.handled == [commands.ChangeBatchQuantity("b2", 7)]
+    assert redis_client.xpending(stream, "allocation")["pending"] == 2
+    later = make_consumer(redis_client, stream, bus, name="c2", min_idle_ms=0)
+    assert later.consume_once() == 2
+    assert [cmd.qty for cmd in bus.handled] == [7, 5, 8]
+
+
+def test_gives_up_after_max_deliveries(redis_client, stream):
+    bus = mock.Mock()
+    bus.handle.side_effect = Exception("poison")
+    consumer = make_consumer(
+        redis_client, stream, bus, min_idle_ms=0, max_deliveries=2
+    )
+    add(redis_client, stream, "b1", 5)
+
+    for _ in range(3):
+        consumer.consume_once()
+
+    assert bus.handle.call_count == 2
+    assert redis_client.xpending(stream, "allocation")["pending"] == 0
+    [(_id, fields)] = redis_client.xrange(f"{stream}:dead")
+    assert json.loads(fields[b"data"]) == {"batchref": "b1", "qty": 5}
+
+
+class SlowRecordingBus:
+    def __init__(self, handled, delay):
+        self.handled = handled
+        self.delay = delay
+
+    def handle(self, cmd):
+        time.sleep(self.delay)
+        self.handled.append((threading.current_thread().name, cmd))
+
+
+def test_workers_keep_messages_for_a_batchref_in_order(redis_client, stream):
+    handled = []  # type: List[Tuple[str, commands.ChangeBatchQuantity]]
+    buses = []
+
+    def bus_factory():
+        buses.append(SlowRecordingBus(handled, delay=0.001))
+        return buses[-1]
+
+    consumer = make_consumer(
+        redis_client, stream, None, bus_factory=bus_factory, workers=3, queue_size=2
+    )
+    for qty in range(10):
+        for batchref in ["b1", "b2", "b3", "b4"]:
+            add(redis_client, stream, batchref, qty)
+
+    while consumer.consume_once():
+        pass
+    consumer.drain()
+
+    assert len(buses) == 3
+    assert len(handled) == 40
+    for batchref in ["b1", "b2", "b3", "b4"]:
+        qtys = [cmd.qty for _, cmd in handled if cmd.ref == batchref]
+        assert qtys == list(range(10))
+        assert len({thread for thread, cmd in handled if cmd.ref == batchref}) == 1
+    assert redis_client.xpending(stream, "allocation")["pending"] == 0
+
+
+def test_stopping_drains_queued_messages(redis_client, stream):
+    handled = []  # type: List[Tuple[str, commands.ChangeBatchQuantity]]
+    consumer = make_consumer(
+        redis_client,
+        stream,
+        None,
+        bus_factory=lambda: SlowRecordingBus(handled, delay=0.01),
+        workers=2,
+    )
+    for qty in range(5):
+        add(redis_client, stream, "b1", qty)
+
+    consumer.consume_once()
+    consumer.stop()
+    consumer.run()
+
+    assert [cmd.qty for _, cmd in handled] == list(range(5))
+    assert redis_client.xpending(stream, "allocation")["pending"] == 0
+
+
+def test_queued_messages_are_not_reclaimed_while_they_wait(redis_client, stream):
+    release = threading.Event()
+    bus = mock.Mock()
+    bus.handle.side_effect = lambda _: release.wait(5)
+    consumer = make_consumer(redis_client, stream, bus, workers=1, min_idle_ms=50)
+    add(redis_client, stream, "b1", 1)
+    add(redis_client, stream, "b1", 2)
+    assert consumer.consume_once() == 2
+
+    try:
+        time.sleep(0.1)
+        consumer.consume_once()
+        other = make_consumer(redis_client, stream, bus, name="c2", min_idle_ms=50)
+        assert other.reclaim_pending() == []
+
+        pending = redis_client.xpending_range(stream, "allocation", "-", "+", 10)
+        assert [p["consumer"] for p in pending] == [b"c1", b"c1"]
+        assert [p["times_delivered"] for p in pending] == [1, 1]
+    finally:
+        release.set()
+        consumer.drain()
+    assert redis_client.xpending(stream, "allocation")["pending"] == 0
+
+
+def test_pauses_reading_while_the_bus_is_under_pressure(redis_client, stream):
+    bus = mock.Mock()
+    admission = AdmissionController(limit=1)
+    consumer = make_consumer(redis_client, stream, bus, admission=admission)
+    add(redis_client, stream, "b1", 1)
+    release = threading.Event()
+
+    def hold():
+        with admission.admit(blocking=True):
+            release.wait(5)
+
+    holders = [threading.Thread(target=hold) for _ in range(2)]
+    for holder in holders:
+        holder.start()
+    while not admission.waiting:
+        time.sleep(0.001)
+    assert consumer.consume_once() == 0
+    assert bus.handle.call_count == 0
+    release.set()
+    for holder in holders:
+        holder.join()
+
+    assert consumer.consume_once() == 1
+    assert admission.stats()["admitted"] == 3
+
+
+def test_keeps_reading_while_every_worker_is_busy(redis_client, stream):
+    release = threading.Event()
+    bus = mock.Mock()
+    bus.handle.side_effect = lambda _: release.wait(5)
+    admission = AdmissionController(limit=2)
+    consumer = make_consumer(
+        redis_client, stream, bus, workers=2, max_queued=1, admission=admission
+    )
+    try:
+        for batchref in ["b1", "b2"]:
+            add(redis_client, stream, batchref, 1)
+        assert consumer.consume_once() == 2
+        while admission.in_flight < 2:
+            time.sleep(0.001)
+
+        for qty in range(2, 4):
+            add(redis_client, stream, "b1", qty)
+        assert consumer.consume_once() == 2
+        add(redis_client, stream, "b1", 4)
+        assert consumer.consume_once() == 0
+    finally:
+        release.set()
+        consumer.drain()
+    assert consumer.consume_once() == 1
+
+
+def test_coalesces_updates_for_a_batchref_keeping_the_latest(redis_client, stream):
+    bus = mock.Mock()
+    consumer = make_consumer(
+        redis_client, stream, bus, coalesce_key=lambda cmd: cmd.ref
+    )
+    for ref, qty in [("b1", 5), ("b2", 7), ("b1", 3), ("b1", 9)]:
+        add(redis_client, stream, ref, qty)
+
+    assert consumer.consume_once() == 2
+
+    assert bus.handle.call_args_list == [
+        mock.call(commands.ChangeBatchQuantity("b2", 7)),
+        mock.call(commands.ChangeBatchQuantity("b1", 9)),
+    ]
+    assert redis_client.xpending(stream, "allocation")["pending"] == 0
+    assert consumer.stats() == dict(received=4, coalesced=2, in_flight=0)
+
+
+def test_waits_for_the_coalescing_window_to_catch_a_burst(redis_client, stream):
+    bus = mock.Mock()
+    consumer = make_consumer(
+        redis_client, stream, bus, coalesce_key=lambda cmd: cmd.ref, coalesce_ms=500
+    )
+    add(redis_client, stream, "b1", 5)
+    threading.Timer(0.05, add, args=(redis_client, stream, "b1", 8)).start()
+
+    assert consumer.consume_once() == 1
+
+    bus.handle.assert_called_once_with(commands.ChangeBatchQuantity("b1", 8))
+    assert consumer.coalesced == 1
+
+
+def test_keys_commands_by_message_id_so_redeliveries_are_deduplicated(
+    redis_client, stream
+):
+    bus = mock.Mock()
+    consumer = make_consumer(redis_client, stream, bus, keyed_by_message_id=True)
+    add(redis_client, stream, "b1", 5)
+    redis_client.xadd(
+        stream,
+        {"data": json.dumps({"batchref": "b2", "qty": 1, "idempotency_key": "k2"})},
+    )
+
+    assert consumer.consume_once() == 2
+
+    [first_id, _] = [m[0] for m in redis_client.xrange(stream)]
+    [first, second] = [c.args[0] for c in bus.handle.call_args_list]
+    assert first.idempotency_key == f"{stream}:{first_id.decode()}"
+    assert second.idempotency_key == "k2"
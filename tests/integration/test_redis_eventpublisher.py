@@ -0,0 +1,102 @@
+# pylint: disable=redefined-outer-name
+import json
+import pytest
+import redis
+from allocation import config
+from allocation.adapters import redis_eventpublisher
+from allocation.domain import events
+from ..random_refs import random_suffix
+
+
+@pytest.fixture
+def redis_client():
+    client = redis.Redis(**config.get_redis_host_and_port())
+    client.ping()
+    return client
+
+
+@pytest.fixture
+def subscription(redis_client):
+    channel = f"line_allocated-{random_suffix()}"
+    pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(channel)
+    pubsub.get_message(timeout=1)
+    yield channel, pubsub
+    pubsub.close()
+
+
+def received(pubsub, count):
+    messages = []
+    while len(messages) < count:
+        message = pubsub.get_message(timeout=1)
+        assert message is not None, f"only got {messages}"
+        messages.append(json.loads(message["data"])["orderid"])
+    return messages
+
+
+class CountingPipeline:
+    def __init__(self, pipe, executed, failures):
+        self.pipe = pipe
+        self.executed = executed
+        self.failures = failures
+
+    def publish(self, channel, payload):
+        self.pipe.publish(channel, payload)
+
+    def execute(self):
+        if self.failures:
+            self.failures.pop()
+            raise redis.ConnectionError("connection reset")
+        self.executed.append(len(self.pipe.command_stack))
+        return self.pipe.execute()
+
+
+class CountingClient:
+    def __init__(self, client, failures=0):
+        self.client = client
+        self.executed = []
+        self.failures = [None] * failures
+
+    def pipeline(self, transaction=True):
+        pipe = self.client.pipeline(transaction=transaction)
+        return CountingPipeline(pipe, self.executed, self.failures)
+
+
+def allocated(orderid):
+    return events.Allocated(orderid=orderid, sku="sku1", qty=1, batchref="b1")
+
+
+def test_buffered_events_are_flushed_in_one_round_trip(redis_client, subscription):
+    channel, pubsub = subscription
+    client = CountingClient(redis_client)
+    publisher = redis_eventpublisher.RedisEventPublisher(client)
+
+    with publisher.buffered():
+        for i in range(5):
+            publisher(channel, allocated(f"o{i}"))
+        assert pubsub.get_message(timeout=0.1) is None
+
+    assert client.executed == [5]
+    assert received(pubsub, 5) == ["o0", "o1", "o2", "o3", "o4"]
+
+
+def test_unbuffered_events_are_sent_straight_away(redis_client, subscription):
+    channel, pubsub = subscription
+    publisher = redis_eventpublisher.RedisEventPublisher(redis_client)
+
+    publisher(channel, allocated("o1"))
+
+    assert received(pubsub, 1) == ["o1"]
+
+
+def test_retries_transient_errors_without_reordering(redis_client, subscription):
+    channel, pubsub = subscription
+    client = CountingClient(redis_client, failures=2)
+    publisher = redis_eventpublisher.RedisEventPublisher(client, backoff=0)
+
+    with publisher.buffered():
+        for i in range(3):
+            publisher(channel, allocated(f"o{i}"))
+
+    assert client.executed == [3]
+    assert received(pubsub, 3) == ["o0", "o1", "o2"]
@@ -1,3 +1,4 @@
+# pylint: disable=redefined-outer-name
 import pytest
 from allocation.adapters import repository
 from allocation.domain import model
@@ -5,9 +6,17 @@ from allocation.domain import model
 pytestmark = pytest.mark.usefixtures("mappers")
 
 
-def test_get_by_batchref(sqlite_session_factory):
+@pytest.fixture(
+    params=[repository.SqlAlchemyRepository, repository.EventSourcedRepository],
+    ids=["tables", "events"],
+)
+def make_repository(request):
+    return request.param
+
+
+def test_get_by_batchref(sqlite_session_factory, make_repository):
     session = sqlite_session_factory()
-    repo = repository.SqlAlchemyRepository(session)
+    repo = make_repository(session)
     b1 = model.Batch(ref="b1", sku="sku1", qty=100, eta=None)
     b2 = model.Batch(ref="b2", sku="sku1", qty=100, eta=None)
     b3 = model.Batch(ref="b3", sku="sku2", qty=100, eta=None)
@@ -17,3 +26,14 @@ def test_get_by_batchref(sqlite_session_factory):
     repo.add(p2)
     assert repo.get_by_batchref("b2") == p1
     assert repo.get_by_batchref("b3") == p2
+
+
+def test_exists_and_skus(sqlite_session_factory, make_repository):
+    session = sqlite_session_factory()
+    repo = make_repository(session)
+    repo.add(model.Product(sku="sku1", batches=[]))
+    repo.add(model.Product(sku="sku2", batches=[]))
+    session.flush()
+    assert repo.exists("sku1")
+    assert not repo.exists("sku3")
+    assert sorted(repo.skus()) == ["sku1", "sku2"]
@@ -0,0 +1,167 @@
+# pylint: disable=redefined-outer-name
+from datetime import date, timedelta
+from unittest import mock
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import clear_mappers, sessionmaker
+from allocation import bootstrap, views
+from allocation.adapters import repository
+from allocation.adapters.orm import metadata
+from allocation.adapters.sharding import CrossShardRequest, ShardRouter, shard_for
+from allocation.domain import commands
+from allocation.entrypoints import compactor
+from allocation.service_layer import unit_of_work
+from ..random_refs import random_sku, random_batchref, random_orderid
+
+SHARDS = 3
+
+
+def sqlite_file(path) -> sessionmaker:
+    engine = create_engine(f"sqlite:///{path}")
+    metadata.create_all(engine)
+    return sessionmaker(bind=engine)
+
+
+@pytest.fixture
+def home(tmp_path):
+    return sqlite_file(tmp_path / "home.db")
+
+
+@pytest.fixture
+def router(tmp_path):
+    return ShardRouter(
+        [sqlite_file(tmp_path / f"shard{i}.db") for i in range(SHARDS)]
+    )
+
+
+@pytest.fixture
+def sharded_bus(home, router):
+    bus = bootstrap.bootstrap(
+        start_orm=True,
+        uow=unit_of_work.SqlAlchemyUnitOfWork(home, shards=router),
+        notifications=mock.Mock(),
+        publish=lambda *args: None,
+    )
+    yield bus
+    clear_mappers()
+
+
+def skus_on_each_shard():
+    skus = {}
+    while len(skus) < SHARDS:
+        sku = random_sku()
+        skus.setdefault(shard_for(sku, SHARDS), sku)
+    return [skus[shard] for shard in range(SHARDS)]
+
+
+def test_shard_for_is_stable():
+    assert shard_for("RED-CHAIR", 4) == shard_for("RED-CHAIR", 4) == 1
+    assert {shard_for(random_sku(), SHARDS) for _ in range(50)} == {0, 1, 2}
+
+
+def test_products_live_on_the_shard_their_sku_hashes_to(sharded_bus, router, home):
+    skus = skus_on_each_shard()
+    for sku in skus:
+        sharded_bus.handle(commands.CreateBatch(random_batchref(), sku, 10, None))
+
+    for shard, sku in enumerate(skus):
+        session = router.session(shard)
+        assert [s for s, in session.execute("SELECT sku FROM products")] == [sku]
+    assert home().execute("SELECT count(*) FROM products").scalar() == 0
+
+    with sharded_bus.uow as uow:
+        assert sorted(uow.products.skus()) == sorted(skus)
+
+
+def test_allocates_and_reads_views_on_shards(sharded_bus):
+    sku, batchref, orderid = random_sku(), random_batchref(), random_orderid()
+    sharded_bus.handle(commands.CreateBatch(batchref, sku, 10, None))
+
+    assert sharded_bus.handle(commands.Allocate(orderid, sku, 4)) == [batchref]
+    assert views.allocations(orderid, sharded_bus.uow) == [
+        {"sku": sku, "batchref": batchref}
+    ]
+
+
+def test_get_by_batchref_resolves_through_the_directory(sharded_bus, router, home):
+    sku, batchref, orderid = random_sku(), random_batchref(), random_orderid()
+    sharded_bus.handle(commands.CreateBatch(batchref, sku, 10, None))
+    sharded_bus.handle(commands.Allocate(orderid, sku, 8))
+
+    assert router.lookup_batch(home(), batchref) == router.shard_for(sku)
+
+    sharded_bus.handle(commands.ChangeBatchQuantity(batchref, 5))
+
+    with sharded_bus.uow as uow:
+        [batch] = uow.products.get_by_batchref(batchref).batches
+        assert batch.available_quantity == 5
+        assert uow.products.get_by_batchref("no-such-batch") is None
+
+
+def test_rejects_units_of_work_that_span_shards(sharded_bus, router):
+    first, second, _ = skus_on_each_shard()
+    for sku in (first, second):
+        sharded_bus.handle(commands.CreateBatch(random_batchref(), sku, 10, None))
+
+    with pytest.raises(CrossShardRequest):
+        sharded_bus.handle(
+            commands.BulkAllocate(
+                [
+                    commands.Allocate(random_orderid(), first, 1),
+                    commands.Allocate(random_orderid(), second, 1),
+                ]
+            )
+        )
+
+    for shard in range(2):
+        session = router.session(shard)
+        assert session.execute("SELECT count(*) FROM allocations").scalar() == 0
+
+
+def test_compaction_runs_across_shards(sharded_bus, router):
+    old = date.today() - timedelta(days=60)
+    for sku in skus_on_each_shard():
+        sharded_bus.handle(commands.CreateBatch(random_batchref(), sku, 5, old))
+        sharded_bus.handle(commands.Allocate(random_orderid(), sku, 5))
+
+    assert compactor.compact(sharded_bus, date.today()) == SHARDS
+    for session in router.each_shard():
+        assert (
+            session.execute("SELECT count(*) FROM archived_allocations").scalar() == 1
+        )
+
+
+def test_a_failed_shard_commit_leaves_the_key_unclaimed(sharded_bus, router):
+    sku, batchref = random_sku(), random_batchref()
+    sharded_bus.handle(commands.CreateBatch(batchref, sku, 100, None))
+    cmd = commands.Allocate(random_orderid(), sku, 10, idempotency_key="k1")
+    commit = repository.ShardedRepository.commit
+
+    def lose_the_shard_commit(repo):
+        repo.session.commit = mock.Mock(side_effect=RuntimeError("shard went away"))
+        commit(repo)
+
+    with mock.patch.object(
+        repository.ShardedRepository, "commit", lose_the_shard_commit
+    ):
+        with pytest.raises(RuntimeError):
+            sharded_bus.handle(cmd)
+
+    assert sharded_bus.handle(cmd) == [batchref]
+    shard = router.session(shard_for(sku, SHARDS))
+    assert shard.execute("SELECT count(*) FROM allocations").scalar() == 1
+
+
+def test_a_retry_after_a_crash_finds_the_outcome_on_the_shard(sharded_bus, router):
+    sku, batchref = random_sku(), random_batchref()
+    sharded_bus.handle(commands.CreateBatch(batchref, sku, 100, None))
+    cmd = commands.Allocate(random_orderid(), sku, 10, idempotency_key="k1")
+    with mock.patch.object(
+        sharded_bus.idempotency, "record", side_effect=RuntimeError("crashed")
+    ):
+        with pytest.raises(RuntimeError):
+            sharded_bus.handle(cmd)
+
+    assert sharded_bus.handle(cmd) == [batchref]
+    shard = router.session(shard_for(sku, SHARDS))
+    assert shard.execute("SELECT count(*) FROM allocations").scalar() == 1
@@ -0,0 +1,99 @@
+from unittest import mock
+import pytest
+from allocation import bootstrap
+from allocation.adapters import sql_profiling
+from allocation.domain import commands, events
+from allocation.service_layer import unit_of_work
+from ..random_refs import random_sku, random_batchref, random_orderid
+
+pytestmark = pytest.mark.usefixtures("mappers")
+
+
+def bus_with(profiler, session_factory):
+    return bootstrap.bootstrap(
+        start_orm=False,
+        uow=unit_of_work.SqlAlchemyUnitOfWork(session_factory, profiler=profiler),
+        notifications=mock.Mock(),
+        publish=lambda *args: None,
+    )
+
+
+def test_records_statements_and_time_per_uow_and_message(sqlite_session_factory):
+    profiler = sql_profiling.SqlProfiler()
+    bus = bus_with(profiler, sqlite_session_factory)
+    sku = random_sku()
+    bus.handle(commands.CreateBatch(random_batchref(), sku, 100, None))
+    bus.handle(commands.Allocate(random_orderid(), sku, 10))
+
+    assert profiler.stats["CreateBatch"].uows == 1
+    assert profiler.stats["Allocate"].uows == 1
+    assert profiler.stats["Allocate"].statements > 0
+    assert profiler.stats["Allocate"].db_time > 0
+    assert profiler.stats["Allocate"].rows > 0
+    assert isinstance(bus.uow.profile.message, events.Allocated)
+    assert profiler.stats["Allocated"].uows == 1
+
+
+def test_counts_the_rows_each_uow_fetches(sqlite_session_factory):
+    bus = bus_with(None, sqlite_session_factory)
+    sku = random_sku()
+    for _ in range(3):
+        bus.handle(commands.CreateBatch(random_batchref(), sku, 10, None))
+
+    profiler = sql_profiling.SqlProfiler()
+    uow = unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory, profiler=profiler)
+    with uow:
+        uow.session.execute(
+            "SELECT * FROM batches WHERE sku=:sku", dict(sku=sku)
+        ).fetchall()
+        uow.session.execute("SELECT 1 UNION SELECT 2").first()
+
+    assert uow.profile.rows == 4
+    assert profiler.stats["<none>"].rows == 4
+
+
+def test_statements_outside_a_uow_are_not_counted(sqlite_session_factory):
+    profiler = sql_profiling.SqlProfiler()
+    uow = unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory, profiler=profiler)
+    with uow:
+        uow.session.execute("SELECT 1").all()
+
+    session = sqlite_session_factory()
+    for _ in range(3):
+        session.execute("SELECT 1 UNION SELECT 2").all()
+
+    assert list(profiler.stats) == ["<none>"]
+    assert profiler.stats["<none>"].uows == 1
+    assert profiler.stats["<none>"].statements == 1
+    assert profiler.stats["<none>"].rows == 1
+
+
+def test_warns_when_over_statement_budget(sqlite_session_factory):
+    profiler = sql_profiling.SqlProfiler(statement_budget=1)
+    bus = bus_with(profiler, sqlite_session_factory)
+    with pytest.warns(sql_profiling.SqlBudgetWarning, match="over the budget of 1"):
+        bus.handle(commands.CreateBatch(random_batchref(), random_sku(), 100, None))
+    assert bus.uow.profile.violations
+
+
+def test_detects_repeated_queries_in_strict_mode(sqlite_session_factory):
+    strict = sql_profiling.SqlProfiler(repeat_threshold=3, strict=True)
+    uow = unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory, profiler=strict)
+    with pytest.raises(sql_profiling.SqlBudgetExceeded, match="possible N\\+1"):
+        with uow:
+            for ref in ["b1", "b2", "b3", "b4"]:
+                uow.session.execute(
+                    "SELECT * FROM batches WHERE reference=:ref", dict(ref=ref)
+                )
+
+
+def test_allocating_across_many_batches_loads_them_eagerly(sqlite_session_factory):
+    bus = bus_with(None, sqlite_session_factory)
+    sku = random_sku()
+    for _ in range(5):
+        bus.handle(commands.CreateBatch(random_batchref(), sku, 1, None))
+
+    strict = sql_profiling.SqlProfiler(repeat_threshold=3, strict=True)
+    bus = bus_with(strict, sqlite_session_factory)
+    bus.handle(commands.Allocate(random_orderid(), sku, 10))
+    assert strict.stats["Allocate"].statements > 0
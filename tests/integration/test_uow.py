@@ -2,9 +2,11 @@
 import threading
 import time
 import traceback
-from typing import List
+import zlib
+from typing import Dict, List
 from unittest.mock import Mock
 import pytest
+from sqlalchemy.orm import sessionmaker
 from allocation.domain import model
 from allocation.service_layer import unit_of_work
 from ..random_refs import random_sku, random_batchref, random_orderid
@@ -78,6 +80,67 @@ def test_rolls_back_on_error(sqlite_session_factory):
     assert rows == []
 
 
+@pytest.fixture(params=[False, True], ids=["tables", "events"])
+def make_uow(request, sqlite_session_factory):
+    return lambda: unit_of_work.SqlAlchemyUnitOfWork(
+        sqlite_session_factory, event_sourced=request.param
+    )
+
+
+def add_product(make_uow, sku, *batches):
+    with make_uow() as uow:
+        uow.products.add(model.Product(sku, list(batches)))
+        uow.commit()
+
+
+def test_uow_can_add_and_allocate_to_a_product(make_uow):
+    add_product(
+        make_uow,
+        "HIPSTER-WORKBENCH",
+        model.Batch("batch1", "HIPSTER-WORKBENCH", 100, None),
+    )
+
+    with make_uow() as uow:
+        product = uow.products.get(sku="HIPSTER-WORKBENCH")
+        product.allocate(model.OrderLine("o1", "HIPSTER-WORKBENCH", 10))
+        uow.commit()
+
+    with make_uow() as uow:
+        product = uow.products.get_by_batchref("batch1")
+        [batch] = product.batches
+        assert batch.available_quantity == 90
+        assert uow.products.exists("HIPSTER-WORKBENCH")
+        assert list(uow.products.skus()) == ["HIPSTER-WORKBENCH"]
+
+
+def test_product_changes_are_rolled_back_without_a_commit(make_uow):
+    with make_uow() as uow:
+        uow.products.add(model.Product("MEDIUM-PLINTH", []))
+
+    with make_uow() as uow:
+        assert uow.products.get(sku="MEDIUM-PLINTH") is None
+        assert not uow.products.exists("MEDIUM-PLINTH")
+
+
+def test_product_changes_are_rolled_back_on_error(make_uow):
+    add_product(
+        make_uow, "LARGE-FORK", model.Batch("batch1", "LARGE-FORK", 100, None)
+    )
+
+    with pytest.raises(ZeroDivisionError):
+        with make_uow() as uow:
+            uow.products.get(sku="LARGE-FORK").allocate(
+                model.OrderLine("o1", "LARGE-FORK", 10)
+            )
+            uow.commit()
+            uow.products.get(sku="LARGE-FORK").change_batch_quantity("batch1", 5)
+            raise ZeroDivisionError()
+
+    with make_uow() as uow:
+        [batch] = uow.products.get(sku="LARGE-FORK").batches
+        assert batch.available_quantity == 90
+
+
 def try_to_allocate(orderid, sku, exceptions, session_factory):
     line = model.OrderLine(orderid, sku, 10)
     try:
@@ -130,3 +193,68 @@ def test_concurrent_updates_to_version_are_not_allowed(postgres_session_factory)
     assert orders.rowcount == 1
     with unit_of_work.SqlAlchemyUnitOfWork(postgres_session_factory) as uow:
         uow.session.execute("select 1")
+
+
+def split_stock(session_factory, sku, buckets):
+    with unit_of_work.SqlAlchemyUnitOfWork(session_factory) as uow:
+        uow.products.get(sku=sku).split_stock(buckets)
+        uow.commit()
+
+
+def test_bucket_allocations_only_write_their_bucket(sqlite_session_factory):
+    session = sqlite_session_factory()
+    insert_batch(session, "batch1", "HOT-KETTLE", 100, None)
+    session.commit()
+    split_stock(sqlite_session_factory, "HOT-KETTLE", 4)
+
+    with unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory) as uow:
+        uow.products.get(sku="HOT-KETTLE").allocate(
+            model.OrderLine("o1", "HOT-KETTLE", 10)
+        )
+        uow.commit()
+
+    assert get_allocated_batch_ref(session, "o1", "HOT-KETTLE") == "batch1"
+    [[product_version]] = session.execute(
+        "SELECT version_number FROM products WHERE sku='HOT-KETTLE'"
+    )
+    assert product_version == 2
+    with unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory) as uow:
+        buckets = uow.products.get(sku="HOT-KETTLE").buckets
+        assert [b.position for b in buckets] == [0, 1, 2, 3]
+        assert sorted(b.available_quantity for b in buckets) == [15, 25, 25, 25]
+        assert sorted(b.version_number for b in buckets) == [1, 1, 1, 2]
+
+
+def test_concurrent_allocations_to_different_buckets_both_commit(postgres_db):
+    # buckets rely on REPEATABLE READ, as DEFAULT_SESSION_FACTORY uses: under
+    # SERIALIZABLE the two allocations read each other's bucket, and SSI aborts one
+    postgres_session_factory = sessionmaker(
+        bind=postgres_db.execution_options(isolation_level="REPEATABLE READ")
+    )
+    sku, batch = random_sku(), random_batchref()
+    session = postgres_session_factory()
+    insert_batch(session, batch, sku, 100, eta=None, product_version=1)
+    session.commit()
+    split_stock(postgres_session_factory, sku, 2)
+
+    # the bucket an order starts from is picked from its orderid
+    orders = {}  # type: Dict[int, str]
+    while len(orders) < 2:
+        orderid = random_orderid()
+        orders.setdefault(zlib.crc32(orderid.encode()) % 2, orderid)
+    exceptions = []  # type: List[Exception]
+    threads = [
+        threading.Thread(
+            target=try_to_allocate,
+            args=(orderid, sku, exceptions, postgres_session_factory),
+        )
+        for orderid in orders.values()
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert exceptions == []
+    for orderid in orders.values():
+        assert get_allocated_batch_ref(session, orderid, sku) == batch
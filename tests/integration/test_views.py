@@ -1,10 +1,14 @@
 # pylint: disable=redefined-outer-name
 from datetime import date
-from sqlalchemy.orm import clear_mappers
+from sqlalchemy import create_engine
+from sqlalchemy.orm import clear_mappers, sessionmaker
+from sqlalchemy.pool import QueuePool
 from unittest import mock
 import pytest
 from allocation import bootstrap, views
+from allocation.adapters.orm import metadata
 from allocation.domain import commands
+from allocation.domain.policies import PolicyRegistry
 from allocation.service_layer import unit_of_work
 
 today = date.today()
@@ -47,3 +51,154 @@ def test_deallocation(sqlite_bus):
     assert views.allocations("o1", sqlite_bus.uow) == [
         {"sku": "sku1", "batchref": "b2"},
     ]
+
+
+def test_a_quantity_cut_updates_the_view_in_one_commit(sqlite_bus):
+    sqlite_bus.handle(commands.CreateBatch("b1", "sku1", 50, None))
+    sqlite_bus.handle(commands.CreateBatch("b2", "sku1", 50, today))
+    for orderid in ["o1", "o2", "o3"]:
+        sqlite_bus.handle(commands.Allocate(orderid, "sku1", 10))
+
+    with mock.patch.object(
+        sqlite_bus.uow, "commit", wraps=sqlite_bus.uow.commit
+    ) as commit:
+        sqlite_bus.handle(commands.ChangeBatchQuantity("b1", 5))
+    assert commit.call_count == 2
+
+    for orderid in ["o1", "o2", "o3"]:
+        assert views.allocations(orderid, sqlite_bus.uow) == [
+            {"sku": "sku1", "batchref": "b2"},
+        ]
+
+
+def test_evicting_part_of_a_split_line_keeps_the_rest(sqlite_session_factory):
+    bus = bootstrap.bootstrap(
+        start_orm=True,
+        uow=unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory),
+        notifications=mock.Mock(),
+        publish=lambda *args: None,
+        policies=PolicyRegistry(default="split"),
+    )
+    try:
+        bus.handle(commands.CreateBatch("b1", "sku1", 10, None))
+        bus.handle(commands.CreateBatch("b2", "sku1", 10, today))
+        bus.handle(commands.Allocate("o1", "sku1", 15))
+        assert len(views.allocations("o1", bus.uow)) == 2
+
+        bus.handle(commands.ChangeBatchQuantity("b2", 2))
+
+        assert views.allocations("o1", bus.uow) == [
+            {"sku": "sku1", "batchref": "b1"},
+        ]
+    finally:
+        clear_mappers()
+
+
+def test_reallocating_a_split_part_next_to_its_other_part(sqlite_session_factory):
+    bus = bootstrap.bootstrap(
+        start_orm=True,
+        uow=unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory),
+        notifications=mock.Mock(),
+        publish=lambda *args: None,
+        policies=PolicyRegistry(default="split"),
+    )
+    try:
+        bus.handle(commands.CreateBatch("a", "sku1", 5, None))
+        bus.handle(commands.CreateBatch("b", "sku1", 5, today))
+        bus.handle(commands.Allocate("o1", "sku1", 10))
+        bus.handle(commands.ChangeBatchQuantity("a", 10))
+
+        bus.handle(commands.ChangeBatchQuantity("b", 0))
+
+        assert views.allocations("o1", bus.uow) == [
+            {"sku": "sku1", "batchref": "a"},
+        ]
+        with bus.uow as uow:
+            a, _b = uow.products.get("sku1").batches
+            assert a.available_quantity == 0
+    finally:
+        clear_mappers()
+
+
+def sqlite_file(path, **kwargs):
+    engine = create_engine(f"sqlite:///{path}", **kwargs)
+    metadata.create_all(engine)
+    return sessionmaker(bind=engine)
+
+
+def add_view_row(session_factory, orderid, batchref):
+    session = session_factory()
+    session.execute(
+        "INSERT INTO allocations_view (orderid, sku, batchref) VALUES (:o, 'sku', :b)",
+        dict(o=orderid, b=batchref),
+    )
+    session.commit()
+
+
+@pytest.fixture
+def primary_and_replica(tmp_path):
+    primary = sqlite_file(tmp_path / "primary.db", poolclass=QueuePool, pool_size=3)
+    replica = sqlite_file(tmp_path / "replica.db", poolclass=QueuePool, pool_size=2)
+    add_view_row(primary, "order1", "from-primary")
+    add_view_row(replica, "order1", "from-replica")
+    return primary, replica
+
+
+def test_views_read_from_the_replica(primary_and_replica):
+    primary, replica = primary_and_replica
+    read_uow = unit_of_work.ReadOnlyUnitOfWork(replica, primary)
+
+    [row] = views.allocations("order1", read_uow)
+
+    assert row["batchref"] == "from-replica"
+    assert read_uow.replica_reads == 1
+
+
+def test_falls_back_to_the_primary_when_the_replica_lags(primary_and_replica):
+    primary, replica = primary_and_replica
+    lag = [10.0]
+    clock = [0.0]
+    read_uow = unit_of_work.ReadOnlyUnitOfWork(
+        replica,
+        primary,
+        max_lag_seconds=5,
+        lag_check_seconds=1,
+        lag_probe=lambda session: lag[0],
+        clock=lambda: clock[0],
+    )
+
+    assert views.allocations("order1", read_uow)[0]["batchref"] == "from-primary"
+
+    lag[0] = 0.5
+    assert views.allocations("order1", read_uow)[0]["batchref"] == "from-primary"
+    clock[0] = 1.0
+    assert views.allocations("order1", read_uow)[0]["batchref"] == "from-replica"
+    assert (read_uow.primary_fallbacks, read_uow.replica_reads) == (2, 1)
+
+
+def test_falls_back_to_the_primary_when_lag_is_unknown(primary_and_replica):
+    primary, replica = primary_and_replica
+
+    def broken_probe(session):
+        raise RuntimeError("replica is down")
+
+    read_uow = unit_of_work.ReadOnlyUnitOfWork(
+        replica, primary, max_lag_seconds=5, lag_probe=broken_probe
+    )
+
+    assert views.allocations("order1", read_uow)[0]["batchref"] == "from-primary"
+    assert read_uow.stats()["replica_lag"] is None
+
+
+def test_reports_replica_and_primary_pools_separately(primary_and_replica):
+    primary, replica = primary_and_replica
+    read_uow = unit_of_work.ReadOnlyUnitOfWork(replica, primary)
+
+    with read_uow:
+        read_uow.session.execute("SELECT 1")
+        stats = read_uow.stats()
+
+    assert stats["replica"]["size"] == 2
+    assert stats["replica"]["checked_out"] == 1
+    assert stats["primary"]["size"] == 3
+    assert stats["primary"]["checked_out"] == 0
@@ -0,0 +1,65 @@
+import argparse
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from allocation import config
+from tests.random_refs import random_batchref, random_orderid, random_sku
+
+
+def run_allocations(url, total, concurrency):
+    sku = random_sku()
+    r = requests.post(
+        f"{url}/add_batch",
+        json={"ref": random_batchref(), "sku": sku, "qty": total * 10, "eta": None},
+    )
+    assert r.status_code == 201
+
+    def allocate(_):
+        start = time.perf_counter()
+        r = requests.post(
+            f"{url}/allocate",
+            json={"orderid": random_orderid(), "sku": sku, "qty": 1},
+        )
+        return time.perf_counter() - start, r.status_code == 202
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(allocate, range(total)))
+    elapsed = time.perf_counter() - start
+
+    latencies = sorted(latency for latency, _ in results)
+    percentiles = statistics.quantiles(latencies, n=100)
+    return dict(
+        throughput=total / elapsed,
+        p50=percentiles[49],
+        p95=percentiles[94],
+        p99=percentiles[98],
+        errors=sum(1 for _, ok in results if not ok),
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="compare /allocate throughput of the flask and asgi apps"
+    )
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    args = parser.parse_args()
+
+    for name, url in [
+        ("flask", config.get_api_url()),
+        ("asgi", config.get_async_api_url()),
+    ]:
+        stats = run_allocations(url, args.requests, args.concurrency)
+        print(
+            f"{name:>6}: {stats['throughput']:8.1f} req/s"
+            f"  p50={stats['p50'] * 1000:.1f}ms"
+            f"  p95={stats['p95'] * 1000:.1f}ms"
+            f"  p99={stats['p99'] * 1000:.1f}ms"
+            f"  errors={stats['errors']}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+import threading
+import time
+import pytest
+from allocation import config
+from allocation.service_layer.admission import (
+    AdmissionController,
+    DeadlineExceeded,
+    QueueFull,
+)
+
+
+def hold(admission, release: threading.Event, **kwargs):
+    entered = threading.Event()
+
+    def run():
+        with admission.admit(**kwargs):
+            entered.set()
+            release.wait(5)
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    return thread, entered
+
+
+def test_admits_up_to_the_limit_and_queues_the_rest():
+    admission = AdmissionController(limit=1, queue_size=1, queue_timeout=5)
+    release, release_second = threading.Event(), threading.Event()
+    first, first_in = hold(admission, release)
+    assert first_in.wait(1)
+    second, second_in = hold(admission, release_second)
+
+    while not admission.waiting:
+        time.sleep(0.001)
+    assert admission.under_pressure()
+    assert not second_in.is_set()
+
+    release.set()
+    assert second_in.wait(1)
+    first.join()
+    assert admission.stats()["admitted"] == 2
+    assert admission.stats()["in_flight"] == 1
+    release_second.set()
+    second.join()
+
+
+def test_rejects_when_the_queue_is_full():
+    admission = AdmissionController(limit=1, queue_size=0)
+    release = threading.Event()
+    thread, entered = hold(admission, release)
+    assert entered.wait(1)
+
+    with pytest.raises(QueueFull) as e:
+        with admission.admit():
+            pass
+
+    assert e.value.retry_after >= 1
+    assert admission.rejected == 1
+    release.set()
+    thread.join()
+
+
+def test_rejects_when_the_wait_outlives_the_deadline():
+    admission = AdmissionController(limit=1, queue_size=10, queue_timeout=0.05)
+    release = threading.Event()
+    thread, entered = hold(admission, release)
+    assert entered.wait(1)
+
+    started = time.monotonic()
+    with pytest.raises(DeadlineExceeded):
+        with admission.admit():
+            pass
+    assert time.monotonic() - started < 1
+
+    with pytest.raises(DeadlineExceeded):
+        with admission.admit(arrived_at=time.monotonic() - 1):
+            pass
+    release.set()
+    thread.join()
+    assert not admission.under_pressure()
+
+
+def test_using_every_slot_is_not_pressure():
+    admission = AdmissionController(limit=1)
+    with admission.admit():
+        assert not admission.under_pressure()
+
+
+def test_blocking_admission_ignores_the_queue_bounds():
+    admission = AdmissionController(limit=1, queue_size=0, queue_timeout=0.01)
+    release = threading.Event()
+    thread, entered = hold(admission, release)
+    assert entered.wait(1)
+
+    threading.Timer(0.05, release.set).start()
+    with admission.admit(blocking=True):
+        assert release.is_set()
+    thread.join()
+
+
+def test_adaptive_limit_backs_off_when_slow_and_recovers_when_fast():
+    admission = AdmissionController(limit=10, target_latency=0.01)
+    for _ in range(10):
+        with admission.admit():
+            time.sleep(0.02)
+    assert admission.current_limit < 10
+
+    shrunk = admission.limit
+    release = threading.Event()
+    holders = [hold(admission, release) for _ in range(admission.current_limit - 1)]
+    for _thread, entered in holders:
+        assert entered.wait(1)
+    with admission.admit():
+        pass
+    release.set()
+    for thread, _entered in holders:
+        thread.join()
+    assert admission.limit > shrunk
+
+
+def test_the_consumer_limit_follows_its_worker_count(monkeypatch):
+    monkeypatch.setenv("ADMISSION_LIMIT", "16")
+    monkeypatch.setenv("REDIS_WORKERS", "3")
+    assert config.get_consumer_admission_settings()["limit"] == 3
+
+    monkeypatch.setenv("REDIS_ADMISSION_LIMIT", "2")
+    assert config.get_consumer_admission_settings()["limit"] == 2
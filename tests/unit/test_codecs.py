@@ -0,0 +1,109 @@
+import json
+from datetime import date
+import pytest
+from allocation.adapters import codecs
+from allocation.domain import commands, events
+from allocation.service_layer import tracing
+
+MESSAGES = [
+    commands.Allocate("o1", "RED-CHAIR", 10),
+    commands.Allocate("o1", "RED-CHAIR", 10, idempotency_key="retry-1"),
+    commands.CreateBatch("b1", "RED-CHAIR", 100, date(2011, 1, 2)),
+    commands.CreateBatch("b1", "RED-CHAIR", 100, None),
+    commands.ChangeBatchQuantity("b1", 50),
+    commands.BulkAllocate(
+        [
+            commands.Allocate("o1", "RED-CHAIR", 1),
+            commands.Allocate("o2", "BLUE-ÇHAIR", 2),
+        ]
+    ),
+    commands.ArchiveConsumedBatches("RED-CHAIR", date(2011, 1, 2)),
+    commands.SplitStock("RED-CHAIR", 4),
+    events.Allocated("o1", "RED-CHAIR", 10, "b1"),
+    events.Deallocated("o1", "RED-CHAIR", 10),
+    events.Deallocated("o1", "RED-CHAIR", 10, "b1"),
+    events.AllocationArchived("o1", "RED-CHAIR", 10, "b1"),
+    events.OutOfStock("RED-CHAIR"),
+    events.BatchCreated("RED-CHAIR", "b1", 100, date(2011, 1, 2)),
+    events.BatchCreated("RED-CHAIR", "b1", 100),
+    events.BatchQuantityChanged("RED-CHAIR", "b1", 50),
+    events.StockSplit("RED-CHAIR", 4),
+]
+
+
+@pytest.mark.parametrize("codec", codecs.CODECS.values(), ids=codecs.CODECS.keys())
+@pytest.mark.parametrize("message", MESSAGES, ids=repr)
+def test_round_trips_every_message_type(codec, message):
+    assert codecs.decode(codec.encode(message)) == message
+
+
+def test_every_command_and_event_has_a_type_id():
+    assert set(codecs.MESSAGE_TYPES) == {type(m).__name__ for m in MESSAGES}
+
+
+def test_json_payloads_stay_readable_by_existing_consumers():
+    payload = codecs.get_codec("json").encode(events.Allocated("o1", "LAMP", 3, "b1"))
+    assert json.loads(payload) == {
+        "orderid": "o1",
+        "sku": "LAMP",
+        "qty": 3,
+        "batchref": "b1",
+        "_v": codecs.SCHEMA_VERSION,
+        "_type": "Allocated",
+    }
+
+
+def test_decodes_untagged_json_as_the_default_type():
+    payload = json.dumps({"batchref": "b1", "qty": 5}).encode()
+    cmd = codecs.decode(payload, default_type=commands.ChangeBatchQuantity)
+    assert cmd == commands.ChangeBatchQuantity(ref="b1", qty=5)
+
+
+def test_binary_payloads_are_smaller_than_json():
+    message = events.Allocated("order-123", "SMALL-TABLE", 10, "batch-001")
+    binary = codecs.get_codec("binary").encode(message)
+    assert binary[0] == codecs.BINARY_MAGIC
+    assert len(binary) < len(codecs.get_codec("json").encode(message)) / 2
+
+
+def test_rejects_unknown_binary_schema_versions():
+    payload = bytearray(codecs.get_codec("binary").encode(events.OutOfStock("LAMP")))
+    payload[1] = codecs.SCHEMA_VERSION + 1
+    with pytest.raises(codecs.CodecError):
+        codecs.decode(bytes(payload))
+
+
+def test_rejects_unknown_json_schema_versions():
+    data = json.loads(codecs.get_codec("json").encode(events.OutOfStock("LAMP")))
+    data["_v"] = codecs.SCHEMA_VERSION + 1
+    with pytest.raises(codecs.CodecError):
+        codecs.decode(json.dumps(data).encode())
+
+
+def test_rejects_unknown_message_types():
+    json_payload = json.dumps({"_v": codecs.SCHEMA_VERSION, "_type": "Unknown"})
+    with pytest.raises(codecs.CodecError):
+        codecs.decode(json_payload.encode())
+
+    binary_payload = bytearray(
+        codecs.get_codec("binary").encode(events.OutOfStock("X"))
+    )
+    unused_id = next(i for i in range(2**16) if i not in codecs.TYPES_BY_ID)
+    binary_payload[2:4] = unused_id.to_bytes(2, "big")
+    with pytest.raises(codecs.CodecError):
+        codecs.decode(bytes(binary_payload))
+
+
+@pytest.mark.parametrize("codec", codecs.CODECS.values(), ids=codecs.CODECS.keys())
+def test_trace_context_travels_with_the_message(codec):
+    root = tracing.root_context()
+    context = root.caused(tracing.new_span_id())
+    message = tracing.attach(events.Allocated("o1", "LAMP", 3, "b1"), context)
+
+    decoded = codecs.decode(codec.encode(message))
+
+    assert tracing.context_of(decoded) == context
+    assert (
+        tracing.context_of(codecs.decode(codec.encode(events.OutOfStock("X"))))
+        is None
+    )
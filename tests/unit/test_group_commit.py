@@ -0,0 +1,100 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+from allocation.domain import commands
+from allocation.service_layer.group_commit import GroupCommitter
+from allocation.service_layer.handlers import InvalidSku
+
+
+class FakeBus:
+    def __init__(self, fail_on=None):
+        self.handled = []
+        self.fail_on = fail_on
+        self.lock = threading.Lock()
+
+    def handle(self, cmd):
+        with self.lock:
+            self.handled.append(cmd)
+        if any(line.orderid == self.fail_on for line in cmd.lines):
+            raise RuntimeError("database went away")
+        return [
+            [
+                (
+                    InvalidSku(f"Invalid sku {line.sku}")
+                    if line.sku == "NOPE"
+                    else f"batch-{line.orderid}"
+                )
+                for line in cmd.lines
+            ]
+        ]
+
+
+def allocate_concurrently(committer, cmds):
+    def allocate(cmd):
+        try:
+            return committer.allocate(cmd)
+        except Exception as e:  # pylint: disable=broad-except
+            return e
+
+    with ThreadPoolExecutor(len(cmds)) as executor:
+        return list(executor.map(allocate, cmds))
+
+
+def test_concurrent_allocations_for_a_sku_share_one_commit():
+    bus = FakeBus()
+    committer = GroupCommitter(bus.handle, window_seconds=0.05)
+    cmds = [commands.Allocate(f"o{i}", "LAMP", 1) for i in range(8)]
+
+    results = allocate_concurrently(committer, cmds)
+
+    assert results == [f"batch-o{i}" for i in range(8)]
+    assert len(bus.handled) == 1
+    assert sorted(line.orderid for line in bus.handled[0].lines) == sorted(
+        cmd.orderid for cmd in cmds
+    )
+    assert (committer.commits, committer.allocations) == (1, 8)
+
+
+def test_each_sku_gets_its_own_unit_of_work():
+    bus = FakeBus()
+    committer = GroupCommitter(bus.handle, window_seconds=0.05)
+    cmds = [commands.Allocate(f"o{i}", ["LAMP", "CHAIR"][i % 2], 1) for i in range(6)]
+
+    allocate_concurrently(committer, cmds)
+
+    assert sorted(tuple({line.sku for line in cmd.lines}) for cmd in bus.handled) == [
+        ("CHAIR",),
+        ("LAMP",),
+    ]
+
+
+def test_invalid_sku_is_raised_to_the_caller():
+    bus = FakeBus()
+    committer = GroupCommitter(bus.handle, window_seconds=0.01)
+
+    assert committer.allocate(commands.Allocate("o1", "LAMP", 1)) == "batch-o1"
+    with pytest.raises(InvalidSku):
+        committer.allocate(commands.Allocate("o2", "NOPE", 1))
+
+
+def test_a_failed_commit_is_raised_to_every_caller_in_the_group():
+    bus = FakeBus(fail_on="o3")
+    committer = GroupCommitter(bus.handle, window_seconds=0.05)
+    cmds = [commands.Allocate(f"o{i}", "LAMP", 1) for i in range(5)]
+
+    results = allocate_concurrently(committer, cmds)
+
+    assert all(isinstance(r, RuntimeError) for r in results)
+    assert committer.allocate(commands.Allocate("o9", "LAMP", 1)) == "batch-o9"
+
+
+def test_large_groups_are_split_and_leadership_is_handed_on():
+    bus = FakeBus()
+    committer = GroupCommitter(bus.handle, window_seconds=0.05, max_batch=3)
+    cmds = [commands.Allocate(f"o{i}", "LAMP", 1) for i in range(7)]
+
+    results = allocate_concurrently(committer, cmds)
+
+    assert results == [f"batch-o{i}" for i in range(7)]
+    assert [len(cmd.lines) for cmd in bus.handled] == [3, 3, 1]
+    assert not committer._queues  # pylint: disable=protected-access
@@ -1,12 +1,14 @@
 # pylint: disable=no-self-use
 from __future__ import annotations
 from collections import defaultdict
+from contextlib import contextmanager
 from datetime import date
 from typing import Dict, List
 import pytest
 from allocation import bootstrap
-from allocation.domain import commands
+from allocation.domain import commands, model
 from allocation.service_layer import handlers
+from allocation.service_layer.stock_hints import StockHints
 from allocation.adapters import notifications, repository
 from allocation.service_layer import unit_of_work
 
@@ -16,6 +18,12 @@ class FakeRepository(repository.AbstractRepository):
         super().__init__()
         self._products = set(products)
 
+    def exists(self, sku):
+        return self._get(sku) is not None
+
+    def skus(self):
+        return [p.sku for p in self._products]
+
     def _add(self, product):
         self._products.add(product)
 
@@ -49,6 +57,21 @@ class FakeNotifications(notifications.AbstractNotifications):
         self.sent[destination].append(message)
 
 
+class FakeBufferedPublisher:
+    def __init__(self):
+        self.buffer = None
+        self.flushed = []  # type: List[List[str]]
+
+    def __call__(self, channel, event):
+        self.buffer.append(event.orderid)
+
+    @contextmanager
+    def buffered(self):
+        self.buffer = []
+        yield
+        self.flushed.append(self.buffer)
+
+
 def bootstrap_test_app():
     return bootstrap.bootstrap(
         start_orm=False,
@@ -110,6 +133,92 @@ class TestAllocate:
         ]
 
 
+class TestBulkAllocate:
+    def test_returns_an_outcome_per_line(self):
+        bus = bootstrap_test_app()
+        bus.handle(commands.CreateBatch("b1", "SHINY-KETTLE", 10, None))
+        bus.handle(commands.CreateBatch("b2", "DULL-KETTLE", 10, None))
+
+        [outcomes] = bus.handle(
+            commands.BulkAllocate(
+                [
+                    commands.Allocate("o1", "SHINY-KETTLE", 6),
+                    commands.Allocate("o2", "NONEXISTENTSKU", 1),
+                    commands.Allocate("o3", "DULL-KETTLE", 10),
+                    commands.Allocate("o4", "SHINY-KETTLE", 6),
+                ]
+            )
+        )
+
+        assert outcomes[0] == "b1"
+        assert isinstance(outcomes[1], handlers.InvalidSku)
+        assert str(outcomes[1]) == "Invalid sku NONEXISTENTSKU"
+        assert outcomes[2] == "b2"
+        assert outcomes[3] is None
+
+    def test_commits_once_for_all_lines(self):
+        bus = bootstrap_test_app()
+        bus.handle(commands.CreateBatch("b1", "TIDY-SHELF", 100, None))
+        bus.uow.committed = False
+
+        bus.handle(
+            commands.BulkAllocate(
+                [
+                    commands.Allocate("o1", "TIDY-SHELF", 10),
+                    commands.Allocate("o2", "TIDY-SHELF", 20),
+                ]
+            )
+        )
+
+        assert bus.uow.committed
+        [batch] = bus.uow.products.get("TIDY-SHELF").batches
+        assert batch.available_quantity == 70
+
+    def test_sends_email_for_each_out_of_stock_line(self):
+        fake_notifs = FakeNotifications()
+        bus = bootstrap.bootstrap(
+            start_orm=False,
+            uow=FakeUnitOfWork(),
+            notifications=fake_notifs,
+            publish=lambda *args: None,
+        )
+        bus.handle(commands.CreateBatch("b1", "RARE-VASE", 1, None))
+        bus.handle(
+            commands.BulkAllocate(
+                [
+                    commands.Allocate("o1", "RARE-VASE", 1),
+                    commands.Allocate("o2", "RARE-VASE", 1),
+                    commands.Allocate("o3", "RARE-VASE", 1),
+                ]
+            )
+        )
+        assert fake_notifs.sent["stock@made.com"] == [
+            "Out of stock for RARE-VASE",
+            "Out of stock for RARE-VASE",
+        ]
+
+
+class TestPublishing:
+    def test_events_are_published_once_handling_is_complete(self):
+        publisher = FakeBufferedPublisher()
+        bus = bootstrap.bootstrap(
+            start_orm=False,
+            uow=FakeUnitOfWork(),
+            notifications=FakeNotifications(),
+            publish=publisher,
+        )
+        bus.handle(commands.CreateBatch("b1", "NOISY-CLOCK", 100, None))
+        bus.handle(
+            commands.BulkAllocate(
+                [
+                    commands.Allocate("o1", "NOISY-CLOCK", 10),
+                    commands.Allocate("o2", "NOISY-CLOCK", 10),
+                ]
+            )
+        )
+        assert publisher.flushed == [[], ["o1", "o2"]]
+
+
 class TestChangeBatchQuantity:
     def test_changes_available_quantity(self):
         bus = bootstrap_test_app()
@@ -140,3 +249,129 @@ class TestChangeBatchQuantity:
         assert batch1.available_quantity == 5
         # and 20 will be reallocated to the next batch
         assert batch2.available_quantity == 30
+
+    def test_reallocates_evicted_lines_in_one_commit(self):
+        bus = bootstrap_test_app()
+        bus.handle(commands.CreateBatch("batch1", "CROWDED-SHELF", 50, None))
+        bus.handle(commands.CreateBatch("batch2", "CROWDED-SHELF", 50, date.today()))
+        for i in range(5):
+            bus.handle(commands.Allocate(f"order{i}", "CROWDED-SHELF", 10))
+        commits = []
+        bus.uow._commit = lambda: commits.append(True)
+        loads = []
+        get_by_batchref = bus.uow.products._get_by_batchref
+        bus.uow.products._get_by_batchref = lambda ref: (
+            loads.append(ref) or get_by_batchref(ref)
+        )
+
+        bus.handle(commands.ChangeBatchQuantity("batch1", 10))
+
+        assert len(commits) == 1
+        assert loads == ["batch1"]
+        [batch1, batch2] = bus.uow.products.get(sku="CROWDED-SHELF").batches
+        assert batch1.available_quantity == 0
+        assert batch2.available_quantity == 10
+
+
+class TestSplitStock:
+    def test_new_batches_are_shared_between_buckets(self):
+        bus = bootstrap_test_app()
+        bus.handle(commands.CreateBatch("batch1", "BESTSELLING-MUG", 10, None))
+        bus.handle(commands.SplitStock("BESTSELLING-MUG", 2))
+        bus.handle(commands.CreateBatch("batch2", "BESTSELLING-MUG", 4, None))
+
+        product = bus.uow.products.get("BESTSELLING-MUG")
+        assert [b.quotas for b in product.buckets] == [
+            {"batch1": 5, "batch2": 2},
+            {"batch1": 5, "batch2": 2},
+        ]
+
+    def test_errors_for_invalid_sku(self):
+        bus = bootstrap_test_app()
+        with pytest.raises(handlers.InvalidSku):
+            bus.handle(commands.SplitStock("NONEXISTENTSKU", 2))
+
+
+class TestFastPath:
+    @staticmethod
+    def bus_with_hints(hints):
+        return bootstrap.bootstrap(
+            start_orm=False,
+            uow=FakeUnitOfWork(),
+            notifications=FakeNotifications(),
+            publish=lambda *args: None,
+            hints=hints,
+        )
+
+    @staticmethod
+    def count_loads(bus):
+        loads = []
+        get = bus.uow.products._get
+        bus.uow.products._get = lambda sku: loads.append(sku) or get(sku)
+        return loads
+
+    def test_rejects_known_exhausted_stock_without_loading_the_product(self):
+        hints = StockHints(ttl_seconds=5)
+        bus = self.bus_with_hints(hints)
+        bus.handle(commands.CreateBatch("b1", "HOT-LAMP", 10, None))
+        bus.handle(commands.Allocate("o1", "HOT-LAMP", 8))
+        assert bus.handle(commands.Allocate("o2", "HOT-LAMP", 5)) == [None]
+        loads = self.count_loads(bus)
+
+        assert bus.handle(commands.Allocate("o3", "HOT-LAMP", 5)) == [None]
+        assert bus.handle(commands.Allocate("o4", "HOT-LAMP", 2)) != [None]
+        assert loads == ["HOT-LAMP"]
+        assert hints.fast_rejections == 1
+
+    def test_new_stock_clears_the_hint(self):
+        bus = self.bus_with_hints(StockHints(ttl_seconds=5))
+        bus.handle(commands.CreateBatch("b1", "HOT-LAMP", 10, None))
+        assert bus.handle(commands.Allocate("o1", "HOT-LAMP", 20)) == [None]
+
+        bus.handle(commands.ChangeBatchQuantity("b1", 30))
+        assert bus.handle(commands.Allocate("o1", "HOT-LAMP", 20)) == ["b1"]
+        assert bus.handle(commands.Allocate("o2", "HOT-LAMP", 20)) == [None]
+
+        bus.handle(commands.CreateBatch("b2", "HOT-LAMP", 20, None))
+        assert bus.handle(commands.Allocate("o2", "HOT-LAMP", 20)) == ["b2"]
+
+    def test_hints_expire(self):
+        now = [0.0]
+        bus = self.bus_with_hints(StockHints(ttl_seconds=5, clock=lambda: now[0]))
+        bus.handle(commands.CreateBatch("b1", "HOT-LAMP", 10, None))
+        bus.handle(commands.Allocate("o1", "HOT-LAMP", 20))
+        bus.uow.products.get("HOT-LAMP").change_batch_quantity("b1", 30)
+
+        assert bus.handle(commands.Allocate("o1", "HOT-LAMP", 20)) == [None]
+        now[0] = 6
+        assert bus.handle(commands.Allocate("o1", "HOT-LAMP", 20)) == ["b1"]
+
+    def test_unknown_skus_are_rejected_from_the_known_set(self):
+        bus = self.bus_with_hints(StockHints())
+        bus.handle(commands.CreateBatch("b1", "HOT-LAMP", 10, None))
+        loads = self.count_loads(bus)
+        with pytest.raises(handlers.InvalidSku):
+            bus.handle(commands.Allocate("o1", "NONEXISTENTSKU", 1))
+        assert loads == []
+
+    def test_exhausted_stock_hints_are_off_by_default(self):
+        hints = StockHints()
+        bus = self.bus_with_hints(hints)
+        bus.handle(commands.CreateBatch("b1", "HOT-LAMP", 10, None))
+        assert bus.handle(commands.Allocate("o1", "HOT-LAMP", 20)) == [None]
+
+        bus.uow.products.get("HOT-LAMP").change_batch_quantity("b1", 30)
+        assert bus.handle(commands.Allocate("o1", "HOT-LAMP", 20)) == ["b1"]
+        assert hints.fast_rejections == 0
+
+    def test_never_rejects_a_sku_added_elsewhere(self):
+        bus = self.bus_with_hints(StockHints())
+        bus.handle(commands.CreateBatch("b1", "HOT-LAMP", 10, None))
+        with pytest.raises(handlers.InvalidSku):
+            bus.handle(commands.Allocate("o1", "NEW-LAMP", 1))
+
+        other_process = model.Product(
+            "NEW-LAMP", [model.Batch("b2", "NEW-LAMP", 5, None)]
+        )
+        bus.uow.products._add(other_process)
+        assert bus.handle(commands.Allocate("o1", "NEW-LAMP", 1)) == ["b2"]
@@ -0,0 +1,73 @@
+from datetime import datetime, timedelta
+from allocation import bootstrap
+from allocation.domain import commands
+from allocation.service_layer.idempotency import IdempotencyStore
+from .test_handlers import FakeNotifications, FakeUnitOfWork
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = datetime(2011, 1, 1)
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += timedelta(seconds=seconds)
+
+
+def bootstrap_test_app(idempotency):
+    return bootstrap.bootstrap(
+        start_orm=False,
+        uow=FakeUnitOfWork(),
+        notifications=FakeNotifications(),
+        publish=lambda *args: None,
+        idempotency=idempotency,
+    )
+
+
+def test_remembers_outcomes_until_they_expire():
+    clock = FakeClock()
+    store = IdempotencyStore(ttl_seconds=60, clock=clock)
+    assert store.lookup("k1") is None
+
+    store.record("k1", "batch1")
+    store.record("k2", None)
+    assert store.lookup("k1") == ("batch1",)
+    assert store.lookup("k2") == (None,)
+
+    clock.advance(61)
+    assert store.lookup("k1") is None
+    assert store.hits == 2
+
+
+def test_keeps_at_most_cache_size_outcomes_in_memory():
+    store = IdempotencyStore(cache_size=2)
+    for key in ["k1", "k2", "k3"]:
+        store.record(key, key)
+    assert store.lookup("k1") is None
+    assert store.lookup("k3") == ("k3",)
+
+
+def test_repeated_commands_are_only_handled_once():
+    bus = bootstrap_test_app(IdempotencyStore())
+    bus.handle(commands.CreateBatch("batch1", "LAMP", 100, None))
+
+    for _ in range(3):
+        [batchref] = bus.handle(
+            commands.Allocate("o1", "LAMP", 10, idempotency_key="retry-me")
+        )
+        assert batchref == "batch1"
+    bus.handle(commands.Allocate("o2", "LAMP", 10, idempotency_key="another"))
+
+    [batch] = bus.uow.products.get("LAMP").batches
+    assert batch.available_quantity == 80
+    assert bus.idempotency.hits == 2
+
+
+def test_commands_without_a_key_bypass_the_store():
+    bus = bootstrap_test_app(IdempotencyStore())
+    bus.handle(commands.CreateBatch("batch1", "LAMP", 100, None))
+    bus.handle(commands.Allocate("o1", "LAMP", 10))
+
+    assert (bus.idempotency.hits, bus.idempotency.recorded) == (0, 0)
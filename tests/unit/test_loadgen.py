@@ -0,0 +1,60 @@
+import io
+from collections import Counter
+import pytest
+from allocation.adapters import codecs
+from allocation.domain import commands, events
+from allocation.entrypoints import loadgen
+
+
+def test_streams_are_reproducible_from_a_seed():
+    shape = loadgen.TrafficShape(commands=200, skus=10, seed=42)
+    assert list(loadgen.generate(shape)) == list(loadgen.generate(shape))
+
+
+def test_every_sku_gets_a_batch_before_any_traffic():
+    shape = loadgen.TrafficShape(commands=100, skus=10, seed=1)
+    stream = list(loadgen.generate(shape))
+    assert all(isinstance(cmd, commands.CreateBatch) for cmd in stream[:10])
+    assert len({cmd.sku for cmd in stream[:10]}) == 10
+
+
+def test_sku_popularity_is_skewed():
+    shape = loadgen.TrafficShape(commands=5000, skus=100, zipf_s=1.2, seed=1)
+    allocations = Counter(
+        cmd.sku
+        for cmd in loadgen.generate(shape)
+        if isinstance(cmd, commands.Allocate)
+    )
+    [(_top_sku, top_count)] = allocations.most_common(1)
+    assert top_count > 10 * (5000 / 100)
+
+
+def test_change_batch_quantity_arrives_in_bursts_for_one_batch():
+    shape = loadgen.TrafficShape(
+        commands=500, skus=5, burst_probability=0.05, burst_size=10, seed=3
+    )
+    stream = list(loadgen.generate(shape))
+    changes = [
+        i
+        for i, cmd in enumerate(stream)
+        if isinstance(cmd, commands.ChangeBatchQuantity)
+    ]
+    assert changes
+    first = changes[0]
+    burst = stream[first : first + 10]
+    assert len({cmd.ref for cmd in burst}) == 1
+
+
+def test_written_streams_can_be_replayed():
+    shape = loadgen.TrafficShape(commands=100, skus=5, seed=7)
+    out = io.StringIO()
+    loadgen.write_stream(loadgen.generate(shape), out)
+    replayed = loadgen.read_stream(io.StringIO(out.getvalue()))
+    assert list(replayed) == list(loadgen.generate(shape))
+
+
+def test_replayed_streams_may_only_hold_commands():
+    out = io.StringIO()
+    loadgen.write_stream([events.OutOfStock("LAMP")], out)
+    with pytest.raises(codecs.CodecError):
+        list(loadgen.read_stream(io.StringIO(out.getvalue())))
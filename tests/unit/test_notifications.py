@@ -0,0 +1,152 @@
+import smtplib
+import threading
+from collections import defaultdict
+from typing import Dict, List
+import pytest
+from allocation.adapters import notifications
+
+
+class FakeSMTP:
+    connections = []  # type: List[FakeSMTP]
+
+    def __init__(self, host, port):
+        self.host, self.port = host, port
+        self.sent = []  # type: List[str]
+        self.disconnected = False
+        self.closed = False
+        FakeSMTP.connections.append(self)
+
+    def sendmail(self, from_addr, to_addrs, msg):
+        if self.disconnected:
+            raise smtplib.SMTPServerDisconnected("gone away")
+        self.sent.append(msg)
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture(autouse=True)
+def reset_fake_smtp():
+    FakeSMTP.connections = []
+
+
+def make_email_notifications():
+    pool = notifications.SMTPConnectionPool("smtp", 25, size=2, connect=FakeSMTP)
+    return notifications.EmailNotifications(pool=pool)
+
+
+def test_email_connections_are_reused():
+    email = make_email_notifications()
+    email.send("stock@made.com", "one")
+    email.send("stock@made.com", "two")
+    [server] = FakeSMTP.connections
+    assert len(server.sent) == 2
+
+
+def test_email_reconnects_when_the_server_disconnects():
+    email = make_email_notifications()
+    email.send("stock@made.com", "one")
+    FakeSMTP.connections[0].disconnected = True
+
+    email.send("stock@made.com", "two")
+
+    first, second = FakeSMTP.connections
+    assert first.closed
+    assert second.sent == ["Subject: allocation service notification\ntwo"]
+
+
+class FakeNotifications(notifications.AbstractNotifications):
+    def __init__(self):
+        self.sent = defaultdict(list)  # type: Dict[str, List[str]]
+
+    def send(self, destination, message):
+        self.sent[destination].append(message)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_background_notifications_collapse_repeats_within_the_window():
+    inner, clock = FakeNotifications(), FakeClock()
+    background = notifications.BackgroundNotifications(
+        inner, debounce_seconds=60, workers=1, clock=clock
+    )
+    for _ in range(5):
+        background.send("stock@made.com", "Out of stock for LAMP")
+    background.send("stock@made.com", "Out of stock for DESK")
+    background.send("buyers@made.com", "Out of stock for LAMP")
+    background.flush()
+
+    assert inner.sent["stock@made.com"] == [
+        "Out of stock for LAMP",
+        "Out of stock for DESK",
+    ]
+    assert inner.sent["buyers@made.com"] == ["Out of stock for LAMP"]
+    assert background.suppressed[("stock@made.com", "Out of stock for LAMP")] == 4
+
+
+def test_background_notifications_send_again_after_the_window():
+    inner, clock = FakeNotifications(), FakeClock()
+    background = notifications.BackgroundNotifications(
+        inner, debounce_seconds=60, clock=clock
+    )
+    background.send("stock@made.com", "Out of stock for LAMP")
+    background.send("stock@made.com", "Out of stock for LAMP")
+    clock.now = 61
+    background.send("stock@made.com", "Out of stock for LAMP")
+    background.flush()
+
+    assert inner.sent["stock@made.com"] == [
+        "Out of stock for LAMP",
+        "Out of stock for LAMP\n(1 similar notifications suppressed)",
+    ]
+
+
+def test_background_notifications_report_repeats_when_the_window_closes():
+    inner, clock = FakeNotifications(), FakeClock()
+    background = notifications.BackgroundNotifications(
+        inner, debounce_seconds=60, clock=clock
+    )
+    for _ in range(3):
+        background.send("stock@made.com", "Out of stock for LAMP")
+    clock.now = 61
+    background.flush_expired()
+    background.flush()
+
+    assert inner.sent["stock@made.com"] == [
+        "Out of stock for LAMP",
+        "Out of stock for LAMP\n(2 similar notifications suppressed)",
+    ]
+
+
+def test_background_notifications_send_on_several_connections_at_once():
+    class BlockingNotifications(notifications.AbstractNotifications):
+        def __init__(self):
+            self.both_sending = threading.Barrier(2, timeout=5)
+
+        def send(self, destination, message):
+            self.both_sending.wait()
+
+    inner = BlockingNotifications()
+    background = notifications.BackgroundNotifications(inner, workers=2)
+    background.send("stock@made.com", "Out of stock for LAMP")
+    background.send("stock@made.com", "Out of stock for DESK")
+    background.flush()
+
+    assert not inner.both_sending.broken
+
+
+def test_background_notifications_survive_send_failures():
+    class BrokenNotifications(notifications.AbstractNotifications):
+        def send(self, destination, message):
+            raise smtplib.SMTPServerDisconnected("gone away")
+
+    background = notifications.BackgroundNotifications(BrokenNotifications())
+    background.send("stock@made.com", "Out of stock for LAMP")
+    background.flush()
+    background.close()
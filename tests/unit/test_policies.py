@@ -0,0 +1,81 @@
+from datetime import date, timedelta
+import pytest
+from allocation.domain import events
+from allocation.domain.model import Batch, OrderLine, Product
+from allocation.domain.policies import POLICIES, PolicyRegistry
+
+today = date.today()
+tomorrow = today + timedelta(days=1)
+later = tomorrow + timedelta(days=10)
+
+
+def make_product(*batches):
+    return Product(
+        "LAMP", [Batch(ref, "LAMP", qty, eta) for ref, qty, eta in batches]
+    )
+
+
+def test_best_fit_picks_the_smallest_batch_that_fits():
+    product = make_product(
+        ("big", 100, None), ("small", 12, later), ("tiny", 5, None)
+    )
+    batchref = product.allocate(OrderLine("o1", "LAMP", 10), POLICIES["best_fit"])
+    assert batchref == "small"
+
+
+def test_best_fit_prefers_earlier_batches_on_equal_quantity():
+    product = make_product(("slow", 10, later), ("speedy", 10, tomorrow))
+    batchref = product.allocate(OrderLine("o1", "LAMP", 10), POLICIES["best_fit"])
+    assert batchref == "speedy"
+
+
+def test_split_prefers_a_single_batch():
+    product = make_product(("shipment", 10, tomorrow), ("warehouse", 5, None))
+    batchref = product.allocate(OrderLine("o1", "LAMP", 8), POLICIES["split"])
+    assert batchref == "shipment"
+    assert len(product.events) == 1
+
+
+def test_split_spreads_a_line_across_batches_in_eta_order():
+    product = make_product(
+        ("later", 10, later), ("warehouse", 5, None), ("soon", 4, today)
+    )
+    batchref = product.allocate(OrderLine("o1", "LAMP", 12), POLICIES["split"])
+    assert batchref == "warehouse"
+    assert product.events == [
+        events.Allocated("o1", "LAMP", 5, "warehouse"),
+        events.Allocated("o1", "LAMP", 4, "soon"),
+        events.Allocated("o1", "LAMP", 3, "later"),
+    ]
+    assert [b.available_quantity for b in product.batches] == [7, 0, 0]
+
+
+def test_split_is_out_of_stock_when_total_stock_is_short():
+    product = make_product(("warehouse", 5, None), ("soon", 4, today))
+    assert product.allocate(OrderLine("o1", "LAMP", 10), POLICIES["split"]) is None
+    assert product.events == [events.OutOfStock("LAMP")]
+
+
+@pytest.mark.parametrize("policy", POLICIES.values(), ids=POLICIES.keys())
+def test_indexes_follow_allocations_and_quantity_changes(policy):
+    product = make_product(("warehouse", 10, None), ("shipment", 10, tomorrow))
+    assert product.allocate(OrderLine("o1", "LAMP", 10), policy) == "warehouse"
+    assert product.allocate(OrderLine("o2", "LAMP", 10), policy) == "shipment"
+    assert product.allocate(OrderLine("o3", "LAMP", 1), policy) is None
+
+    product.change_batch_quantity("warehouse", 20)
+    assert product.allocate(OrderLine("o4", "LAMP", 10), policy) == "warehouse"
+
+    product.batches.append(Batch("new", "LAMP", 50, later))
+    assert product.allocate(OrderLine("o5", "LAMP", 50), policy) == "new"
+
+
+def test_registry_selects_policies_per_sku():
+    registry = PolicyRegistry("best_fit", {"LAMP": "split"})
+    assert registry.for_sku("LAMP") is POLICIES["split"]
+    assert registry.for_sku("CHAIR") is POLICIES["best_fit"]
+
+
+def test_registry_rejects_unknown_policies():
+    with pytest.raises(ValueError, match="unknown allocation policy"):
+        PolicyRegistry("cheapest")
@@ -1,8 +1,7 @@
 from datetime import date, timedelta
-from allocation.domain import events
+from allocation.domain import events, policies
 from allocation.domain.model import Product, OrderLine, Batch
 
-
 today = date.today()
 tomorrow = today + timedelta(days=1)
 later = tomorrow + timedelta(days=10)
@@ -72,3 +71,169 @@ def test_increments_version_number():
     product.version_number = 7
     product.allocate(line)
     assert product.version_number == 8
+
+
+def test_archives_allocations_of_consumed_batches():
+    consumed = Batch("consumed", "SOFA", 10, eta=today - timedelta(days=40))
+    shipping = Batch("shipping", "SOFA", 10, eta=today - timedelta(days=1))
+    in_stock = Batch("in-stock", "SOFA", 10, eta=None)
+    product = Product("SOFA", [consumed, shipping, in_stock], version_number=3)
+    for batch in [consumed, shipping]:
+        batch.allocate(OrderLine(f"o-{batch.reference}", "SOFA", 10))
+    in_stock.allocate(OrderLine("o-in-stock", "SOFA", 5))
+
+    archived = product.archive_consumed(arrived_before=today - timedelta(days=30))
+
+    assert archived == [("consumed", OrderLine("o-consumed", "SOFA", 10))]
+    assert not consumed.has_allocations
+    assert consumed.allocated_quantity == 10
+    assert consumed.available_quantity == 0
+    assert shipping.has_allocations
+    assert in_stock.has_allocations
+    assert product.version_number == 4
+    assert product.events == [
+        events.AllocationArchived("o-consumed", "SOFA", 10, "consumed")
+    ]
+
+
+def test_archived_quantity_cannot_be_deallocated():
+    batch = Batch("batch1", "SOFA", 20, eta=None)
+    product = Product("SOFA", [batch])
+    batch.allocate(OrderLine("old", "SOFA", 10))
+    batch.allocate(OrderLine("older", "SOFA", 10))
+    product.archive_consumed(arrived_before=today)
+    product.events.clear()
+    batch._purchased_quantity += 5
+    batch.allocate(OrderLine("new", "SOFA", 5))
+
+    product.change_batch_quantity("batch1", 5)
+
+    assert product.events == [
+        events.BatchQuantityChanged("SOFA", "batch1", 5),
+        events.Deallocated("new", "SOFA", 5, "batch1"),
+        events.OutOfStock("SOFA"),
+    ]
+    assert batch.available_quantity == -15
+
+
+def test_reallocates_evicted_lines_after_all_deallocations():
+    warehouse = Batch("warehouse", "SOFA", 20, eta=None)
+    shipment = Batch("shipment", "SOFA", 20, eta=tomorrow)
+    product = Product("SOFA", [warehouse, shipment])
+    for orderid in ["o1", "o2"]:
+        product.allocate(OrderLine(orderid, "SOFA", 10))
+    product.events.clear()
+
+    product.change_batch_quantity("warehouse", 5)
+
+    changed, deallocated, reallocated = (
+        product.events[0],
+        product.events[1:3],
+        product.events[3:],
+    )
+    assert changed == events.BatchQuantityChanged("SOFA", "warehouse", 5)
+    assert {type(e) for e in deallocated} == {events.Deallocated}
+    assert sorted(e.orderid for e in reallocated) == ["o1", "o2"]
+    assert all(e.batchref == "shipment" for e in reallocated)
+    assert shipment.available_quantity == 0
+
+
+def test_evicted_part_of_a_split_line_merges_with_its_other_part():
+    split = policies.POLICIES["split"]
+    a, b = Batch("a", "LAMP", 5, eta=None), Batch("b", "LAMP", 5, eta=tomorrow)
+    product = Product("LAMP", [a, b])
+    product.allocate(OrderLine("o1", "LAMP", 10), split)
+    product.change_batch_quantity("a", 10, split)
+    product.events.clear()
+
+    product.change_batch_quantity("b", 0, split)
+
+    assert a._allocations == {OrderLine("o1", "LAMP", 10)}
+    assert (a.available_quantity, b.available_quantity) == (0, 0)
+    assert product.events[-1] == events.Allocated("o1", "LAMP", 5, "a")
+
+
+def test_a_repeated_line_is_allocated_once():
+    batch = Batch("batch1", "LAMP", 20, eta=None)
+    product = Product("LAMP", [batch])
+    product.allocate(OrderLine("o1", "LAMP", 5))
+    product.events.clear()
+
+    assert product.allocate(OrderLine("o1", "LAMP", 5)) == "batch1"
+
+    assert batch.available_quantity == 15
+    assert product.events == []
+
+
+def test_split_stock_spreads_free_stock_over_buckets():
+    warehouse = Batch("warehouse", "LAMP", 10, eta=None)
+    shipment = Batch("shipment", "LAMP", 3, eta=tomorrow)
+    product = Product("LAMP", [warehouse, shipment])
+    product.allocate(OrderLine("o1", "LAMP", 2))
+
+    product.split_stock(4)
+
+    assert [b.quotas for b in product.buckets] == [
+        {"warehouse": 2, "shipment": 1},
+        {"warehouse": 2, "shipment": 1},
+        {"warehouse": 2, "shipment": 1},
+        {"warehouse": 2},
+    ]
+
+
+def test_bucket_allocations_leave_the_product_version_alone():
+    batch = Batch("batch1", "LAMP", 20, eta=None)
+    product = Product("LAMP", [batch])
+    product.split_stock(2)
+    version = product.version_number
+    bucket_versions = [b.version_number for b in product.buckets]
+
+    assert product.allocate(OrderLine("o1", "LAMP", 3)) == "batch1"
+
+    assert product.version_number == version
+    changed = [
+        b for b, v in zip(product.buckets, bucket_versions) if b.version_number != v
+    ]
+    assert len(changed) == 1
+    assert changed[0].available_quantity == 7
+    assert batch.available_quantity == 17
+    assert product.events[-1] == events.Allocated("o1", "LAMP", 3, "batch1")
+
+
+def test_allocations_no_bucket_can_hold_rebalance_every_bucket():
+    batch = Batch("batch1", "LAMP", 10, eta=None)
+    product = Product("LAMP", [batch])
+    product.split_stock(4)
+    version = product.version_number
+
+    assert product.allocate(OrderLine("big", "LAMP", 6)) == "batch1"
+
+    assert product.version_number == version + 1
+    assert sum(b.available_quantity for b in product.buckets) == 4
+    assert product.allocate(OrderLine("too-big", "LAMP", 5)) is None
+    assert product.events[-1] == events.OutOfStock("LAMP")
+
+
+def test_out_of_stock_leaves_the_buckets_alone():
+    batch = Batch("batch1", "LAMP", 10, eta=None)
+    product = Product("LAMP", [batch])
+    product.split_stock(4)
+    bucket_versions = [b.version_number for b in product.buckets]
+
+    assert product.allocate(OrderLine("too-big", "LAMP", 11)) is None
+
+    assert [b.version_number for b in product.buckets] == bucket_versions
+    assert product.events[-1] == events.OutOfStock("LAMP")
+
+
+def test_buckets_follow_batch_quantity_changes_and_can_be_merged():
+    batch = Batch("batch1", "LAMP", 10, eta=None)
+    product = Product("LAMP", [batch])
+    product.split_stock(2)
+
+    product.change_batch_quantity("batch1", 30)
+    assert [b.available_quantity for b in product.buckets] == [15, 15]
+
+    product.split_stock(1)
+    assert product.buckets == []
+    assert product.allocate(OrderLine("o1", "LAMP", 25)) == "batch1"
@@ -0,0 +1,94 @@
+import pytest
+from allocation.domain import commands
+from allocation.service_layer import tracing
+from .test_handlers import bootstrap_test_app
+
+
+@pytest.fixture
+def exporter():
+    exporter = tracing.InMemorySpanExporter()
+    tracing.tracer.exporters.append(exporter)
+    yield exporter
+    tracing.tracer.exporters.remove(exporter)
+
+
+def test_records_a_span_per_handler_and_per_commit(exporter):
+    bus = bootstrap_test_app()
+    bus.handle(commands.CreateBatch("b1", "LAMP", 100, None))
+    exporter.clear()
+
+    bus.handle(commands.Allocate("o1", "LAMP", 10))
+
+    [command_span] = exporter.named("handle Allocate")
+    allocated_spans = exporter.named("handle Allocated")
+    commit_spans = exporter.named("uow.commit")
+    assert command_span.attributes["code.function"] == "allocate"
+    assert {s.attributes["code.function"] for s in allocated_spans} == {
+        "publish_allocated_event",
+        "update_allocations_view",
+    }
+    assert {s.trace_id for s in exporter.spans} == {command_span.trace_id}
+    assert all(s.parent_span_id == command_span.span_id for s in allocated_spans)
+    assert commit_spans[0].parent_span_id == command_span.span_id
+    assert all(s.end_time_ns >= s.start_time_ns for s in exporter.spans)
+
+
+def test_events_carry_causation_and_correlation_ids(exporter):
+    bus = bootstrap_test_app()
+    bus.handle(commands.CreateBatch("b1", "LAMP", 10, None))
+    command = commands.Allocate("o1", "LAMP", 10)
+    bus.handle(command)
+    exporter.clear()
+
+    change = commands.ChangeBatchQuantity("b1", 5)
+    bus.handle(change)
+
+    root = tracing.context_of(change)
+    [command_span] = exporter.named("handle ChangeBatchQuantity")
+    caused = exporter.named("handle Deallocated") + exporter.named(
+        "handle OutOfStock"
+    )
+    assert {s.attributes["message.causation_id"] for s in caused} == {root.message_id}
+    assert {s.parent_span_id for s in caused} == {command_span.span_id}
+    assert root.message_id not in {
+        s.attributes["messaging.message.id"] for s in caused
+    }
+    assert {
+        s.attributes["messaging.message.conversation_id"]
+        for s in exporter.spans
+        if s.name.startswith("handle")
+    } == {root.correlation_id}
+
+
+def test_continues_a_trace_context_received_with_the_message(exporter):
+    upstream = tracing.root_context().caused(tracing.new_span_id())
+    command = tracing.attach(commands.CreateBatch("b1", "LAMP", 10, None), upstream)
+
+    bootstrap_test_app().handle(command)
+
+    [span] = exporter.named("handle CreateBatch")
+    assert span.trace_id == upstream.trace_id
+    assert span.parent_span_id == upstream.parent_span_id
+
+
+def test_failed_handlers_mark_their_span_as_errored(exporter):
+    bus = bootstrap_test_app()
+    with pytest.raises(Exception):
+        bus.handle(commands.Allocate("o1", "NONEXISTENT", 10))
+    [span] = exporter.named("handle Allocate")
+    assert span.error.startswith("InvalidSku")
+    assert span.to_otlp()["status"] == {"code": 2, "message": span.error}
+
+
+def test_spans_export_as_otlp_json():
+    span = tracing.Span("handle X", "ab" * 16, "cd" * 8, None, 1, 2, {"n": 1})
+    assert span.to_otlp() == {
+        "traceId": "ab" * 16,
+        "spanId": "cd" * 8,
+        "name": "handle X",
+        "kind": 1,
+        "startTimeUnixNano": "1",
+        "endTimeUnixNano": "2",
+        "attributes": [{"key": "n", "value": {"intValue": "1"}}],
+        "status": {"code": 1},
+    }